@@ -5,6 +5,8 @@ import threading
 from time import sleep
 from utils import tetrahedron_plotter
 from multiprocessing import Process, Pipe
+from linknetworking import GaitCompiler
+from linkcompletion import wait_for_commands
 
 class Vertex:
     
@@ -104,14 +106,23 @@ class Tetrahedron:
 
     
     # contract all links
-    def contract(self):
-        self.set_all(self.MIN_POS)
+    def contract(self, completion=False):
+        return self.set_all(self.MIN_POS, completion=completion)
 
     # set position for all links    
-    def set_all(self, position, exclude=[]):
-        for l in self.links:
-            if l not in exclude:
-                l.send_position_only(position, position)
+    def set_all(self, position, exclude=[], completion=False):
+        return self.send_positions({l: (position, position) for l in self.links if l not in exclude}, completion)
+
+    # {RobotLink: (srv0_pos, srv1_pos)}, sent as one group so the links start together
+    # (with completion, the GroupSend has a completion future per link, see wait_positions)
+    def send_positions(self, positions, completion=False):
+        return self.server.send_group({l.device_id: position for l, position in positions.items()},
+                                      completion=completion, timeout=self.t)
+
+    # waits until the links of a send_positions(..., completion=True) reached their positions,
+    # at most timeout (self.t) seconds, returns early when the event is set
+    def wait_positions(self, group, timeout=None):
+        return wait_for_commands(group.completions.values(), self.t if timeout is None else timeout, self.event)
 
 
     # crawl continuously
@@ -159,107 +170,54 @@ class Tetrahedron:
 
         for i in range(steps):
             #print(f'rotating with pivot link {pivot.device_id}')
-            bl.send_position_only(self.MIN_POS, self.MIN_POS)
-            br.send_position_only(self.MIN_POS, self.MIN_POS)
-            bf.send_position_only(self.MIN_POS, self.MIN_POS)
+            contraction = self.send_positions({bl: (self.MIN_POS, self.MIN_POS), br: (self.MIN_POS, self.MIN_POS), bf: (self.MIN_POS, self.MIN_POS)}, completion=True)
 
             if dir == 'ccw':
                 print("rotate")
-                self.event.wait(self.t)
-                # bl.send_position_only(self.MAX_POS, self.MIN_POS)
-                # br.send_position_only(self.MIN_POS, self.MAX_POS)
-                # bf.send_position_only(self.MAX_POS, self.MIN_POS) # CORRECT
-                if bl_flip:
-                    bl.send_position_only(self.MIN_POS, self.MAX_POS)
-                else:
-                    bl.send_position_only(self.MAX_POS, self.MIN_POS)
-                    # bl.send_position_only(self.MID_POS, self.MIN_POS)
-                if br_flip:
-                    br.send_position_only(self.MIN_POS, self.MAX_POS)
-                else:
-                    br.send_position_only(self.MAX_POS, self.MIN_POS)
-
-                # modified the crawling motion
-                bf.send_position_only(self.MID_POS, self.MID_POS)
-
+                self.wait_positions(contraction)
+                push = {
+                    bl: (self.MIN_POS, self.MAX_POS) if bl_flip else (self.MAX_POS, self.MIN_POS),
+                    br: (self.MIN_POS, self.MAX_POS) if br_flip else (self.MAX_POS, self.MIN_POS),
+                    # modified the crawling motion
+                    bf: (self.MID_POS, self.MID_POS),
+                }
                 if ul_flip:
-                    ur.send_position_only(self.MAX_POS, self.MAX_POS)
-                else:
-                    ul.send_position_only(self.MAX_POS, self.MAX_POS)
-                # ub.send_position_only(self.MIN_POS, self.MAX_POS)
-                self.event.wait(self.t)
-                # bl.send_position_only(self.MIN_POS, self.MAX_POS)
-                # br.send_position_only(self.MAX_POS, self.MIN_POS)
-                # bf.send_position_only(self.MIN_POS, self.MAX_POS)
-
-                if bl_flip:
-                    bl.send_position_only(self.MAX_POS, self.MIN_POS)
+                    push[ur] = (self.MAX_POS, self.MAX_POS)
                 else:
-                    bl.send_position_only(self.MIN_POS, self.MAX_POS)
-                    # bl.send_position_only(self.MIN_POS, self.MID_POS)
-                if br_flip:
-                    br.send_position_only(self.MAX_POS, self.MIN_POS)
-                else:
-                    br.send_position_only(self.MIN_POS, self.MAX_POS)
+                    push[ul] = (self.MAX_POS, self.MAX_POS)
+                self.wait_positions(self.send_positions(push, completion=True))
 
-                # to help with a push
-                if ub_flip:
-                    ub.send_position_only(self.MIN_POS, self. MAX_POS)
-                else:    
-                    ub.send_position_only(self.MIN_POS, self. MAX_POS)
-                
-                self.event.wait(12)
+                self.wait_positions(self.send_positions({
+                    bl: (self.MAX_POS, self.MIN_POS) if bl_flip else (self.MIN_POS, self.MAX_POS),
+                    br: (self.MAX_POS, self.MIN_POS) if br_flip else (self.MIN_POS, self.MAX_POS),
+                    # to help with a push
+                    ub: (self.MIN_POS, self.MAX_POS),
+                }, completion=True), 12)
 
                 if self.event.is_set(): return
-                self.contract()
-                self.event.wait(12)
+                self.wait_positions(self.contract(completion=True), 12)
 
 
             elif dir == 'cw':
                 print("rotating")
-                self.event.wait(self.t)
-                # bl.send_position_only(self.MAX_POS, self.MIN_POS)
-                # br.send_position_only(self.MIN_POS, self.MAX_POS)
-                # bf.send_position_only(self.MAX_POS, self.MIN_POS) # CORRECT
-                if bl_flip:
-                    bl.send_position_only(self.MIN_POS, self.MAX_POS)
-                else:
-                    bl.send_position_only(self.MAX_POS, self.MIN_POS)
-                    # bl.send_position_only(self.MID_POS, self.MIN_POS)
-                if br_flip:
-                    br.send_position_only(self.MIN_POS, self.MAX_POS)
-                else:
-                    br.send_position_only(self.MAX_POS, self.MIN_POS)
-
-                # modified the crawling motion
-
-                bf.send_position_only(self.MID_POS, self.MID_POS)
-
-                ur.send_position_only(self.MAX_POS, self.MAX_POS)
-                # ub.send_position_only(self.MIN_POS, self.MAX_POS)
-                self.event.wait(self.t)
-                # bl.send_position_only(self.MIN_POS, self.MAX_POS)
-                # br.send_position_only(self.MAX_POS, self.MIN_POS)
-                # bf.send_position_only(self.MIN_POS, self.MAX_POS)
-
-                if bl_flip:
-                    bl.send_position_only(self.MAX_POS, self.MIN_POS)
-                else:
-                    bl.send_position_only(self.MIN_POS, self.MAX_POS)
-                    # bl.send_position_only(self.MIN_POS, self.MID_POS)
-                if br_flip:
-                    br.send_position_only(self.MAX_POS, self.MIN_POS)
-                else:
-                    br.send_position_only(self.MIN_POS, self.MAX_POS)
-
-                # to help with a push    
-                ub.send_position_only(self.MIN_POS, self. MAX_POS)
-                
-                self.event.wait(12)
+                self.wait_positions(contraction)
+                self.wait_positions(self.send_positions({
+                    bl: (self.MIN_POS, self.MAX_POS) if bl_flip else (self.MAX_POS, self.MIN_POS),
+                    br: (self.MIN_POS, self.MAX_POS) if br_flip else (self.MAX_POS, self.MIN_POS),
+                    # modified the crawling motion
+                    bf: (self.MID_POS, self.MID_POS),
+                    ur: (self.MAX_POS, self.MAX_POS),
+                }, completion=True))
+
+                self.wait_positions(self.send_positions({
+                    bl: (self.MAX_POS, self.MIN_POS) if bl_flip else (self.MIN_POS, self.MAX_POS),
+                    br: (self.MAX_POS, self.MIN_POS) if br_flip else (self.MIN_POS, self.MAX_POS),
+                    # to help with a push
+                    ub: (self.MIN_POS, self.MAX_POS),
+                }, completion=True), 12)
 
                 if self.event.is_set(): return
-                self.contract()
-                self.event.wait(12)
+                self.wait_positions(self.contract(completion=True), 12)
 
             # if dir == 'ccw':
             #     print("rotating counter clockwise")
@@ -281,9 +239,7 @@ class Tetrahedron:
             # self.event.wait(self.t)
 
         # this is to make sure the triangle gets back to the default position
-        bf.send_position_only(self.MIN_POS, self.MIN_POS)
-        bl.send_position_only(self.MIN_POS, self.MIN_POS)
-        br.send_position_only(self.MIN_POS, self.MIN_POS)
+        self.send_positions({bf: (self.MIN_POS, self.MIN_POS), bl: (self.MIN_POS, self.MIN_POS), br: (self.MIN_POS, self.MIN_POS)})
         # rotating is done, set the event flag to true
         self.event.set()
 
@@ -412,32 +368,33 @@ class Tetrahedron:
         if self.event.is_set(): 
             print("flag 0.5")
             return
+        # every command returns a completion future, the next step starts once they resolved
         if ul_flip:
-            ul.send_position_only(self.MAX_POS, self.MIN_POS)
+            expand = [ul.send_position_only(self.MAX_POS, self.MIN_POS, completion=True)]
         else:
             print("flag 1")
-            ul.send_position_only(self.MIN_POS, self.MAX_POS)
+            expand = [ul.send_position_only(self.MIN_POS, self.MAX_POS, completion=True)]
         if ur_flip:
             print("flag 2")
-            ur.send_position_only(self.MAX_POS, self.MIN_POS)
+            expand.append(ur.send_position_only(self.MAX_POS, self.MIN_POS, completion=True))
         else:
-            ur.send_position_only(self.MIN_POS, self.MAX_POS)
+            expand.append(ur.send_position_only(self.MIN_POS, self.MAX_POS, completion=True))
         print("flag 3")
-        bf.send_position_only(BF_POS, BF_POS)
-        self.event.wait(self.t)
+        expand.append(bf.send_position_only(BF_POS, BF_POS, completion=True))
+        wait_for_commands(expand, self.t, self.event)
 
         # topple
         topple_value = 88 # used to be 90
         if self.event.is_set(): return
         if ub_flip:
-            ub.send_position_only(self.MAX_POS, topple_value)
+            topple = [ub.send_position_only(self.MAX_POS, topple_value, completion=True)]
         else:
-            ub.send_position_only(topple_value, self.MAX_POS)
+            topple = [ub.send_position_only(topple_value, self.MAX_POS, completion=True)]
         
         if tail is not None:
             self.event.wait(3)
-            tail.send_position_only(self.MAX_POS, self.MIN_POS)
-        self.event.wait(self.t)
+            topple.append(tail.send_position_only(self.MAX_POS, self.MIN_POS, completion=True))
+        wait_for_commands(topple, self.t, self.event)
 
         print("flag 4")
 
@@ -456,124 +413,145 @@ class Tetrahedron:
         # event.wait(self.t)
 
         if self.event.is_set(): return
-        self.contract()
-        self.event.wait(self.t)
+        self.wait_positions(self.contract(completion=True))
         print("flag 5")
 
         self.event.set() # set event to true to indicate that the topple is finished
 
 
         
+    # send every phase from the server, the next one as soon as the links reached their positions
+    # (at most phase duration), returns False if the gait was interrupted (event set)
+    def run_phases(self, phases):
+        for duration, commands in phases:
+            if self.event.is_set(): return False
+            self.wait_positions(self.send_positions(commands, completion=True), duration)
+        return True
+
+    def contract_phase(self):
+        return (self.t, {l: (self.MIN_POS, self.MIN_POS) for l in self.links})
+
     # crawl one step in the bl, br (bottom-left, bottom-right) direction
     def crawl_forward(self, links, flip):
         print("crawling step")
+        self.run_phases(self.crawl_forward_phases(links, flip))
+
+    def crawl_forward_phases(self, links, flip):
         ul, ur, ub, bl, br, bf = links
         ub_flip, ul_flip, ur_flip, bl_flip, br_flip = flip
-        
-
-        if self.event.is_set(): return
-        if bl_flip:
-            bl.send_position_only(self.MIN_POS, self.MAX_POS)
-        else:
-            bl.send_position_only(self.MAX_POS, self.MIN_POS)
-        if br_flip:
-            br.send_position_only(self.MIN_POS, self.MAX_POS)
-        else:
-            br.send_position_only(self.MAX_POS, self.MIN_POS)
-        
-        bf.send_position_only(self.MID_POS, self.MID_POS)
-
-        if ul_flip:
-            ul.send_position_only(self.MID_POS, self.MIN_POS)
-        else:
-            ul.send_position_only(self.MIN_POS, self.MID_POS)
-        if ur_flip:
-            ur.send_position_only(self.MID_POS, self.MIN_POS)
-        else:
-            ur.send_position_only(self.MIN_POS, self.MID_POS)
-        self.event.wait(12)
-
-        if self.event.is_set(): return
-        if ul_flip:
-            ul.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            ul.send_position_only(self.MIN_POS, self.MAX_POS)
-        if ur_flip:
-            ur.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            ur.send_position_only(self.MIN_POS, self.MAX_POS)
-
-        if bl_flip:
-            bl.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            bl.send_position_only(self.MIN_POS, self.MAX_POS)
-        if br_flip:
-            br.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            br.send_position_only(self.MIN_POS, self.MAX_POS)
-        self.event.wait(12)
-
-        if self.event.is_set(): return
-        self.contract()
-        self.event.wait(12)
+        MIN_POS, MAX_POS, MID_POS = self.MIN_POS, self.MAX_POS, self.MID_POS
+
+        return [
+            (self.t, {
+                bl: (MIN_POS, MAX_POS) if bl_flip else (MAX_POS, MIN_POS),
+                br: (MIN_POS, MAX_POS) if br_flip else (MAX_POS, MIN_POS),
+                bf: (MID_POS, MID_POS),
+                ul: (MID_POS, MIN_POS) if ul_flip else (MIN_POS, MID_POS),
+                ur: (MID_POS, MIN_POS) if ur_flip else (MIN_POS, MID_POS),
+            }),
+            (self.t, {
+                ul: (MAX_POS, MIN_POS) if ul_flip else (MIN_POS, MAX_POS),
+                ur: (MAX_POS, MIN_POS) if ur_flip else (MIN_POS, MAX_POS),
+                bl: (MAX_POS, MIN_POS) if bl_flip else (MIN_POS, MAX_POS),
+                br: (MAX_POS, MIN_POS) if br_flip else (MIN_POS, MAX_POS),
+            }),
+            self.contract_phase(),
+        ]
 
     def crawl_backward(self, links, flip):
         print("crawling step")
+        self.run_phases(self.crawl_backward_phases(links, flip))
+
+    def crawl_backward_phases(self, links, flip):
         ul, ur, ub, bl, br, bf = links
         ub_flip, ul_flip, ur_flip, bl_flip, br_flip = flip
-        
-        if self.event.is_set(): return
-        if ul_flip:
-            ul.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            ul.send_position_only(self.MIN_POS, self.MAX_POS)
-        if ur_flip:
-            ur.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            ur.send_position_only(self.MIN_POS, self.MAX_POS)
-
-        if bl_flip:
-            bl.send_position_only(self.MIN_POS, self.MAX_POS)
-        else:
-            bl.send_position_only(self.MAX_POS, self.MIN_POS)
-            # bl.send_position_only(self.MID_POS, self.MIN_POS)
-        if br_flip:
-            br.send_position_only(self.MIN_POS, self.MAX_POS)
-        else:
-            br.send_position_only(self.MAX_POS, self.MIN_POS)
-
-        # modified the crawling motion
-
-        bf.send_position_only(self.MID_POS, self.MID_POS)
-
-        self.event.wait(12)
-        
-        if self.event.is_set(): return
-        if bl_flip:
-            bl.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            bl.send_position_only(self.MIN_POS, self.MAX_POS)
-            # bl.send_position_only(self.MIN_POS, self.MID_POS)
-        if br_flip:
-            br.send_position_only(self.MAX_POS, self.MIN_POS)
-        else:
-            br.send_position_only(self.MIN_POS, self.MAX_POS)
+        MIN_POS, MAX_POS, MID_POS = self.MIN_POS, self.MAX_POS, self.MID_POS
+
+        return [
+            (self.t, {
+                ul: (MAX_POS, MIN_POS) if ul_flip else (MIN_POS, MAX_POS),
+                ur: (MAX_POS, MIN_POS) if ur_flip else (MIN_POS, MAX_POS),
+                bl: (MIN_POS, MAX_POS) if bl_flip else (MAX_POS, MIN_POS),
+                br: (MIN_POS, MAX_POS) if br_flip else (MAX_POS, MIN_POS),
+                # modified the crawling motion
+                bf: (MID_POS, MID_POS),
+            }),
+            (self.t, {
+                bl: (MAX_POS, MIN_POS) if bl_flip else (MIN_POS, MAX_POS),
+                br: (MAX_POS, MIN_POS) if br_flip else (MIN_POS, MAX_POS),
+                ul: (MID_POS, MIN_POS) if ul_flip else (MIN_POS, MID_POS),
+                ur: (MID_POS, MIN_POS) if ur_flip else (MIN_POS, MID_POS),
+                # to help with a push
+                ub: (MAX_POS, MAX_POS),
+            }),
+            self.contract_phase(),
+        ]
 
-        if ul_flip:
-            ul.send_position_only(self.MID_POS, self.MIN_POS)
-        else:
-            ul.send_position_only(self.MIN_POS, self.MID_POS)
-        if ur_flip:
-            ur.send_position_only(self.MID_POS, self.MIN_POS)
+    # one rotation step, same commands as rotate()
+    def rotate_phases(self, dir, links, flip):
+        ul, ur, ub, bl, br, bf = links
+        ub_flip, ul_flip, ur_flip, bl_flip, br_flip = flip
+        MIN_POS, MAX_POS, MID_POS = self.MIN_POS, self.MAX_POS, self.MID_POS
+
+        push = {
+            bl: (MIN_POS, MAX_POS) if bl_flip else (MAX_POS, MIN_POS),
+            br: (MIN_POS, MAX_POS) if br_flip else (MAX_POS, MIN_POS),
+            bf: (MID_POS, MID_POS),
+        }
+        if dir == 'ccw' and not ul_flip:
+            push[ul] = (MAX_POS, MAX_POS)
         else:
-            ur.send_position_only(self.MIN_POS, self.MID_POS)
-        # to help with a push    
-        ub.send_position_only(self.MAX_POS, self. MAX_POS)
-        self.event.wait(12)
-
-        if self.event.is_set(): return
-        self.contract()
-        self.event.wait(12)
+            push[ur] = (MAX_POS, MAX_POS)
+
+        return [
+            (self.t, {bl: (MIN_POS, MIN_POS), br: (MIN_POS, MIN_POS), bf: (MIN_POS, MIN_POS)}),
+            (self.t, push),
+            (self.t, {
+                bl: (MAX_POS, MIN_POS) if bl_flip else (MIN_POS, MAX_POS),
+                br: (MAX_POS, MIN_POS) if br_flip else (MIN_POS, MAX_POS),
+                ub: (MIN_POS, MAX_POS),
+            }),
+            self.contract_phase(),
+        ]
+
+    # same commands as execute_topple() (without the tail)
+    def topple_phases(self, links, flip, bf_pos=100):
+        ul, ur, ub, bl, br, bf = links
+        ub_flip, ul_flip, ur_flip, bl_flip, br_flip = flip
+        MIN_POS, MAX_POS = self.MIN_POS, self.MAX_POS
+        topple_value = 88
+
+        return [
+            (self.t, {
+                ul: (MAX_POS, MIN_POS) if ul_flip else (MIN_POS, MAX_POS),
+                ur: (MAX_POS, MIN_POS) if ur_flip else (MIN_POS, MAX_POS),
+                bf: (bf_pos, bf_pos),
+            }),
+            (self.t, {ub: (MAX_POS, topple_value) if ub_flip else (topple_value, MAX_POS)}),
+            self.contract_phase(),
+        ]
+
+    # Compiles the phases into one list package per link and uploads them in one burst, so the
+    # whole gait runs on the links from a shared start time (see linknetworking.GaitCompiler)
+    def upload_gait(self, phases, steps=1):
+        compiler = GaitCompiler(self.server, rest=(self.MIN_POS, self.MIN_POS))
+        return compiler.compile_and_upload(phases, nr_repeat=steps)
+
+    def upload_crawl(self, dir=2, steps=1):
+        link_edges, flip = self.calculate_pose(dir)
+        links = [l.link for l in link_edges]
+        return self.upload_gait(self.crawl_backward_phases(links, flip), steps)
+
+    def upload_rotate(self, dir, steps=1):
+        link_edges, flip = self.calculate_pose(2)
+        links = [l.link for l in link_edges]
+        return self.upload_gait(self.rotate_phases(dir, links, flip), steps)
+
+    def upload_topple(self, dir=2, bf_pos=100):
+        link_edges, flip = self.calculate_pose(dir)
+        self.top_vertex = link_edges[2].srv0 if link_edges[2].srv0.id != self.top_vertex.id else link_edges[2].srv1
+        links = [l.link for l in link_edges]
+        return self.upload_gait(self.topple_phases(links, flip, bf_pos))
 
 
     # def crawl_backward_original(self, links, flip):
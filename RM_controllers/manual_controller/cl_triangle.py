@@ -1,6 +1,8 @@
 # Author: Simon Kang simon.kang@columbia.edu
 # Last updated: Nov 19, 2023
 import threading
+from linknetworking import GaitCompiler
+from linkcompletion import wait_for_commands
 
 class Triangle:
     def __init__(self, server, link_ids=None, MIN_POS=22, MAX_POS=100, MID_POS=50):
@@ -34,34 +36,7 @@ class Triangle:
     def crawl(self, dir, steps=1):
         print(f"Triangle starts crawling...")
         for i in range(steps):
-            if self.event.is_set(): break
-            #self.back.send_position_only(self.LOW_MID_POS, self.LOW_MID_POS)
-            self.back.send_position_only(self.MIN_POS, self.MIN_POS)
-            self.left.send_position_only(self.MIN_POS, self.MIN_POS)
-            self.right.send_position_only(self.MIN_POS, self.MIN_POS)
-            self.event.wait(self.t)
-
-            if self.event.is_set(): break
-            if dir == 1:
-                self.left.send_position_only(self.MAX_POS, self.MIN_POS)
-                self.right.send_position_only(self.MAX_POS, self.MIN_POS)
-            elif dir == -1:
-                self.left.send_position_only(self.MIN_POS, self.MAX_POS)
-                self.right.send_position_only(self.MIN_POS, self.MAX_POS)
-            #self.back.send_position_only(self.MID_POS, self.MID_POS)
-            #self.back.send_position_only(65, 65)
-            self.event.wait(self.t)
-
-            if self.event.is_set(): break
-            if dir == 1:
-                self.back.send_position_only(self.MID_POS, self.MID_POS)
-                self.left.send_position_only(self.MIN_POS, self.MAX_POS)
-                self.right.send_position_only(self.MIN_POS, self.MAX_POS)
-            elif dir == -1:
-                self.back.send_position_only(self.MID_POS, self.MID_POS)
-                self.left.send_position_only(self.MAX_POS, self.MIN_POS)
-                self.right.send_position_only(self.MAX_POS, self.MIN_POS)
-            self.event.wait(self.t)
+            if not self.run_phases(self.crawl_phases(dir)): break
         
         # this is to make sure the triangle gets back to the default position
         self.back.send_position_only(self.MIN_POS, self.MIN_POS)
@@ -69,6 +44,54 @@ class Triangle:
         self.right.send_position_only(self.MIN_POS, self.MIN_POS)
         # crawling is done, set the event flag to true
         self.event.set()
+
+    # send every phase from the server, the next one as soon as the links reached their positions
+    # (at most phase duration), returns False if the gait was interrupted (event set)
+    def run_phases(self, phases):
+        for duration, commands in phases:
+            if self.event.is_set(): return False
+            group = self.server.send_group({link.device_id: position for link, position in commands.items()},
+                                           completion=True, timeout=duration)
+            wait_for_commands(group.completions.values(), duration, self.event)
+        return True
+
+    def crawl_phases(self, dir):
+        MIN_POS, MAX_POS, MID_POS = self.MIN_POS, self.MAX_POS, self.MID_POS
+        #self.back.send_position_only(self.LOW_MID_POS, self.LOW_MID_POS)
+        phases = [(self.t, {self.back: (MIN_POS, MIN_POS), self.left: (MIN_POS, MIN_POS), self.right: (MIN_POS, MIN_POS)})]
+        if dir == 1:
+            phases.append((self.t, {self.left: (MAX_POS, MIN_POS), self.right: (MAX_POS, MIN_POS)}))
+            phases.append((self.t, {self.back: (MID_POS, MID_POS), self.left: (MIN_POS, MAX_POS), self.right: (MIN_POS, MAX_POS)}))
+        elif dir == -1:
+            phases.append((self.t, {self.left: (MIN_POS, MAX_POS), self.right: (MIN_POS, MAX_POS)}))
+            phases.append((self.t, {self.back: (MID_POS, MID_POS), self.left: (MAX_POS, MIN_POS), self.right: (MAX_POS, MIN_POS)}))
+        else:
+            phases.append((self.t, {}))
+            phases.append((self.t, {}))
+        return phases
+
+    def rotate_phases(self, dir):
+        MIN_POS, MAX_POS = self.MIN_POS, self.MAX_POS
+        phases = [(self.t, {self.left: (MIN_POS, MIN_POS), self.right: (MIN_POS, MIN_POS), self.back: (MIN_POS, MIN_POS)})]
+        if dir == 'ccw':
+            phases.append((self.t, {self.left: (MIN_POS, MAX_POS), self.right: (MAX_POS, MIN_POS), self.back: (MAX_POS, MIN_POS)}))
+            phases.append((self.t, {self.back: (MIN_POS, MAX_POS)}))
+        elif dir == 'cw':
+            phases.append((self.t, {self.left: (MAX_POS, MIN_POS), self.right: (MIN_POS, MAX_POS), self.back: (MIN_POS, MAX_POS)}))
+            phases.append((self.t, {self.back: (MAX_POS, MIN_POS)}))
+        return phases
+
+    # Compiles the phases into one list package per link and uploads them in one burst, so the
+    # whole gait runs on the links from a shared start time (see linknetworking.GaitCompiler)
+    def upload_gait(self, phases, steps=1):
+        compiler = GaitCompiler(self.server, rest=(self.MIN_POS, self.MIN_POS))
+        return compiler.compile_and_upload(phases, nr_repeat=steps)
+
+    def upload_crawl(self, dir, steps=1):
+        return self.upload_gait(self.crawl_phases(dir), steps)
+
+    def upload_rotate(self, dir, steps=1):
+        return self.upload_gait(self.rotate_phases(dir), steps)
     
     # def crawl_2(self, event, steps=100):
     #     print(f"Triangle starts crawling...")
@@ -398,9 +398,8 @@ def main(nr_links):
         server = linknetworking.get_default_server()
 
         my_dashboard = dashboard.Dashboard(server, list(range(35)), open_in_browser=True)
-        while server.size() < nr_links:
+        while not server.wait_for_links(nr_links, timeout=1):
             print(f"Waiting for links to connect. Currently {server.size()} of {nr_links} links are connected.")
-            sleep(1)
         
 
         debug_print("STARTING SCRIPTS!!!!!")
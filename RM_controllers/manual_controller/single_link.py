@@ -2,6 +2,8 @@
 # Edits: Simon Kang simon.kang@columbia.edu
 # Last updated: Nov 10, 2023
 import threading
+from linknetworking import GaitCompiler
+from linkcompletion import wait_for_commands
 
 class SingleLink:
     def __init__(self, link, link_id=None, MIN_POS=22, MAX_POS=100):
@@ -20,29 +22,35 @@ class SingleLink:
     def crawl(self, dir=0, steps=1):
         print(f"link {self.name} start crawling in SRV{dir} direction")
         # self.event.clear() # internal flag is set to false, so wait() will block
+        # same phases as the uploaded crawl (upload_crawl)
+        phases = self.crawl_phases(dir)
         for i in range(steps):
-            # crawling pauses when internal flag is set, makes it exit the loop
+            for t, positions in phases:
+                # crawling pauses when internal flag is set, makes it exit the loop
+                if self.event.is_set(): break
+                self.wait(self.link.send_position_only(*positions[self.link], completion=True), t)
             if self.event.is_set(): break # break out of the loop
-            if dir:
-                self.link.send_position_only(self.MIN_POS, self.MAX_POS)
-            elif dir == -1:
-                self.link.send_position_only(self.MAX_POS, self.MIN_POS)
-            self.event.wait(12)
-
-            if self.event.is_set(): break
-            if dir:
-                self.link.send_position_only(self.MAX_POS, self.MIN_POS)
-            elif dir == -1:
-                self.link.send_position_only(self.MIN_POS, self.MAX_POS)
-            self.event.wait(12)
-
-            if self.event.is_set(): break
-            self.link.send_position_only(self.MIN_POS, self.MIN_POS)
-            self.event.wait(12)
 
         self.link.send_position_only(self.MIN_POS, self.MIN_POS)
         self.event.set()
-    
 
-        
+    # waits until the link reached the position of a command, at most t seconds (returns early
+    # when the event is set)
+    def wait(self, completion, t=12):
+        return wait_for_commands([completion], t, self.event)
+
+    def crawl_phases(self, dir=0, t=12):
+        if dir == -1:
+            first, second = (self.MAX_POS, self.MIN_POS), (self.MIN_POS, self.MAX_POS)
+        else:
+            first, second = (self.MIN_POS, self.MAX_POS), (self.MAX_POS, self.MIN_POS)
+        return [
+            (t, {self.link: first}),
+            (t, {self.link: second}),
+            (t, {self.link: (self.MIN_POS, self.MIN_POS)}),
+        ]
 
+    # uploads the whole crawl as one list package, the link runs it locally
+    def upload_crawl(self, server, dir=0, steps=1):
+        compiler = GaitCompiler(server, rest=(self.MIN_POS, self.MIN_POS))
+        return compiler.compile_and_upload(self.crawl_phases(dir), nr_repeat=steps)
@@ -11,6 +11,7 @@ that has access to the LinkServer object.
 """
 import threading
 import cv2
+import numpy as np
 import webbrowser as wb
 import logging
 
@@ -207,6 +208,9 @@ class Dashboard(threading.Thread):
         if not self.link_server or not hasattr(self.link_server, 'links'):
             return []
 
+        if hasattr(self.link_server, 'state'):
+            return self.get_rows_from_state()
+
         for device_id in self.device_ids:
             if device_id in self.link_server.links:
                 link = self.link_server.links[device_id]
@@ -243,6 +247,34 @@ class Dashboard(threading.Thread):
             rows = sorted(rows, key=lambda x: str(x["0"]))
         return rows
 
+    def get_rows_from_state(self):
+        """
+        Same rows as get_rows, from one snapshot of the LinkServer state table
+        (consistent across links, no per-attribute reads).
+        """
+        from linkstate import NONE  # only needed with a real LinkServer
+
+        state = self.link_server.state.snapshot()
+        state = state[np.isin(state['device_id'], list(self.device_ids))]
+        state = state[np.argsort(state['device_id'], kind='stable')]
+
+        columns = {}
+        for i, field in enumerate(FIELDS):
+            if field == "device_status":
+                columns[str(i)] = [value.decode("ASCII") if value else None for value in state[field].tolist()]
+            elif field in state.dtype.names:
+                columns[str(i)] = [None if value == NONE else value for value in state[field].tolist()]
+        for key in ("10", "11"):  # checksums are shown as text
+            columns[key] = [str(value) for value in columns[key]]
+
+        rows = []
+        for i, device_id in enumerate(state['device_id'].tolist()):
+            row_data = {key: values[i] for key, values in columns.items()}
+            link = self.link_server.links.get(device_id)
+            row_data["12"] = getattr(link, 'version', 'N/A')
+            rows.append(row_data)
+        return rows
+
 if __name__ == '__main__':
     # This is an example of how to run the dashboard standalone.
     # In a real application, you would integrate it with your LinkServer.
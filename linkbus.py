@@ -0,0 +1,240 @@
+# Telemetry bus: the server publishes every link's state row (linkstate.STATE_DTYPE) and its
+# recent 'U' packages (linktelemetry.TELEMETRY_DTYPE) into a multiprocessing.shared_memory
+# segment, so the dashboard, loggers and analysis tools can run in their own processes instead of
+# as threads competing with the controllers for the GIL. Readers map the segment and read straight
+# out of it: no sockets, no pickling, nothing sent per reader.
+#
+# The segment is a header and one slot per device_id (device_id is one byte, so 256 slots):
+#   seq, count, state row, telemetry ring of `capacity` rows
+# Every slot is a seqlock: the writer makes seq odd, writes, makes it even again. A reader notes
+# seq, reads, and retries if seq was odd or has changed, so it never keeps a torn row. Writes to a
+# slot are serialized with a lock on the server side (the receiving and the sending thread of a
+# link both publish). Readers never block the writer.
+#
+#   server = LinkServer(host, port, bus=True)                 # segment "trusslink_<port>"
+#
+#   reader = TelemetryBusReader("trusslink_54657")   # any process on the machine
+#   reader.snapshot()                                # STATE_DTYPE rows of the active links
+#   rows, index = reader.since(3, 0)                 # telemetry of link 3, like TelemetryRing.since
+#   seq = reader.begin(3)                            # zero copy: read reader.slot(3) views, then
+#   reader.valid(3, seq)                             # check nothing was written meanwhile
+#
+# The seqlock relies on stores becoming visible in program order, which holds on x86. On weakly
+# ordered CPUs a reader can in rare cases accept a row written concurrently.
+#
+#   python linkbus.py trusslink_54657     # prints the links' state once a second
+
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+from linkstate import STATE_DTYPE
+from linktelemetry import TELEMETRY_DTYPE
+
+BUS_MAGIC = b'RMLBUS1\0'
+HEADER_STRUCT = struct.Struct('<8sIIId')  # magic, version, slots, capacity, start_epoch_raw
+HEADER_SIZE = 64
+BUS_SLOTS = 256
+BUS_CAPACITY = 1024  # telemetry rows per link
+SPINS = 100  # reads of a locked slot before the reader starts sleeping between them
+READ_TIMEOUT = 1.0  # seconds a reader waits for a slot the writer holds
+
+
+def slot_dtype(capacity):
+    return np.dtype([('seq', '<u8'), ('count', '<u8'), ('state', STATE_DTYPE),
+                     ('telemetry', TELEMETRY_DTYPE, (capacity,))], align=True)
+
+
+def default_bus_name(port):
+    return f"trusslink_{port}"
+
+
+class TelemetryBus:
+
+    # Server side: creates the segment (replacing a stale one of the same name) and publishes
+
+    def __init__(self, name, capacity=BUS_CAPACITY, start_epoch_raw=0.0):
+        self.name = name
+        self.capacity = capacity
+        dtype = slot_dtype(capacity)
+        size = HEADER_SIZE + dtype.itemsize * BUS_SLOTS
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.slots = np.ndarray(BUS_SLOTS, dtype=dtype, buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.slots['seq'] = 0
+        self.slots['count'] = 0
+        self.slots['state']['active'] = False
+        self.seq = self.slots['seq']
+        self.count = self.slots['count']
+        self.state = self.slots['state']
+        self.telemetry = self.slots['telemetry']
+        self.locks = [threading.Lock() for _ in range(BUS_SLOTS)]
+        HEADER_STRUCT.pack_into(self.shm.buf, 0, BUS_MAGIC, 1, BUS_SLOTS, capacity, start_epoch_raw)
+        self.closed = False
+
+    # state_row: a row of a STATE_DTYPE table. telemetry: (time,) + 'U' package, or TELEMETRY_DTYPE
+    # rows (e.g. a shard's batch), or None
+    def publish(self, device_id, state_row, telemetry=None):
+        if self.closed:
+            return
+        with self.locks[device_id]:
+            if self.closed:  # closed while waiting for the lock
+                return
+            self.seq[device_id] += 1
+            self.state[device_id] = state_row
+            if isinstance(telemetry, tuple):
+                count = int(self.count[device_id])
+                self.telemetry[device_id, count % self.capacity] = telemetry
+                self.count[device_id] = count + 1
+            elif telemetry is not None and len(telemetry):
+                telemetry = telemetry[-self.capacity:]
+                count = int(self.count[device_id])
+                self.telemetry[device_id, np.arange(count, count + len(telemetry)) % self.capacity] = telemetry
+                self.count[device_id] = count + len(telemetry)
+            self.seq[device_id] += 1
+
+    # The link's connection closed; its last values stay readable
+    def deactivate(self, device_id):
+        if self.closed:
+            return
+        with self.locks[device_id]:
+            if self.closed:
+                return
+            self.seq[device_id] += 1
+            self.state['active'][device_id] = False
+            self.seq[device_id] += 1
+
+    # Waits for publishes in progress (every slot lock) before the arrays and the segment go away
+    def close(self):
+        if self.closed:
+            return
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            del self.seq, self.count, self.state, self.telemetry, self.slots
+            self.shm.close()
+            self.shm.unlink()
+        finally:
+            for lock in self.locks:
+                lock.release()
+
+
+class TelemetryBusReader:
+
+    # Maps a bus by name, read only use
+
+    def __init__(self, name):
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before Python 3.13 attaching registers the segment with this process' resource
+            # tracker, which would unlink it when the reader exits
+            self.shm = shared_memory.SharedMemory(name)
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            except Exception:
+                pass
+        magic, version, nr_slots, capacity, self.start_epoch_raw = HEADER_STRUCT.unpack_from(self.shm.buf, 0)
+        if magic != BUS_MAGIC:
+            raise ValueError(f"{name} is not a telemetry bus")
+        self.capacity = capacity
+        self.slots = np.ndarray(nr_slots, dtype=slot_dtype(capacity), buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.seq = self.slots['seq']
+        self.retries = 0
+
+    # Zero copy reads: seq = begin(id), read from slot(id) views, then check valid(id, seq).
+    # A writer thread can lose the GIL in the middle of a write, so a locked slot is waited for.
+    def begin(self, device_id):
+        deadline = None
+        spins = 0
+        while True:
+            seq = int(self.seq[device_id])
+            if not seq & 1:
+                return seq
+            self.retries += 1
+            spins += 1
+            if spins > SPINS:
+                if deadline is None:
+                    deadline = time.monotonic() + READ_TIMEOUT
+                elif time.monotonic() > deadline:
+                    raise TimeoutError(f"slot {device_id} stays locked")
+                time.sleep(0.0001)
+
+    def valid(self, device_id, seq):
+        return int(self.seq[device_id]) == seq
+
+    def slot(self, device_id):
+        return self.slots[device_id]
+
+    # Runs read(slot view) until it saw a consistent slot and returns its result (which must not
+    # be a view into the slot)
+    def read(self, device_id, read):
+        deadline = time.monotonic() + READ_TIMEOUT
+        while True:
+            seq = self.begin(device_id)
+            result = read(self.slots[device_id])
+            if self.valid(device_id, seq):
+                return result
+            self.retries += 1
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"slot {device_id} keeps changing")
+
+    # State row of a link (copy), None if it never connected
+    def state(self, device_id):
+        row = self.read(device_id, lambda slot: slot['state'].copy())
+        return None if row['device_id'] != device_id else row
+
+    # State rows of every active link, each consistent on its own
+    def snapshot(self):
+        active = np.flatnonzero(self.slots['state']['active'])
+        rows = np.empty(len(active), dtype=STATE_DTYPE)
+        for i, device_id in enumerate(active):
+            rows[i] = self.read(device_id, lambda slot: slot['state'].copy())
+        return rows[rows['active']]
+
+    # Telemetry rows written after logical index first and the index to pass next time, like
+    # TelemetryRing.since
+    def since(self, device_id, first=0):
+        capacity = self.capacity
+
+        def read(slot):
+            count = int(slot['count'])
+            start = max(first, count - capacity, 0)
+            indexes = np.arange(start, count) % capacity
+            return slot['telemetry'][indexes], count
+
+        return self.read(device_id, read)
+
+    def last(self, device_id, n=1):
+        count = int(self.slots['count'][device_id])
+        return self.since(device_id, count - n)[0]
+
+    def close(self):
+        del self.seq, self.slots
+        self.shm.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    reader = TelemetryBusReader(sys.argv[1] if len(sys.argv) > 1 else default_bus_name(54657))
+    while True:
+        state = reader.snapshot()
+        print(time.strftime('%H:%M:%S'), len(state), "links")
+        for row in state:
+            print(f"  {row['device_id']:4} {row['device_status'].decode() or '-'} pos {row['srv0_pos']:4} "
+                  f"{row['srv1_pos']:4} bat {row['bat_status']:4} cmd {row['current_command_checksum']:6} "
+                  f"exec {row['executing_command_checksum']:6}")
+        time.sleep(1)
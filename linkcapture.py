@@ -0,0 +1,261 @@
+# Binary wire capture of a LinkServer and a replayer for it. log=True writes a formatted tuple per
+# 'U' package through logging, which is slow and loses the timing; a capture records every frame
+# received from and written to a link, as is, with a monotonic timestamp, into an append-only file.
+# The links only pack a record header and hand it to a background writer thread, so the receive
+# path never waits on the disk.
+#
+#   server = LinkServer(host, port, capture='run.rmlcap')
+#
+# The file starts with CAPTURE_MAGIC and is a sequence of records: RECORD_STRUCT (time in ns on
+# time.monotonic_ns, kind, connection, device_id or -1 before Hello, payload length) and the
+# payload. Kinds:
+#   'S' a server started capturing, payload SESSION_STRUCT (start_epoch_raw, wall clock time)
+#   'I' frame received on the connection
+#   'O' frame written to the connection, recorded by the link's writer when it hands the frame to
+#       the socket (frames replaced in the send queue before that never show up)
+#   'X' the connection was closed, no payload
+# Connections are numbered per server, a link that reconnects gets a new one.
+#
+# The replayer feeds the inbound frames of a capture back into a running server over TCP, one
+# connection per captured connection, at the recorded pace (speed 1), N times faster or as fast as
+# possible (speed 0), and counts what the server sends back. Controllers can also consume the
+# records directly with replay_records.
+#
+#   python linkcapture.py dump run.rmlcap
+#   python linkcapture.py replay run.rmlcap --speed 0 --server async
+
+import argparse
+import os
+import queue
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from rmlprotocol import StreamFramer
+
+CAPTURE_MAGIC = b'RMLCAP1\n'
+RECORD_STRUCT = struct.Struct('<qBIhH')
+SESSION_STRUCT = struct.Struct('<dd')
+
+SESSION = ord('S')
+INBOUND = ord('I')
+OUTBOUND = ord('O')
+CLOSED = ord('X')
+
+MAX_PENDING = 100000  # records waiting for the writer before new ones are dropped
+
+CaptureRecord = namedtuple('CaptureRecord', ['time', 'kind', 'connection', 'device_id', 'payload'])
+
+
+class WireCapture:
+
+    # Append-only capture file with a background writer. record() can be called from any thread.
+
+    def __init__(self, path, start_epoch_raw=None):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.pending = queue.SimpleQueue()
+        self.records = 0
+        self.dropped = 0
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_loop, name="WireCapture", daemon=True)
+        self.writer.start()
+        start_epoch_raw = time.time() if start_epoch_raw is None else start_epoch_raw
+        self.record(SESSION, 0, -1, SESSION_STRUCT.pack(start_epoch_raw, time.time()))
+
+    # frame may be a memoryview of a framer buffer, it is copied here
+    def record(self, kind, connection, device_id, frame=b''):
+        if self.closed:
+            return
+        if self.pending.qsize() >= MAX_PENDING:
+            self.dropped += 1
+            return
+        header = RECORD_STRUCT.pack(time.monotonic_ns(), kind, connection,
+                                    -1 if device_id is None else device_id, len(frame))
+        self.pending.put(header + frame)
+        self.records += 1
+
+    def write_loop(self):
+        record = self.pending.get()
+        while record is not None:
+            self.file.write(record)
+            try:
+                record = self.pending.get_nowait()
+            except queue.Empty:
+                self.file.flush()
+                record = self.pending.get()
+        self.file.close()
+
+    # Writes what is pending and closes the file
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.writer.join()
+
+    def stats(self):
+        return {'path': self.path, 'records': self.records, 'dropped': self.dropped,
+                'pending': self.pending.qsize()}
+
+
+def read_capture(path):
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a link capture")
+        while True:
+            header = f.read(RECORD_STRUCT.size)
+            if len(header) < RECORD_STRUCT.size:
+                return  # end of file, or a record cut off by a crash
+            t, kind, connection, device_id, length = RECORD_STRUCT.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield CaptureRecord(t / 1e9, kind, connection, device_id, payload)
+
+
+# Yields the records of a capture paced like they were recorded: speed 1 is real time, 10 is ten
+# times faster, 0 doesn't wait at all. Consecutive sessions in one file are played back to back.
+def replay_records(path, speed=1.0, kinds=None):
+    start = time.perf_counter()
+    offset = None
+    for record in read_capture(path):
+        if kinds is not None and record.kind not in kinds:
+            continue
+        if speed:
+            if offset is None or record.kind == SESSION:
+                offset = record.time - (time.perf_counter() - start) * speed
+            delay = (record.time - offset) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        yield record
+
+
+class CaptureReplayer:
+
+    # Replays the inbound frames of a capture into a server at host:port, one TCP connection per
+    # captured connection. What the server sends back is read and counted per device_id.
+
+    def __init__(self, path, host='127.0.0.1', port=None, speed=1.0):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.sockets = {}  # captured connection (per session) -> socket
+        self.selector = selectors.DefaultSelector()
+        self.sent_frames = 0
+        self.captured_outbound = {}  # device_id -> frames the server sent in the capture
+        self.received = {}  # device_id -> frames the server sent during the replay
+        self.running = True
+
+    def connection(self, key, record):
+        sock = self.sockets.get(key)
+        if sock is None:
+            device_id = record.device_id
+            if device_id < 0 and record.payload[1] == ord('H'):
+                device_id = record.payload[2]  # the first frame is the Hello, device_id comes first
+            sock = socket.create_connection((self.host, self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sockets[key] = sock
+            self.selector.register(sock, selectors.EVENT_READ, [device_id, StreamFramer()])
+        return sock
+
+    def read_loop(self):
+        while self.running:
+            for key, _ in self.selector.select(0.05):
+                device_id, framer = key.data
+                try:
+                    framer.recv_from(key.fileobj)
+                except OSError:
+                    try:
+                        self.selector.unregister(key.fileobj)
+                    except (KeyError, ValueError):
+                        pass  # closed by run() meanwhile
+                    continue
+                while framer.next_frame() is not None:
+                    self.received[device_id] = self.received.get(device_id, 0) + 1
+
+    # Returns a summary once every captured connection has been played back and closed
+    def run(self, settle=0.5):
+        reader = threading.Thread(target=self.read_loop, daemon=True)
+        reader.start()
+        session = 0
+        start = time.perf_counter()
+        for record in replay_records(self.path, self.speed):
+            key = (session, record.connection)
+            if record.kind == SESSION:
+                session += 1
+            elif record.kind == INBOUND:
+                self.connection(key, record).sendall(record.payload)
+                self.sent_frames += 1
+            elif record.kind == OUTBOUND:
+                self.captured_outbound[record.device_id] = self.captured_outbound.get(record.device_id, 0) + 1
+            elif record.kind == CLOSED and key in self.sockets:
+                # half close, so what the server still sends is counted
+                self.sockets[key].shutdown(socket.SHUT_WR)
+        elapsed = time.perf_counter() - start
+        time.sleep(settle)
+        for key in list(self.sockets):
+            self.close(key)
+        self.running = False
+        reader.join()
+        return {'sent_frames': self.sent_frames, 'elapsed': elapsed,
+                'captured_outbound': self.captured_outbound, 'received': self.received}
+
+    def close(self, key):
+        sock = self.sockets.pop(key)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+
+def dump(path):
+    names = {SESSION: 'S', INBOUND: 'I', OUTBOUND: 'O', CLOSED: 'X'}
+    start = None
+    for record in read_capture(path):
+        if record.kind == SESSION:
+            start = record.time
+            start_epoch_raw, wall = SESSION_STRUCT.unpack(record.payload)
+            print(f"session start_epoch_raw {start_epoch_raw:.3f} wall {time.ctime(wall)}")
+            continue
+        package_type = chr(record.payload[1]) if len(record.payload) > 1 else '-'
+        print(f"{record.time - start:12.6f} {names[record.kind]} conn {record.connection:4} "
+              f"link {record.device_id:4} {package_type} {record.payload.hex()}")
+
+
+if __name__ == '__main__':
+    import linknetworking
+    import linknetworking_async
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['dump', 'replay'])
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=1.0, help="1 real time, N times faster, 0 as fast as possible")
+    parser.add_argument('--server', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--port', type=int, default=linknetworking.DEFAULT_PORT + 200)
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        dump(args.path)
+        raise SystemExit
+
+    linknetworking.DEBUG = False
+    server_class = linknetworking_async.AsyncLinkServer if args.server == 'async' else linknetworking.LinkServer
+    server = server_class('127.0.0.1', args.port)
+    time.sleep(0.3)
+    cpu = os.times()
+    result = CaptureReplayer(args.path, port=server.port, speed=args.speed).run()
+    used = os.times()
+    server.close_server()
+    print(f"replayed {result['sent_frames']} frames in {result['elapsed']:.2f} s, "
+          f"process cpu {used.user - cpu.user + used.system - cpu.system:.2f} s")
+    for device_id in sorted(set(result['captured_outbound']) | set(result['received'])):
+        print(f"  link {device_id}: server sent {result['received'].get(device_id, 0)} frames, "
+              f"{result['captured_outbound'].get(device_id, 0)} in the capture")
@@ -0,0 +1,170 @@
+# Clock model of a link, to schedule sinusoid and list starts per link at millisecond resolution.
+#
+# The links get the server's start_epoch (whole seconds) in the 'T' package and run on
+#   link time = their clock - start_epoch
+# LinkServer.get_server_time_precise() is the same time base on the server (not rounded, and based
+# on start_epoch rather than start_epoch_raw), LinkClock.to_link_time() maps it to the time a link
+# is expected to show then:
+#   offset(t) = offset_at_sync + drift * (t - sync_time)
+# 'U' packages carry no link timestamp, so what the server can observe is:
+#   drift       the link sends 'U' every nominal_period of its own clock; a line fitted through
+#               the arrival times gives that period in server time, drift = nominal / fitted - 1
+#               (None while nominal_period is unknown or there are too few packages). Packages
+#               that come less than half a period after the previous one (the report right after
+#               a command) are off the schedule and left out, the others get their tick number.
+#   delay       round trips from sending a command to the first 'U' reporting its checksum
+#               (every command is a sample, link.probe_clock() adds one on an idle link); one
+#               way delay is half the smallest recent round trip
+# offset_at_sync is the link's error when it got the epoch (sync_time: sent + one way delay). It
+# is 0 unless measured elsewhere and set with calibrate().
+#
+# Start fields on the wire are whole seconds ('S' and 'L' start_time). schedule_sinusoid() moves
+# the sub second part into the sinusoid's phase shift (ms), so sinusoids start at ms resolution.
+# Lists have nowhere to put it and keep starting on a whole second of server time: with the
+# offset at sync unknown (0) and microseconds of drift over a lead time, the link's nearest
+# second is the same for every link anyway.
+
+import math
+import threading
+from collections import deque
+import numpy as np
+
+CLOCK_WINDOW = 512  # 'U' arrival times kept for the period fit
+MIN_FIT_SAMPLES = 32
+RTT_WINDOW = 64  # recent round trips kept for the delay estimate
+PHASE_SHIFT_RANGE = (-32768, 32767)  # 'S' phase shift field, ms
+
+
+class LinkClock:
+
+    def __init__(self, nominal_period=None, window=CLOCK_WINDOW):
+        self.nominal_period = nominal_period  # seconds between 'U' packages on the link's clock
+        self.lock = threading.Lock()
+        self.arrivals = np.zeros(window)
+        self.ticks = np.zeros(window)
+        self.count = 0  # on schedule 'U' packages since the sync
+        self.tick = 0  # tick number of the last one (missed ticks are skipped over)
+        self.sync_sent_time = None
+        self.offset_at_sync = 0.0
+        self.rtts = deque(maxlen=RTT_WINDOW)
+        self.fit_count = None
+        self.fit = None  # (period, residual jitter)
+
+    # The epoch was sent to the link (Hello) at server time now
+    def synced(self, now):
+        with self.lock:
+            self.sync_sent_time = now
+            self.count = 0
+            self.tick = 0
+            self.fit_count = self.fit = None
+
+    def update_received(self, now):
+        with self.lock:
+            if self.count and self.nominal_period:
+                last = self.arrivals[(self.count - 1) % len(self.arrivals)]
+                ticks = round((now - last) / self.nominal_period)
+                if ticks < 1:
+                    return  # off schedule
+                self.tick += ticks
+            else:
+                self.tick += 1
+            self.arrivals[self.count % len(self.arrivals)] = now
+            self.ticks[self.count % len(self.arrivals)] = self.tick
+            self.count += 1
+
+    def rtt_sample(self, rtt):
+        with self.lock:
+            self.rtts.append(rtt)
+
+    def calibrate(self, offset_at_sync):
+        self.offset_at_sync = offset_at_sync
+
+    @property
+    def min_rtt(self):
+        with self.lock:
+            return min(self.rtts) if self.rtts else None
+
+    @property
+    def one_way_delay(self):
+        rtt = self.min_rtt
+        return None if rtt is None else rtt / 2
+
+    @property
+    def sync_time(self):
+        if self.sync_sent_time is None:
+            return None
+        return self.sync_sent_time + (self.one_way_delay or 0.0)
+
+    # Tick numbers and arrival times, oldest first
+    def samples(self):
+        with self.lock:
+            n = min(self.count, len(self.arrivals))
+            shift = -(self.count % len(self.arrivals))
+            return np.roll(self.ticks, shift)[len(self.ticks) - n:], np.roll(self.arrivals, shift)[len(self.arrivals) - n:]
+
+    # (period in server seconds, rms jitter of the arrivals around the fit), None without enough data
+    def period_fit(self):
+        if self.count < MIN_FIT_SAMPLES:
+            return None
+        if self.fit_count != self.count:
+            index, times = self.samples()
+            slope, intercept = np.polyfit(index, times, 1)
+            jitter = float(np.sqrt(np.mean((times - (slope * index + intercept)) ** 2)))
+            self.fit, self.fit_count = (float(slope), jitter), self.count
+        return self.fit
+
+    @property
+    def period(self):
+        fit = self.period_fit()
+        return None if fit is None else fit[0]
+
+    @property
+    def drift(self):
+        period = self.period
+        if period is None or not self.nominal_period:
+            return None
+        return self.nominal_period / period - 1
+
+    # Link time minus server time at server time now
+    def offset(self, now):
+        drift = self.drift
+        sync_time = self.sync_time
+        if drift is None or sync_time is None:
+            return self.offset_at_sync
+        return self.offset_at_sync + drift * (now - sync_time)
+
+    def to_link_time(self, server_time):
+        return server_time + self.offset(server_time)
+
+    def stats(self, now=None):
+        fit = self.period_fit()
+        return {
+            'updates': self.count,
+            'period': None if fit is None else fit[0],
+            'arrival_jitter': None if fit is None else fit[1],
+            'drift_ppm': None if self.drift is None else self.drift * 1e6,
+            'min_rtt': self.min_rtt,
+            'one_way_delay': self.one_way_delay,
+            'offset': None if now is None else self.offset(now),
+        }
+
+
+# 'S' fields for a sinusoid starting at link_start (link time, seconds, fractional): start_time is
+# the whole second, the rest goes into both phase shifts. params are the 8 fields after start_time.
+def schedule_sinusoid(link_start, params):
+    start_time = math.floor(link_start)
+    fraction_ms = (link_start - start_time) * 1000
+    a0, x0, ps0, p0, a1, x1, ps1, p1 = params
+    return (start_time, a0, x0, shift_phase(ps0, fraction_ms, p0), p0,
+            a1, x1, shift_phase(ps1, fraction_ms, p1), p1)
+
+
+# Phase shift later by shift_ms, wrapped by whole periods if it leaves the int16 field. Without a
+# positive period it can't be wrapped, ValueError then.
+def shift_phase(phase_shift, shift_ms, period):
+    shifted = int(round(phase_shift + shift_ms))
+    if shifted > PHASE_SHIFT_RANGE[1]:
+        if period <= 0:
+            raise ValueError(f"Phase shift {shifted} ms out of range and period {period} ms can't wrap it")
+        shifted -= math.ceil((shifted - PHASE_SHIFT_RANGE[1]) / period) * period
+    return shifted
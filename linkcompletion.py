@@ -0,0 +1,148 @@
+# Completion of position commands, from the links' telemetry: instead of waiting a fixed time
+# after every command (12 s in the gaits, however long the servos actually need), a controller
+# gets a future that resolves as soon as a 'U' package shows the link executing the command
+# (its checksum) with both servos within tolerance of the target.
+#
+#   future = link.send_position_only(100, 22, completion=True)   # concurrent.futures.Future
+#   result = future.result()     # CommandResult, truthy if the servos got there
+#   result.elapsed, result.reason
+#
+# The future always resolves: REACHED, or TIMEOUT (timeout seconds after sending, checked on every
+# 'U' package of the link), SUPERSEDED (another command was sent first) or CLOSED (the link's
+# connection closed, or the send failed). Gaits that only care about moving on can wait for a set
+# of futures with wait_for_commands(), which returns early if their stop event is set.
+
+import threading
+import time
+from concurrent.futures import Future
+
+COMPLETION_TOLERANCE = 3  # position units both servos must be within
+COMPLETION_TIMEOUT = 12.0  # seconds, the fixed wait the gaits used before
+CANCEL_POLL = 0.05  # seconds between checks of a stop event while waiting for commands
+
+REACHED = 'reached'
+TIMEOUT = 'timeout'
+SUPERSEDED = 'superseded'
+CLOSED = 'closed'
+
+
+class CommandResult:
+
+    __slots__ = ('reason', 'elapsed', 'srv0_pos', 'srv1_pos')
+
+    def __init__(self, reason, elapsed, srv0_pos=None, srv1_pos=None):
+        self.reason = reason
+        self.elapsed = elapsed  # seconds from sending to resolving
+        self.srv0_pos = srv0_pos  # positions reported when it resolved
+        self.srv1_pos = srv1_pos
+
+    def __bool__(self):
+        return self.reason == REACHED
+
+    def __repr__(self):
+        return f"CommandResult({self.reason}, {self.elapsed:.3f} s, pos {self.srv0_pos}, {self.srv1_pos})"
+
+
+class PendingCommand:
+
+    __slots__ = ('future', 'checksum', 'target', 'tolerance', 'sent_time', 'deadline')
+
+    def __init__(self, checksum, target, tolerance, sent_time, timeout):
+        self.future = Future()
+        self.checksum = checksum
+        self.target = target
+        self.tolerance = tolerance
+        self.sent_time = sent_time
+        self.deadline = sent_time + timeout
+
+
+class CompletionTracker:
+
+    # Pending position commands of one link. add() is called by the sending thread, update() by
+    # whoever handles the link's 'U' packages. Times are server time raw.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def add(self, checksum, target, now, tolerance=COMPLETION_TOLERANCE, timeout=COMPLETION_TIMEOUT):
+        command = PendingCommand(checksum, target, tolerance, now, timeout)
+        with self.lock:
+            superseded = [c for c in self.pending if c.checksum != checksum]
+            self.pending = [c for c in self.pending if c.checksum == checksum]
+            self.pending.append(command)
+        for c in superseded:
+            resolve(c, SUPERSEDED, now)
+        return command.future
+
+    # A command that isn't tracked was sent: the pending ones won't be executed any more
+    def supersede(self, checksum, now):
+        if not self.pending:
+            return
+        with self.lock:
+            superseded = [c for c in self.pending if c.checksum != checksum]
+            self.pending = [c for c in self.pending if c.checksum == checksum]
+        for c in superseded:
+            resolve(c, SUPERSEDED, now)
+
+    def update(self, executing_checksum, srv0_pos, srv1_pos, now):
+        if not self.pending:
+            return
+        done = []
+        with self.lock:
+            for c in self.pending:
+                if (c.checksum == executing_checksum and srv0_pos is not None and srv1_pos is not None
+                        and abs(srv0_pos - c.target[0]) <= c.tolerance and abs(srv1_pos - c.target[1]) <= c.tolerance):
+                    done.append((c, REACHED))
+                elif now >= c.deadline:
+                    done.append((c, TIMEOUT))
+            if done:
+                finished = {id(c) for c, _ in done}
+                self.pending = [c for c in self.pending if id(c) not in finished]
+        for c, reason in done:
+            resolve(c, reason, now, srv0_pos, srv1_pos)
+
+    def close(self, now):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for c in pending:
+            resolve(c, CLOSED, now)
+
+
+def resolve(command, reason, now, srv0_pos=None, srv1_pos=None):
+    if not command.future.done():
+        command.future.set_result(CommandResult(reason, now - command.sent_time, srv0_pos, srv1_pos))
+
+
+# A future that is already resolved, for a command that could not be sent
+def closed_future():
+    future = Future()
+    future.set_result(CommandResult(CLOSED, 0.0))
+    return future
+
+
+# Waits until every future resolved, timeout passed or stop_event is set. Returns whether all of
+# them resolved truthy (their servos got there).
+def wait_for_commands(futures, timeout=None, stop_event=None):
+    futures = list(futures)
+    condition = threading.Condition()
+
+    def done(_):
+        with condition:
+            condition.notify_all()
+
+    for future in futures:
+        future.add_done_callback(done)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with condition:
+        while not all(future.done() for future in futures):
+            if stop_event is not None and stop_event.is_set():
+                return False
+            wait = CANCEL_POLL if stop_event is not None else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = remaining if wait is None else min(wait, remaining)
+            condition.wait(wait)
+    return all(future.result() for future in futures)
@@ -0,0 +1,486 @@
+# Fleet of emulated Truss Links for load testing a LinkServer without hardware. One process runs
+# N virtual links on one asyncio loop. Each link connects, says Hello (device_id, MAX_VEL), takes
+# the epoch from the 'T' package and streams 'U' packages at `rate` Hz. Commands move two emulated
+# servos:
+#   P  move towards the positions, at srv_vel percent of SERVO_SPEED
+#   S  follow offset + amplitude * sin(2 pi (t - start_time - phase shift) / period) (link time)
+#   L  run the list from its start time: every entry (P or S) for duration * LIST_TIME_UNIT
+#      (rmlprotocol, the unit GaitCompiler converts the phases to),
+#      nr_repeat times (negative repeats forever), then hold the last entry
+#   W  run the last list again nr_steps times from now
+#   C  answer with a 'C' calibration confirmation
+# The servos are rate limited to SERVO_SPEED, so positions in the 'U' packages lag the commands
+# like the real ones do. executing_command_checksum is the checksum of the last command frame;
+# a 'U' package is also sent right after every command (report_on_command).
+#
+# Faults, per FaultProfile:
+#   corrupt          probability that a frame the link sends has one flipped byte
+#   slow_fraction    fraction of links that are slow: every frame they send or receive is
+#                    delayed by latency seconds
+#   disconnect_rate  disconnects per link per second; the link closes the connection (or just
+#                    goes silent with silent=True) and reconnects after reconnect_delay seconds
+#   clock_drift      every link's clock runs fast or slow by up to this many ppm (its 'U' period
+#                    and its link time, from when the emulator started)
+#   loss             probability that a frame is lost on the network: a datagram is gone, on TCP
+#                    it is retransmitted after rto seconds and every later frame waits for it
+#                    (head of line blocking)
+#
+# With udp_port the 'U' packages go to the server as datagrams (linkudp) with a sequence number
+# per connection, everything else stays on TCP. record_updates keeps the send time of every 'U'
+# package in link.update_times (index = sequence number), to measure telemetry age.
+#
+# With delta_telemetry the links say the extended Hello offering CAP_DELTA_TELEMETRY and, if the
+# server's 'N' package accepts it, send 'D' packages with the fields that changed instead of full
+# 'U' packages (a 'U' keyframe every keyframe_interval packages and after every 'N'). Deltas need
+# every frame in order, so links that send their telemetry as datagrams keep sending 'U'.
+# stats['bytes'] is what the links put on the network, to compare the airtime.
+#
+#   python linkemulator.py --links 200 --rate 20 --port 50000 --corrupt 0.001 --disconnect-rate 0.01
+#   python linkemulator.py --links 20 --port 50000 --udp-port 50000 --loss 0.02
+#   python linkemulator.py --links 100 --port 50000 --delta
+#
+#   emulator = FleetEmulator(host, port, nr_links=100)
+#   emulator.start_process()  # or run() / start_thread()
+
+import argparse
+import asyncio
+import math
+import multiprocessing
+import random
+import threading
+import time
+
+from rmlprotocol import (
+    STRUCTS, HEADER_LENGTH, FOOTER_LENGTH, FOOTER_STRUCT, LIST_HEADER_STRUCT, get_crc_15,
+    HELLO_EXTENDED_STRUCT, PROTOCOL_VERSION, CAP_DELTA_TELEMETRY, encode_delta, LIST_TIME_UNIT,
+)
+from linkudp import make_datagram
+
+SERVO_SPEED = 60.0  # position units per second at 100% velocity
+BATTERY = 90  # raw bat_status reported (the server shifts it by -25)
+CALIBRATION = (0, 500, 2500, 500, 2500, 0, 255, 0, 255)  # 'C' confirmation fields
+
+
+def make_frame(package_type, *data):
+    return make_raw_frame(package_type, STRUCTS[package_type].pack(*data))
+
+
+def make_raw_frame(package_type, body):
+    header_and_body = bytes([len(body)]) + package_type + body
+    return header_and_body + FOOTER_STRUCT.pack(get_crc_15(header_and_body))
+
+
+# Frames sent to a link, split by their length byte (lists have a variable length, so the
+# StreamFramer, which knows the body length of every type, can't be used here). Returns
+# (frames, bytes consumed); a frame with a wrong CRC is skipped byte by byte like the firmware.
+def split_frames(buffer):
+    frames = []
+    start = 0
+    while len(buffer) - start >= HEADER_LENGTH + FOOTER_LENGTH:
+        n = HEADER_LENGTH + buffer[start]
+        if len(buffer) - start < n + FOOTER_LENGTH:
+            break
+        frame = bytes(buffer[start:start + n + FOOTER_LENGTH])
+        if FOOTER_STRUCT.unpack_from(frame, n)[0] != get_crc_15(frame[:n]):
+            start += 1
+            frames.append(None)  # counted as a CRC error
+            continue
+        frames.append(frame)
+        start += n + FOOTER_LENGTH
+    return frames, start
+
+
+class FaultProfile:
+
+    def __init__(self, corrupt=0.0, slow_fraction=0.0, latency=0.2, disconnect_rate=0.0,
+                 reconnect_delay=(0.5, 2.0), silent=False, clock_drift=0.0, loss=0.0, rto=0.2, seed=None):
+        self.corrupt = corrupt
+        self.slow_fraction = slow_fraction
+        self.latency = latency
+        self.disconnect_rate = disconnect_rate
+        self.reconnect_delay = reconnect_delay
+        self.silent = silent
+        self.clock_drift = clock_drift
+        self.loss = loss
+        self.rto = rto  # seconds until a lost TCP segment is retransmitted
+        self.seed = seed
+
+
+NO_FAULTS = FaultProfile()
+
+
+class EmulatedServo:
+
+    def __init__(self, position=22.0):
+        self.position = position
+        self.velocity = 100
+
+    # Moves towards target for dt seconds
+    def step(self, target, velocity, dt):
+        self.velocity = velocity
+        max_step = SERVO_SPEED * max(velocity, 1) / 100 * dt
+        delta = target - self.position
+        self.position += max(-max_step, min(max_step, delta))
+
+    @property
+    def pos(self):
+        return min(255, max(0, int(round(self.position))))
+
+
+# Target (srv0, srv1, vel0, vel1) of one P or S command at link time t
+def command_target(package_type, body, t):
+    if package_type == ord('P'):
+        return STRUCTS[b'P'].unpack_from(body)
+    start_time, a0, x0, ps0, p0, a1, x1, ps1, p1 = STRUCTS[b'S'].unpack_from(body)
+    servos = []
+    for a, x, ps, p in ((a0, x0, ps0, p0), (a1, x1, ps1, p1)):
+        phase = (t - start_time - ps / 1000) / (max(p, 1) / 1000)
+        servos.append(x + a * math.sin(2 * math.pi * phase))
+    return servos[0], servos[1], 100, 100
+
+
+def parse_list(body):
+    nr_repeat, start_time = LIST_HEADER_STRUCT.unpack_from(body)
+    entries = []
+    i = LIST_HEADER_STRUCT.size
+    while i + 2 <= len(body):
+        duration, package_type = body[i], body[i + 1]
+        if package_type == ord('E'):
+            break
+        size = STRUCTS[bytes([package_type])].size
+        entries.append((duration * LIST_TIME_UNIT, package_type, body[i + 2:i + 2 + size]))
+        i += 2 + size
+    return nr_repeat, start_time, entries
+
+
+class EmulatedLink:
+
+    def __init__(self, emulator, device_id, rng, slow):
+        self.emulator = emulator
+        self.device_id = device_id
+        self.rng = rng
+        self.slow = slow
+        self.clock_rate = 1 + rng.uniform(-1, 1) * emulator.faults.clock_drift * 1e-6
+        self.servos = (EmulatedServo(), EmulatedServo())
+        self.epoch = None
+        self.checksum = 0
+        self.command = (ord('P'), STRUCTS[b'P'].pack(22, 22, 100, 100))
+        self.list = None  # (nr_repeat, start_time, entries)
+        self.writer = None
+        self.connected = False
+        self.buffer = bytearray()
+        self.udp = None  # datagram transport to the server, with udp_port
+        self.sequence = 0  # 'U' packages sent on this connection
+        self.update_times = []  # perf_counter of every 'U' package, with record_updates
+        self.stalled = None  # frames waiting behind a lost one on TCP
+        self.capabilities = 0  # accepted by the server's 'N' package
+        self.keyframe_interval = None
+        self.last_update = None  # fields of the last 'U' or 'D' package, None: next one is a keyframe
+        self.since_keyframe = 0
+
+    def link_time(self):
+        start = self.emulator.start_time
+        return start + (time.time() - start) * self.clock_rate - (self.epoch or 0)
+
+    def target(self, t):
+        package_type, body = self.command
+        if package_type == ord('L') and self.list is not None:
+            nr_repeat, start_time, entries = self.list
+            if not entries:
+                return None
+            if t < start_time:
+                return None  # hold until the list starts
+            total = sum(entry[0] for entry in entries) or LIST_TIME_UNIT
+            elapsed = t - start_time
+            if 0 <= nr_repeat <= elapsed // total:
+                duration, package_type, body = entries[-1]
+            else:
+                elapsed %= total
+                for duration, package_type, body in entries:
+                    if elapsed < duration:
+                        break
+                    elapsed -= duration
+        return command_target(package_type, body, t)
+
+    def step(self, dt):
+        target = self.target(self.link_time())
+        if target is not None:
+            for servo, position, velocity in zip(self.servos, target[:2], target[2:]):
+                servo.step(position, velocity, dt)
+
+    def update_frame(self):
+        s0, s1 = self.servos
+        fields = (b'R', s0.pos, s1.pos, s0.pos, s1.pos, BATTERY, s0.velocity, s1.velocity, self.checksum)
+        if self.capabilities & CAP_DELTA_TELEMETRY and self.udp is None:
+            previous, self.last_update = self.last_update, fields
+            if previous is not None and self.since_keyframe < self.keyframe_interval:
+                self.since_keyframe += 1
+                return make_raw_frame(b'D', encode_delta(previous, fields))
+            self.since_keyframe = 0
+        return make_frame(b'U', *fields)
+
+    def hello_frame(self):
+        if self.emulator.delta_telemetry:
+            return make_raw_frame(b'H', HELLO_EXTENDED_STRUCT.pack(self.device_id, self.emulator.max_vel,
+                                                                   PROTOCOL_VERSION, CAP_DELTA_TELEMETRY))
+        return make_frame(b'H', self.device_id, self.emulator.max_vel)
+
+    def send(self, frame):
+        if not self.connected:
+            return
+        emulator = self.emulator
+        faults = emulator.faults
+        if faults.corrupt and self.rng.random() < faults.corrupt:
+            frame = bytearray(frame)
+            frame[self.rng.randrange(HEADER_LENGTH, len(frame))] ^= 0x55
+            frame = bytes(frame)
+            emulator.stats['corrupted'] += 1
+        write, channel = self.write, self.writer
+        if frame[1] == ord('U'):
+            if emulator.record_updates:
+                self.update_times.append(time.perf_counter())
+            if self.udp is not None:
+                write, channel = self.write_datagram, self.udp
+                frame = make_datagram(self.device_id, self.sequence, frame)
+            self.sequence += 1
+        if self.slow:
+            emulator.loop.call_later(faults.latency, write, channel, frame)
+        else:
+            write(channel, frame)
+
+    def write(self, writer, frame):
+        if writer is not self.writer or not self.connected or writer.is_closing():
+            return
+        if self.stalled is not None:
+            self.stalled.append(frame)  # behind the lost segment
+            return
+        faults = self.emulator.faults
+        if faults.loss and self.rng.random() < faults.loss:
+            self.emulator.stats['lost'] += 1
+            self.stalled = [frame]
+            self.emulator.loop.call_later(faults.rto, self.retransmit, writer)
+            return
+        writer.write(frame)
+        self.emulator.stats['sent'] += 1
+        self.emulator.stats['bytes'] += len(frame)
+
+    # The lost segment arrives after all, with everything that queued up behind it
+    def retransmit(self, writer):
+        stalled, self.stalled = self.stalled, None
+        if writer is self.writer and self.connected and not writer.is_closing():
+            writer.write(b''.join(stalled))
+            self.emulator.stats['sent'] += len(stalled)
+            self.emulator.stats['bytes'] += sum(len(frame) for frame in stalled)
+
+    def write_datagram(self, udp, datagram):
+        if udp is not self.udp or udp.is_closing():
+            return
+        faults = self.emulator.faults
+        if faults.loss and self.rng.random() < faults.loss:
+            self.emulator.stats['lost'] += 1
+            return
+        udp.sendto(datagram)
+        self.emulator.stats['sent'] += 1
+        self.emulator.stats['bytes'] += len(datagram)
+
+    def received(self, data):
+        self.buffer += data
+        frames, consumed = split_frames(self.buffer)
+        del self.buffer[:consumed]
+        for frame in frames:
+            if frame is None:
+                self.emulator.stats['crc_errors'] += 1
+            elif self.slow:
+                self.emulator.loop.call_later(self.emulator.faults.latency, self.execute, frame)
+            else:
+                self.execute(frame)
+
+    def execute(self, frame):
+        package_type, body = frame[1], frame[HEADER_LENGTH:-FOOTER_LENGTH]
+        self.emulator.stats['commands'] += 1
+        if package_type == ord('N'):
+            # negotiation, not a command: the checksum stays that of the executing command
+            _, self.capabilities, self.keyframe_interval = STRUCTS[b'N'].unpack_from(body)
+            self.last_update = None
+            return
+        if package_type == ord('T'):
+            self.epoch = STRUCTS[b'T'].unpack_from(body)[0]
+        elif package_type in (ord('P'), ord('S')):
+            self.command = (package_type, body)
+        elif package_type == ord('L'):
+            self.list = parse_list(body)
+            self.command = (package_type, body)
+        elif package_type == ord('W') and self.list is not None:
+            nr_steps = body[0]
+            self.list = (nr_steps, int(self.link_time()), self.list[2])
+            self.command = (ord('L'), b'')
+        elif package_type == ord('C'):
+            self.send(make_frame(b'C', *CALIBRATION))
+        self.checksum = FOOTER_STRUCT.unpack_from(frame, len(frame) - FOOTER_LENGTH)[0]
+        if self.emulator.report_on_command:
+            self.send(self.update_frame())
+
+    # Connects, streams until a disconnect fault or the emulator stops, reconnects
+    async def run(self):
+        emulator = self.emulator
+        faults = emulator.faults
+        while emulator.running:
+            try:
+                reader, self.writer = await asyncio.open_connection(emulator.host, emulator.port)
+            except OSError:
+                await asyncio.sleep(1)
+                continue
+            if emulator.udp_port is not None:
+                self.udp, _ = await emulator.loop.create_datagram_endpoint(
+                    asyncio.DatagramProtocol, remote_addr=(emulator.host, emulator.udp_port))
+            self.connected = True
+            self.buffer.clear()
+            self.stalled = None
+            self.sequence = 0
+            self.update_times = []
+            self.capabilities = 0
+            self.last_update = None
+            emulator.stats['connects'] += 1
+            self.send(self.hello_frame())
+            reading = asyncio.ensure_future(self.read(reader))
+            period = 1 / emulator.rate / self.clock_rate
+            last = time.perf_counter()
+            # exponential time to the next disconnect
+            up_for = self.rng.expovariate(faults.disconnect_rate) if faults.disconnect_rate else math.inf
+            up_until = last + up_for
+            tick = last
+            while emulator.running and not reading.done() and time.perf_counter() < up_until:
+                # on a fixed schedule of the link's clock, like a timer interrupt
+                tick += period
+                await asyncio.sleep(max(0.0, tick - time.perf_counter()))
+                now = time.perf_counter()
+                self.step(now - last)
+                last = now
+                self.send(self.update_frame())
+
+            self.connected = False
+            if time.perf_counter() >= up_until:
+                emulator.stats['disconnects'] += 1
+            elif reading.done() and emulator.running:
+                emulator.stats['dropped'] += 1  # closed by the server
+            reading.cancel()
+            if self.udp is not None:
+                self.udp.close()
+                self.udp = None
+            if faults.silent and emulator.running:
+                # gone without a FIN, the server has to notice the silence
+                silent_writer = self.writer
+                emulator.loop.call_later(60, silent_writer.close)
+            else:
+                self.writer.close()
+            if emulator.running:
+                await asyncio.sleep(self.rng.uniform(*faults.reconnect_delay))
+
+    async def read(self, reader):
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                return
+            self.received(data)
+
+
+class FleetEmulator:
+
+    def __init__(self, host, port, nr_links=10, rate=20, faults=NO_FAULTS, first_device_id=0, max_vel=100,
+                 report_on_command=True, udp_port=None, record_updates=False, delta_telemetry=False):
+        if first_device_id + nr_links > 256:
+            raise ValueError("device_id is one byte, at most 256 links")
+        self.host = host
+        self.port = port
+        self.nr_links = nr_links
+        self.rate = rate
+        self.faults = faults
+        self.first_device_id = first_device_id
+        self.max_vel = max_vel
+        self.report_on_command = report_on_command
+        self.udp_port = udp_port  # send the 'U' packages as datagrams to this port
+        self.record_updates = record_updates
+        self.delta_telemetry = delta_telemetry  # offer delta telemetry in the Hello
+        self.running = False
+        self.loop = None
+        self.start_time = time.time()
+        self.links = []
+        self.stats = dict.fromkeys(('connects', 'disconnects', 'dropped', 'sent', 'bytes', 'lost', 'commands',
+                                    'corrupted', 'crc_errors'), 0)
+        self.process = None
+        self.thread = None
+
+    async def main(self, duration=None):
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        rng = random.Random(self.faults.seed)
+        self.links = []
+        for i in range(self.nr_links):
+            link_rng = random.Random(rng.random())
+            slow = link_rng.random() < self.faults.slow_fraction
+            self.links.append(EmulatedLink(self, self.first_device_id + i, link_rng, slow))
+        tasks = [asyncio.ensure_future(link.run()) for link in self.links]
+        if duration is not None:
+            self.loop.call_later(duration, self.stop)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        self.running = False
+
+    # Blocks until duration is over (or forever), returns the stats
+    def run(self, duration=None):
+        asyncio.run(self.main(duration))
+        return self.stats
+
+    def start_thread(self, duration=None):
+        self.thread = threading.Thread(target=self.run, args=(duration,), daemon=True)
+        self.thread.start()
+        return self.thread
+
+    # In a child process, so the emulator doesn't compete with the server for the GIL
+    def start_process(self, duration=None):
+        self.process = multiprocessing.Process(target=self.run, args=(duration,), daemon=True)
+        self.process.start()
+        return self.process
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+        if self.loop is not None and self.running:
+            self.loop.call_soon_threadsafe(self.stop)
+        if self.thread is not None:
+            self.thread.join()
+
+
+if __name__ == '__main__':
+    from linknetworking import DEFAULT_HOST, DEFAULT_PORT
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--links', type=int, default=10)
+    parser.add_argument('--first-id', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=20, help="'U' packages per second per link")
+    parser.add_argument('--duration', type=float, default=None)
+    parser.add_argument('--corrupt', type=float, default=0.0)
+    parser.add_argument('--slow', type=float, default=0.0, help="fraction of slow links")
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds of delay of the slow links")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help="per link per second")
+    parser.add_argument('--silent', action='store_true', help="disconnect without closing the connection")
+    parser.add_argument('--clock-drift', type=float, default=0.0, help="max clock error of a link, ppm")
+    parser.add_argument('--loss', type=float, default=0.0, help="probability that a frame is lost")
+    parser.add_argument('--rto', type=float, default=0.2, help="seconds until a lost TCP segment is resent")
+    parser.add_argument('--udp-port', type=int, default=None, help="send the 'U' packages as datagrams")
+    parser.add_argument('--delta', action='store_true', help="offer delta telemetry in the Hello")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    faults = FaultProfile(args.corrupt, args.slow, args.latency, args.disconnect_rate, silent=args.silent,
+                          clock_drift=args.clock_drift, loss=args.loss, rto=args.rto, seed=args.seed)
+    emulator = FleetEmulator(args.host, args.port, args.links, args.rate, faults, args.first_id,
+                             udp_port=args.udp_port, delta_telemetry=args.delta)
+    try:
+        print(emulator.run(args.duration))
+    except KeyboardInterrupt:
+        print(emulator.stats)
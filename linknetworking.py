@@ -2,27 +2,56 @@
 # Edits: Simon Kang, simon.kang@columbia.edu
 # Last updated: Dec 7, 2023
 
-from rmlprotocol import RMLPacker
+from rmlprotocol import RMLPacker, StreamFramer, MAX_BODY_LENGTH, HEADER_LENGTH, FOOTER_LENGTH
+from rmlprotocol import PROTOCOL_VERSION, CAP_DELTA_TELEMETRY, apply_delta
+from rmlprotocol import MAX_LIST_DURATION, list_duration
 import socket
 import threading
 import sys
 import time
+import math
 import logging
+import json
+import itertools
+from collections import namedtuple, deque
+from linkstats import Histogram, CommandLatency
+from linktelemetry import TelemetryRing, TELEMETRY_CAPACITY
+from linkstate import LinkStateTable, StateField, STATE_FIELDS
+from linkretransmit import Retransmitter, DEFAULT_POLICY
+from linkcapture import WireCapture, INBOUND, OUTBOUND, CLOSED
+from linkclock import LinkClock, schedule_sinusoid
+from linkbus import TelemetryBus, default_bus_name
+from linknotify import UpdateNotifier
+from linkudp import TelemetryIngest, DatagramReader, open_udp_socket, is_newer
+from linkcompletion import CompletionTracker, closed_future, COMPLETION_TOLERANCE, COMPLETION_TIMEOUT
 
 DEBUG = True
 
-thread_Rlock = threading.RLock()
 thread_lock = threading.Lock()
 
 CLIENT_SOCKET_TIMEOUT = 15 # This is enough because communication is high frequency
 
+# A link is dead when it has been silent for DEAD_LINK_FACTOR times its usual 'U' interval,
+# but never less than DEAD_LINK_MIN_TIMEOUT or more than CLIENT_SOCKET_TIMEOUT seconds
+DEAD_LINK_FACTOR = 20
+DEAD_LINK_MIN_TIMEOUT = 1.0
+DEAD_LINK_ALPHA = 0.05  # weight of a new interval in the running average
+
+SESSION_TTL = 600  # seconds a closed link's session is kept for a reconnect
+GROUP_WRITE_TIMEOUT = 1.0  # seconds send_group waits for the writers to send the group's frames
+
+# What the server offers links that say the extended Hello (see rmlprotocol)
+SERVER_CAPABILITIES = CAP_DELTA_TELEMETRY
+KEYFRAME_INTERVAL = 20  # 'U' or 'D' packages between full 'U' keyframes of a delta link
+KEYFRAME_REQUEST_INTERVAL = 1.0  # seconds between 'N' packages asking a link for a keyframe
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
 def safe_error_print(content):
     with thread_lock:
-        eprint(*content)
+        eprint(content)
 
 
 def safe_print(content, my_end="\n"):
@@ -32,15 +61,36 @@ def safe_print(content, my_end="\n"):
         print(content, end=my_end)
 
 
+GroupSend = namedtuple('GroupSend', ['sent', 'dispatch_times', 'skew', 'completions'], defaults=(None,))
+
+# What a reconnecting link gets back: the command in force, its telemetry history and counters
+LinkSession = namedtuple('LinkSession', ['frame', 'checksum', 'telemetry', 'retransmitter', 'closed_time'])
+
+
 class LinkServer(threading.Thread):
 
     # A single object of this class will listen for Link Connection requests and then make new threads for each link
 
-    def __init__(self, host, port, log=False):
+    def __init__(self, host, port, log=False, start_epoch_raw=None, reuse_port=False,
+                 telemetry_capacity=TELEMETRY_CAPACITY, retransmit_policy=DEFAULT_POLICY, capture=None,
+                 update_period=None, bus=None, udp_port=None, capabilities=SERVER_CAPABILITIES,
+                 keyframe_interval=KEYFRAME_INTERVAL):
         super().__init__()
 
-        self.start_epoch_raw = time.time()
-        self.start_epoch = int(time.time() + 0.5)
+        # rows of telemetry history per link (linktelemetry.TelemetryRing), 0 keeps no history
+        self.telemetry_capacity = telemetry_capacity
+        # when to resend a command a link hasn't picked up (linkretransmit.RetransmitPolicy)
+        self.retransmit_policy = retransmit_policy
+        # seconds between 'U' packages of the links (their clock), lets linkclock estimate drift
+        self.update_period = update_period
+        # protocol capabilities accepted from links that offer them, and the keyframe interval
+        # of delta telemetry; links with the short Hello keep the original packages
+        self.capabilities = capabilities
+        self.keyframe_interval = keyframe_interval
+
+        # start_epoch_raw can be given so several servers (e.g. shards) share one time base
+        self.start_epoch_raw = time.time() if start_epoch_raw is None else start_epoch_raw
+        self.start_epoch = int(self.start_epoch_raw + 0.5)
         self.log = log
         if self.log:
             logging.basicConfig(format='%(asctime)s - %(message)s', 
@@ -51,15 +101,36 @@ class LinkServer(threading.Thread):
             logging.getLogger().setLevel(logging.INFO)
             logging.info(self.start_epoch)
 
+        # binary capture of every frame (linkcapture), a path or a WireCapture
+        if isinstance(capture, str):
+            capture = WireCapture(capture, self.start_epoch_raw)
+        self.capture = capture
+        self.connection_ids = itertools.count()
+
         self.__is__running__ = True
         self.host = host
         self.port = port
         self.links = {}  # This will store all Link objects in a dictionary for device_name reference
         self.newest = None
+        # One row per link, the state attributes of the links are views onto it (see linkstate)
+        self.state = LinkStateTable()
+
+        # send_group skew (last minus first dispatch), all groups and per group size
+        self.group_skew = Histogram()
+        self.group_skew_by_size = {}
+        # command -> execution latency of every link (each link also keeps its own)
+        self.command_latency = CommandLatency()
+        # device_id -> LinkSession of closed links, resumed when they say Hello again
+        self.sessions = {}
+        # fires when a link said Hello or closed (linknotify)
+        self.link_events = UpdateNotifier()
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Allows the socket to bind to a previously used port
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Lets several processes accept on the same port, the kernel spreads the connections
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     
         bound = False
         attempts = 0
@@ -88,6 +159,21 @@ class LinkServer(threading.Thread):
         #     except OSError as e:
         #         time.sleep(1)
 
+        # shared memory copy of the link state and telemetry for other processes (linkbus):
+        # True for the default name of the port, a segment name, or a TelemetryBus
+        if bus is True or isinstance(bus, str):
+            bus = TelemetryBus(default_bus_name(self.port) if bus is True else bus,
+                               start_epoch_raw=self.start_epoch_raw)
+        self.bus = bus
+
+        # 'U' packages as UDP datagrams (linkudp): True for the TCP port's number, a port, or None
+        self.udp_sock = None
+        self.udp_ingest = None
+        if udp_port is not None:
+            self.udp_sock = open_udp_socket(self.host, self.port if udp_port is True else udp_port)
+            self.udp_port = self.udp_sock.getsockname()[1]
+            self.udp_ingest = TelemetryIngest(self)
+
         self.start()
 
 
@@ -97,7 +183,13 @@ class LinkServer(threading.Thread):
     def get_server_time_raw(self):
         return time.time() - self.start_epoch_raw
 
+    # Server time in the links' time base (start_epoch), not rounded
+    def get_server_time_precise(self):
+        return time.time() - self.start_epoch
+
     def run(self):
+        if self.udp_sock is not None:
+            DatagramReader(self.udp_sock, self.udp_ingest).start()
         try:
             self.sock.listen(256)  # maximum number of clients in cue
             while self.__is__running__:
@@ -105,6 +197,10 @@ class LinkServer(threading.Thread):
                     csock, caddr = self.sock.accept()
                 except ConnectionAbortedError as e:
                     safe_error_print("Interrupted sock.accept due to server closing")
+                except OSError as e:
+                    if not self.__is__running__:
+                        break
+                    raise
 
                 safe_print("Accepted new Link")
                 self.newest = RobotLink((csock, caddr), self)  # instantiate new client thread
@@ -113,40 +209,317 @@ class LinkServer(threading.Thread):
         finally:
             self.close_server()
 
+    def save_session(self, link):
+        self.sessions[link.device_id] = LinkSession(link.last_sent_frame, link.current_command_checksum,
+                                                    link.telemetry, link.retransmitter, time.monotonic())
+
+    def take_session(self, device_id):
+        session = self.sessions.pop(device_id, None)
+        if session is None or time.monotonic() - session.closed_time > SESSION_TTL:
+            return None
+        return session
+
     # This function returns the size (number of links) in the dictionary
 
     def size(self):
         return len(self.links)
 
+    # Blocks until at least n links are connected, instead of polling size(). Returns whether they
+    # are (False on timeout). The _async variants do the same in a coroutine on any event loop.
+    def wait_for_links(self, n, timeout=None):
+        return self.link_events.wait_for(lambda: len(self.links) >= n, timeout)
+
+    async def wait_for_links_async(self, n, timeout=None):
+        return await self.link_events.wait_for_async(lambda: len(self.links) >= n, timeout)
+
+    # Blocks until the link device_id is connected and returns it (None on timeout)
+    def wait_for_link(self, device_id, timeout=None):
+        return self.link_events.wait_for(lambda: self.links.get(device_id), timeout) or None
+
+    async def wait_for_link_async(self, device_id, timeout=None):
+        return await self.link_events.wait_for_async(lambda: self.links.get(device_id), timeout) or None
+
+    # Sends one command to each of several links at the same time: {device_id: command}, commands
+    # as in GaitCompiler ((srv0_pos, srv1_pos), (srv0_pos, srv1_pos, srv0_vel, srv1_vel) or the 9
+    # sinusoid parameters). Every frame is encoded before the first one is dispatched, and the
+    # dispatch only queues them, so the links' writers send them concurrently. It then waits (at
+    # most GROUP_WRITE_TIMEOUT) until the writers handed the frames to their sockets: dispatch
+    # times and skew are those write times, frames not written by then have no dispatch time.
+    # With start_time (server time, whole seconds) each command is sent as a one entry list
+    # starting then instead, so the links start together regardless of the skew. duration is how
+    # long the list entry runs, in seconds.
+    # With completion, position commands sent right away get a completion future each (see
+    # linkcompletion, tolerance and timeout as in send_position_package).
+    # Returns GroupSend(sent={device_id: bool}, dispatch_times={device_id: server time raw}, skew,
+    # completions={device_id: Future} or None).
+    def send_group(self, commands, start_time=None, duration=MAX_LIST_DURATION, completion=False,
+                   tolerance=COMPLETION_TOLERANCE, timeout=COMPLETION_TIMEOUT):
+        frames = []
+        for device_id, command in commands.items():
+            link = self.links.get(device_id)
+            if link is not None:
+                frames.append((device_id, link, command) + encode_group_command(command, start_time, duration))
+
+        sent = {device_id: False for device_id in commands}
+        stamps = WriteStamps(len(frames))
+        completions = {} if completion else None
+        for device_id, link, command, frame, checksum in frames:
+            on_written = stamps.callback(device_id)
+            if completion and start_time is None and len(command) in (2, 4):
+                completions[device_id] = link.send_tracked(frame, checksum, command[:2], tolerance, timeout,
+                                                           on_written)
+                sent[device_id] = not completions[device_id].done()
+            else:
+                sent[device_id] = link.send_frame(frame, checksum, on_written)
+            if not sent[device_id]:
+                on_written(None)
+
+        written = stamps.wait(GROUP_WRITE_TIMEOUT)
+        dispatch_times = {device_id: t - self.start_epoch_raw for device_id, t in written.items()}
+        skew = max(written.values()) - min(written.values()) if written else 0.0
+        if len(written) > 1:
+            self.group_skew.record(skew)
+            size = len(written)
+            if size not in self.group_skew_by_size:
+                self.group_skew_by_size[size] = Histogram()
+            self.group_skew_by_size[size].record(skew)
+        return GroupSend(sent, dispatch_times, skew, completions)
+
+    def group_skew_summary(self):
+        return {size: histogram.summary() for size, histogram in sorted(self.group_skew_by_size.items())}
+
+    # p50/p95/p99 etc. of the command -> execution latency, fleet wide and per connected link
+    def latency_report(self):
+        return {
+            'fleet': self.command_latency.summary(),
+            'links': {device_id: link.command_latency.summary() for device_id, link in sorted(self.links.items())},
+        }
+
+    # Clock estimates of every connected link (linkclock.LinkClock.stats)
+    def clock_report(self):
+        now = self.get_server_time_precise()
+        return {device_id: link.clock.stats(now) for device_id, link in sorted(self.links.items())}
+
+    # Counters of the UDP telemetry channel, None without one
+    def udp_stats(self):
+        return None if self.udp_ingest is None else self.udp_ingest.stats()
+
+    # Full histograms as JSON, read back with linkstats.CommandLatency.from_dict
+    def export_latency(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'start_epoch': self.start_epoch,
+                'fleet': self.command_latency.to_dict(),
+                'links': {str(device_id): link.command_latency.to_dict() for device_id, link in sorted(self.links.items())},
+            }, f)
+
     # This function interrupts run thread loop
     # It also closes each link object in dictionary
     # It finally closes the listening socket
 
     def close_server(self):
         self.__is__running__ = False
+        try:
+            # wakes up the blocking accept in run()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
+        if self.udp_sock is not None:
+            try:
+                self.udp_sock.shutdown(socket.SHUT_RDWR)  # wakes up the datagram reader
+            except OSError:
+                pass
+            self.udp_sock.close()
         all_device_ids = list(self.links.keys())
 
         for device_id in all_device_ids:
             if device_id in self.links:
                 link = self.links[device_id]
                 link.close_link()
+        if self.capture is not None:
+            self.capture.close()
+        if self.bus is not None:
+            self.bus.close()
         safe_print("Closed all links... Server has been closed.")
 
 
-class RobotLink(threading.Thread):
+class SendQueue:
+
+    # Outbound frames of one link. send_* only append here, the link's writer takes them out, so
+    # a stalled socket holds up its own link and nothing else.
+    # A position command that is still queued is replaced by a newer one (the link only cares about
+    # the latest target), and a retransmission of the frame already at the tail is dropped.
+    # on_written(t) is called once the writer handed the frame to the socket, t is time.time()
+    # then, or None if the frame never gets there (coalesced away, queue closed).
+
+    COALESCE_TYPES = (ord('P'),)
+
+    def __init__(self):
+        self.frames = deque()
+        self.callbacks = deque()  # on_written callbacks of each queued frame, None or a list
+        self.condition = threading.Condition()  # RLock, get() calls take()
+        self.closed = False
+        self.queued_bytes = 0
+        self.writing_bytes = 0  # taken by the writer, not yet fully sent
+        self.writing_callbacks = None  # of the frame taken by the writer
+        self.coalesced = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+
+    # frame must be immutable (bytes), it is sent later
+    def put(self, frame, on_written=None):
+        dropped = None
+        with self.condition:
+            if self.closed:
+                return False
+            if self.frames:
+                tail = self.frames[-1]
+                if tail == frame:
+                    # the same bytes are already waiting to be sent
+                    self.coalesced += 1
+                    if on_written is not None:
+                        self.callbacks[-1] = (self.callbacks[-1] or []) + [on_written]
+                    return True
+                if tail[1] == frame[1] and frame[1] in self.COALESCE_TYPES:
+                    self.frames.pop()
+                    dropped = self.callbacks.pop()
+                    self.queued_bytes -= len(tail)
+                    self.coalesced += 1
+            self.frames.append(frame)
+            self.callbacks.append(None if on_written is None else [on_written])
+            self.queued_bytes += len(frame)
+            self.condition.notify()
+        notify_written(dropped, None)
+        return True
+
+    # Blocks until a frame is queued, returns None once closed
+    def get(self):
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+            return self.take()
+
+    # Non blocking, returns None if nothing is queued
+    def take(self):
+        with self.condition:
+            if not self.frames or self.closed:
+                return None
+            frame = self.frames.popleft()
+            self.writing_callbacks = self.callbacks.popleft()
+            self.queued_bytes -= len(frame)
+            self.writing_bytes += len(frame)
+            return frame
+
+    # The writer is done with the frame it took, written is False if it couldn't send it
+    def done(self, frame, written=True):
+        now = time.time()
+        with self.condition:
+            self.writing_bytes -= len(frame)
+            if written:
+                self.sent_frames += 1
+                self.sent_bytes += len(frame)
+            callbacks, self.writing_callbacks = self.writing_callbacks, None
+        notify_written(callbacks, now if written else None)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.queued_bytes = 0
+            dropped = [self.writing_callbacks] + list(self.callbacks)
+            self.callbacks.clear()
+            self.writing_callbacks = None
+            self.condition.notify_all()
+        for callbacks in dropped:
+            notify_written(callbacks, None)
+
+    def depth(self):
+        return len(self.frames)
+
+    def bytes_in_flight(self):
+        return self.queued_bytes + self.writing_bytes
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'bytes_in_flight': self.bytes_in_flight(),
+            'coalesced': self.coalesced,
+            'sent_frames': self.sent_frames,
+            'sent_bytes': self.sent_bytes,
+        }
+
+
+def notify_written(callbacks, t):
+    if callbacks is not None:
+        for on_written in callbacks:
+            on_written(t)
+
+
+# When each frame of a send_group got to its socket: time.time(), from the links' writers
+class WriteStamps:
+
+    def __init__(self, nr_frames):
+        self.times = {}
+        self.remaining = nr_frames
+        self.condition = threading.Condition()
+
+    def callback(self, device_id):
+        def written(t):
+            with self.condition:
+                if t is not None:
+                    self.times[device_id] = t
+                self.remaining -= 1
+                if self.remaining <= 0:
+                    self.condition.notify_all()
+        return written
+
+    # {device_id: time} of the frames written within timeout
+    def wait(self, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.remaining <= 0, timeout)
+            return dict(self.times)
+
+
+class LinkLiveness:
+
+    # Dead link detection that follows the link's own telemetry rate instead of a fixed timeout
+
+    def __init__(self):
+        self.last = None
+        self.interval = None  # running average of the time between 'U' packages
+
+    def received(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.last is not None:
+            gap = now - self.last
+            self.interval = gap if self.interval is None else self.interval + DEAD_LINK_ALPHA * (gap - self.interval)
+        self.last = now
+
+    def timeout(self):
+        if self.interval is None:
+            return CLIENT_SOCKET_TIMEOUT
+        return min(CLIENT_SOCKET_TIMEOUT, max(DEAD_LINK_MIN_TIMEOUT, DEAD_LINK_FACTOR * self.interval))
+
+    def is_dead(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.last is not None and now - self.last > self.timeout()
+
+
+class LinkBase:
+
+    # Link state, package handling and the send_* API. Shared by the threaded RobotLink below
+    # and the asyncio based link in linknetworking_async, so both behave the same.
+    # Subclasses provide write_frame(frame) and close_connection().
+    # Sends never block on the socket: frames go into the link's SendQueue and its writer sends them.
+
+    def init_link(self, server, log=False):
+        # the row backing the StateField attributes, set up before any of them is assigned
+        self.state_table = getattr(server, 'state', None) or LinkStateTable(1)
+        self.state_row = self.state_table.allocate(self)
 
-    # An object of this class will be instantiated for each link that connects to the server
-    # The thread will close automatically when the connection is broken
-
-    def __init__(self, connection, server, log=False):
-        super().__init__()
         self.__is__running__ = True
-        self.connection = connection[0]
-        self.addr = connection[1]
-        
-        self.connection.settimeout(CLIENT_SOCKET_TIMEOUT)
-
+        self.link_closed = False  # close_link runs once, whoever gets there first
         self.server = server
         self.log = log
         self.device_id = None
@@ -175,84 +548,403 @@ class RobotLink(threading.Thread):
         self.srv1_raw_max = None
 
         self.received_package_queue = []
+        self.framer = StreamFramer()
+        self.capture = getattr(server, 'capture', None)
+        self.bus = getattr(server, 'bus', None)
+        self.connection_id = next(server.connection_ids) if hasattr(server, 'connection_ids') else 0
+
+        # History of the 'U' packages, written in place by handle_package
+        capacity = getattr(server, 'telemetry_capacity', TELEMETRY_CAPACITY)
+        self.telemetry = TelemetryRing(capacity) if capacity else None
 
         self.executing_command_checksum = 0
 
-        self.last_sent_package = None
         self.current_command_checksum = 0
 
-        self.start()
+        # Last sent frame (immutable bytes), this is what gets retransmitted
+        self.last_sent_frame = None
+
+        # Orders last_sent_frame / current_command_checksum with the queue, per link
+        self.send_lock = threading.RLock()
+        self.send_queue = SendQueue()
+        self.retransmitter = Retransmitter(getattr(server, 'retransmit_policy', DEFAULT_POLICY),
+                                           getattr(server, 'command_latency', None))
+        self.liveness = LinkLiveness()
+        self.clock = LinkClock(getattr(server, 'update_period', None))
+        # fires on every 'U' package and when the link closes (linknotify)
+        self.updates = UpdateNotifier()
+        # completion futures of position commands (linkcompletion)
+        self.completions = CompletionTracker()
+        # 'U' packages can also come as datagrams (linkudp), handled under this lock
+        self.receive_lock = threading.Lock()
+        self.udp_sequence = None  # newest datagram taken
+        self.udp_received = 0
+        self.udp_stale = 0
+        # negotiated in the Hello (0 for links that say the short Hello)
+        self.protocol_version = 0
+        self.capabilities = 0
+        self.last_update = None  # last 'U' package, what the next 'D' package applies to
+        self.update_resyncs = 0  # framer resyncs when it came, a frame dropped since breaks the chain
+        self.delta_received = 0
+        self.delta_invalid = 0  # 'D' packages without a keyframe to apply to or that don't decode
+        self.keyframe_requested = None
+
+    @property
+    def resync_count(self):
+        return self.framer.resyncs
+
+    @property
+    def queue_depth(self):
+        return self.send_queue.depth()
+
+    @property
+    def bytes_in_flight(self):
+        return self.send_queue.bytes_in_flight()
+
+    @property
+    def coalesced_count(self):
+        return self.send_queue.coalesced
+
+    @property
+    def retransmit_count(self):
+        return self.retransmitter.retransmits
+
+    @property
+    def give_up_count(self):
+        return self.retransmitter.give_ups
+
+    # seconds from sending the last command until the link reported executing it (None until then)
+    @property
+    def converge_time(self):
+        return self.retransmitter.last_converge_time
+
+    @property
+    def command_latency(self):
+        return self.retransmitter.latency
+
+    # Next verified package from the framer, decoded like StreamFramer.next_package (None if more
+    # bytes are needed). The raw frame goes to the capture if the server has one.
+    def next_package(self):
+        frame = self.framer.next_frame()
+        if frame is None:
+            return None
+        if self.capture is not None:
+            self.capture.record(INBOUND, self.connection_id, self.device_id, frame)
+        return self.framer.decode(frame)
+
+    # A 'U' frame that came as a datagram (CRC already checked). Returns False if it is older than
+    # the newest one taken.
+    def handle_datagram(self, sequence, frame):
+        with self.receive_lock:
+            if not self.__is__running__:
+                return False
+            if not is_newer(sequence, self.udp_sequence):
+                self.udp_stale += 1
+                return False
+            self.udp_sequence = sequence
+            self.udp_received += 1
+            if self.capture is not None:
+                self.capture.record(INBOUND, self.connection_id, self.device_id, frame)
+            self.handle_package(self.framer.structs[frame[1]].unpack_from(frame, HEADER_LENGTH), "U")
+            return True
+
+    # When the Link connects, Hello package is expected.
+    def handle_hello(self, package, package_type):
+        if package_type != "H":  # Check if package is indeed Hello, else quit
+            raise AssertionError("Hello package not received. Closing Link Object")
+
+        self.device_id = package[0]
+        self.MAX_VEL = package[1]
+        if len(package) > 2:
+            # extended Hello: protocol version and capabilities the link offers
+            self.protocol_version = min(package[2], PROTOCOL_VERSION)
+            self.capabilities = package[3] & getattr(self.server, 'capabilities', SERVER_CAPABILITIES)
 
-    def receive_package(self):
-        checksum_verified = False
-        while not checksum_verified:
-            header = self.connection.recv(2)
-            length, package_type = RMLPacker.decode_header(header)
-            body = self.connection.recv(length)
-            footer = self.connection.recv(2)
+        if self.device_id in self.server.links:
+            safe_print("Overwriting existing link " + str(self.device_id))
+            self.server.links[self.device_id].close_link()  # saves its session
+
+        self.server.links[self.device_id] = self
+        self.state_table.register(self.state_row, self.device_id)
+
+        session = self.server.take_session(self.device_id)
+        if session is not None:
+            self.telemetry = session.telemetry
+            self.retransmitter = session.retransmitter
+        self.publish_state()
+
+        if self.protocol_version:
+            self.send_negotiate_package()
+
+        safe_print("Sending epoch...")
+        self.send_epoch_package()
+        self.clock.synced(self.server.get_server_time_precise())
+
+        # resume the command the link was executing before it dropped, right after the epoch
+        if session is not None and session.frame is not None and session.frame[1] != ord('T'):
+            self.send_frame(session.frame, session.checksum)
+            safe_print("Resumed session of link " + str(self.device_id))
+
+        safe_print("P" + str(self.device_id) + " said Hello. Total is " + str(self.server.size()) + ". Sent epoch!")
+        self.server.link_events.notify()
+
+    def handle_package(self, package, package_type):
+        if package_type == "C":
+            pass
+
+        elif package_type == "D":
+            # delta telemetry: handled as the 'U' package it stands for
+            if (package is None or self.last_update is None or self.framer.resyncs != self.update_resyncs
+                    or not self.capabilities & CAP_DELTA_TELEMETRY):
+                self.last_update = None
+                self.delta_invalid += 1
+                self.liveness.received()  # alive, its state just waits for the keyframe
+                self.request_keyframe()
+                return
+            self.delta_received += 1
+            self.handle_package(apply_delta(self.last_update, package), "U")
+
+        elif package_type == "U":
+            self.last_update = package
+            self.update_resyncs = self.framer.resyncs
+            # device_status, srv0_pos, srv1_pos, srv0_raw, srv1_raw, bat_status, srv0_vel, srv1_vel,
+            # executing_command_checksum, written to the state table in one go
+            now = self.server.get_server_time_raw()
+            self.liveness.received()
+            self.clock.update_received(now)
+            bat_status = package[5] - 25  # shifting values so 0 = change battery immediately
+            self.state_table.write_update(self.state_row, package[:5] + (bat_status,) + package[6:], now)
+            if self.telemetry is not None:
+                self.telemetry.append(now, package)
+            if self.bus is not None:
+                self.publish_state((now,) + package)
+            if self.log:
+                logging.info((self.device_id, self.current_command_checksum, self.executing_command_checksum))
+            # a different executing command means the last one got lost, the policy decides when to resend
+            confirmed = self.retransmitter.latency.commands
+            if self.retransmitter.on_update(package[8], now):
+                #print('executing command different from sent command, link ID: ', self.device_id)
+                self.resend_last_frame()
+            elif self.retransmitter.latency.commands != confirmed:
+                # send -> first report of the command, a round trip sample for the clock
+                self.clock.rtt_sample(self.retransmitter.last_converge_time)
+            self.completions.update(package[8], package[1], package[2], now)
+            self.updates.notify()
+
+    # Blocks until predicate(link) is true, rechecked on every 'U' package (and when the link
+    # closes). Without predicate it waits for the next 'U' package. Returns the last value of
+    # predicate, False on timeout. Not from the AsyncLinkServer's loop thread, which would
+    # block the packages it waits for: use wait_for_update_async there.
+    def wait_for_update(self, predicate=None, timeout=None):
+        return self.updates.wait_for(None if predicate is None else lambda: predicate(self), timeout)
+
+    async def wait_for_update_async(self, predicate=None, timeout=None):
+        return await self.updates.wait_for_async(None if predicate is None else lambda: predicate(self), timeout)
+
+    # Copies the link's state row (and a telemetry row) to the server's TelemetryBus, if it has one
+    def publish_state(self, telemetry_row=None):
+        if self.bus is not None and self.device_id is not None:
+            self.bus.publish(self.device_id, self.state_table.rows[self.state_row], telemetry_row)
+
+    # The functions below accept parameters and send them to the link.
+    # They return whether the package was queued for sending (False once the link is closed)
 
-            checksum_verified = RMLPacker.verify_checksum(header, body, footer)
+    def send_package(self, header_and_body, checksum):
+        # safe_print("Sending... ")
+        with self.send_lock:
+            if type(checksum) == type(b''):
+                checksum = int.from_bytes(checksum, byteorder="big")
+            # the frame stays in the SendQueue until the writer sent it, so it is its own bytes object
+            frame, checksum = RMLPacker.pack_raw(header_and_body, checksum)
+            return self.send_frame(frame, checksum)
+
+    # Sends a complete wire frame (header + body + swapped footer), see SendQueue.put for on_written
+    def send_frame(self, frame, checksum, on_written=None):
+        with self.send_lock:
+            now = self.server.get_server_time_raw()
+            self.last_sent_frame = frame
+            self.current_command_checksum = checksum
+            if self.retransmitter is not None:
+                self.retransmitter.command_sent(checksum, now)
+            self.completions.supersede(checksum, now)
+            self.publish_state()
+            return self.write_frame(frame, on_written)
+
+    def write_frame(self, frame, on_written=None):
+        return self.send_queue.put(frame, on_written)
+
+    # Called by the writer once it handed frame to the socket
+    def frame_written(self, frame):
+        if self.capture is not None:
+            self.capture.record(OUTBOUND, self.connection_id, self.device_id, frame)
+
+    # send_frame for a position command, returns a Future resolving to a CommandResult once the
+    # link reports target (srv0_pos, srv1_pos) within tolerance, or TIMEOUT/SUPERSEDED/CLOSED
+    def send_tracked(self, frame, checksum, target, tolerance=COMPLETION_TOLERANCE, timeout=COMPLETION_TIMEOUT,
+                     on_written=None):
+        with self.send_lock:
+            future = self.completions.add(checksum, target, self.server.get_server_time_raw(), tolerance, timeout)
+            if not self.send_frame(frame, checksum, on_written):
+                self.completions.close(self.server.get_server_time_raw())
+                return closed_future()
+            return future
+
+    def resend_last_frame(self):
+        with self.send_lock:
+            if self.last_sent_frame is None:
+                return False
+            return self.write_frame(self.last_sent_frame)
+
+    @property
+    def last_sent_package(self):
+        if self.last_sent_frame is None:
+            return None
+        return bytes(self.last_sent_frame[:-FOOTER_LENGTH])
 
-            # if not checksum_verified:
-            #     # negative_ack_package = RMLPacker.make_ack_package(0)
-            #     # self.connection.send(negative_ack_package)
+    def send_calibrate_package(self):
+        header_and_body, checksum = RMLPacker.make_calibrate_package()
+        return self.send_package(header_and_body, checksum)
 
-        # positive_ack_package = RMLPacker.make_ack_package(255)
-        # self.connection.send(positive_ack_package)
+    # With completion it returns a Future instead (see send_tracked and linkcompletion)
+    def send_position_package(self, srv0_pos, srv1_pos, srv0_vel, srv1_vel, completion=False,
+                              tolerance=COMPLETION_TOLERANCE, timeout=COMPLETION_TIMEOUT):
+        (self.srv0_pos, self.srv1_pos, self.srv0_vel, self.srv1_vel) = (srv0_pos, srv1_pos, srv0_vel, srv1_vel)
+        frame, checksum = RMLPacker.get_position_frame(srv0_pos, srv1_pos, srv0_vel, srv1_vel)
+        if completion:
+            return self.send_tracked(frame, checksum, (srv0_pos, srv1_pos), tolerance, timeout)
+        return self.send_frame(frame, checksum)
 
-        # safe_print("PACKAGE from "+str(self.device_id)+": " + str(package_type))
-        # safe_print(bytearray(header).hex())
-        # safe_print(bytearray(body).hex())
-        # safe_print(bytearray(footer).hex())
+    def send_sinusoidal_package(self, start_time, a0, x0, ps0, p0, a1, x1, ps1, p1):
+        frame, checksum = RMLPacker.get_sinusoidal_frame(start_time, a0, x0, ps0, p0, a1, x1, ps1, p1)
+        return self.send_frame(frame, checksum)
 
-        received_package = RMLPacker.decode(package_type, body)
-        return received_package, package_type.decode("ASCII")
+    def send_walk_package(self, nr_steps):
+        frame, checksum = RMLPacker.get_frame(b'W', (nr_steps,))
+        return self.send_frame(frame, checksum)
 
-    def run(self):
-        try:
+    def send_epoch_package(self):
+        frame, checksum = RMLPacker.get_frame(b'T', (self.server.start_epoch,))
+        return self.send_frame(frame, checksum)
+
+    # 'N': the negotiated protocol version, capabilities and keyframe interval. It isn't a
+    # command (the link doesn't report its checksum), so it never becomes last_sent_frame. A delta
+    # link answers every 'N' with a keyframe.
+    def send_negotiate_package(self):
+        frame, _ = RMLPacker.get_frame(b'N', (self.protocol_version, self.capabilities,
+                                              getattr(self.server, 'keyframe_interval', KEYFRAME_INTERVAL)))
+        return self.write_frame(frame)
+
+    # Asks for a keyframe after a 'D' package that couldn't be applied, at most once per
+    # KEYFRAME_REQUEST_INTERVAL (the deltas until it arrives can't be applied either)
+    def request_keyframe(self):
+        if not self.capabilities & CAP_DELTA_TELEMETRY:
+            return False
+        now = self.server.get_server_time_raw()
+        if self.keyframe_requested is not None and now - self.keyframe_requested < KEYFRAME_REQUEST_INTERVAL:
+            return False
+        self.keyframe_requested = now
+        return self.send_negotiate_package()
+
+    # Resends the epoch to measure a round trip (see linkclock). Only on an idle link, so the
+    # command it executes stays the one that gets retransmitted. Returns whether it was sent.
+    def probe_clock(self):
+        with self.send_lock:
+            if self.last_sent_frame is not None and self.last_sent_frame[1] != ord('T'):
+                return False
+            return self.send_epoch_package()
+
+    # Link time expected at server time server_time (get_server_time_precise base)
+    def link_time(self, server_time):
+        return self.clock.to_link_time(server_time)
+
+    def send_position_only(self, srv0_pos, srv1_pos, completion=False, tolerance=COMPLETION_TOLERANCE,
+                           timeout=COMPLETION_TIMEOUT):
+        return self.send_position_package(srv0_pos, srv1_pos, 100, 100, completion, tolerance, timeout)
+
+    def send_list(self, body):
+        header_and_body, checksum = RMLPacker.make_list(body)
+        return self.send_package(header_and_body, checksum)
 
-            # When Link Thread begins, Hello package is expected.
+    # This function interrupts the receive loop
+    # It also closes the connection
+    # It also removes self from server dictionary (unless a reconnect already replaced it)
 
-            package, package_type = self.receive_package()
+    def close_link(self):
+        with self.send_lock:
+            if self.link_closed:
+                return
+            self.link_closed = True
+        if self.capture is not None and self.__is__running__:
+            self.capture.record(CLOSED, self.connection_id, self.device_id)
+        self.__is__running__ = False
+        if self.server.links.get(self.device_id) is self:
+            self.server.links.pop(self.device_id)
+            self.server.save_session(self)
+            if self.bus is not None:
+                self.bus.deactivate(self.device_id)
+            self.server.link_events.notify()
+        self.state_table.unregister(self.state_row)
+        self.close_connection()
+        self.completions.close(self.server.get_server_time_raw())
+        self.updates.notify()
+        safe_print("Closed Link " + str(self.device_id))
 
-            if package_type != "H":  # Check if package is indeed Hello, else quit
-                raise AssertionError("Hello package not received. Closing Link Object")
 
-            self.device_id = package[0]
-            self.MAX_VEL = package[1]
+# device_status, srv0_pos, ..., executing_command_checksum, current_command_checksum are views
+# onto the link's row of server.state
+for name in STATE_FIELDS:
+    setattr(LinkBase, name, StateField(name))
 
-            if self.device_id in self.server.links:
-                safe_print("Overwriting existing link " + str(self.device_id))
-                self.server.links[self.device_id].close_link()
 
-            self.server.links[self.device_id] = self
+class RobotLink(LinkBase, threading.Thread):
 
-            safe_print("Sending epoch...")
-            self.send_epoch_package()
+    # An object of this class will be instantiated for each link that connects to the server
+    # The thread will close automatically when the connection is broken
 
-            safe_print("P" + str(self.device_id) + " said Hello. Total is " + str(self.server.size()) + ". Sent epoch!")
+    def __init__(self, connection, server, log=False):
+        threading.Thread.__init__(self)
+        self.init_link(server, log)
+        self.connection = connection[0]
+        self.addr = connection[1]
+        
+        self.connection.settimeout(CLIENT_SOCKET_TIMEOUT)
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        self.start()
+
+    def receive_package(self):
+        # The framer reads everything that is available in one recv, so most of the time the next
+        # package is already buffered. Checksum failures make it resynchronize on the next valid frame.
+        package = self.next_package()
+        waiting_since = time.monotonic()
+        while package is None:
+            timeout = self.liveness.timeout()
+            if self.server.udp_ingest is not None:
+                # the 'U' packages may come as datagrams, check on them at least once a second
+                timeout = min(timeout, DEAD_LINK_MIN_TIMEOUT)
+            self.connection.settimeout(timeout)
+            try:
+                self.framer.recv_from(self.connection)
+            except socket.timeout:
+                # with telemetry over UDP the connection is quiet while the link is alive
+                if self.liveness.is_dead() or (self.liveness.last is None and
+                                               time.monotonic() - waiting_since >= CLIENT_SOCKET_TIMEOUT):
+                    raise
+            package = self.next_package()
+
+        # safe_print("PACKAGE from "+str(self.device_id)+": " + str(package[1]))
+        return package
+
+    def run(self):
+        try:
+            package, package_type = self.receive_package()
+            self.handle_hello(package, package_type)
 
             while self.__is__running__:
                 package, package_type = self.receive_package()
-
-                if package_type == "C":
-                    pass
-
-                elif package_type == "U":
-                    self.device_status = package[0].decode("ASCII")
-                    self.srv0_pos = package[1]
-                    self.srv1_pos = package[2]
-                    self.srv0_raw = package[3]
-                    self.srv1_raw = package[4]
-                    self.bat_status = (package[5]-25) # shifting values so 0 = change battery immediately
-                    self.srv0_vel = package[6]
-                    self.srv1_vel = package[7]
-                    self.executing_command_checksum = package[8]
-                    if self.log:
-                        logging.info((self.device_id, self.current_command_checksum, self.executing_command_checksum))
-                    if self.executing_command_checksum != self.current_command_checksum:
-                        #print('executing command different from sent command, link ID: ', self.device_id)
-                        self.send_package(self.last_sent_package, self.current_command_checksum)
+                with self.receive_lock:
+                    self.handle_package(package, package_type)
 
             self.connection.close()
 
@@ -265,71 +957,25 @@ class RobotLink(threading.Thread):
 
         finally:
             self.close_link()
-            self.connection.close()
-
-    # The functions below accept parameters and send them to the link.
-    # They return whether the package was successfully sent
-
-    def send_package(self, header_and_body, checksum):
-        # safe_print("Sending... ")
-        with thread_Rlock:
-            self.last_sent_package = header_and_body
-            if type(checksum) == type(b''):
-                self.current_command_checksum = int.from_bytes(checksum, byteorder="big")
-            else:
-                self.current_command_checksum = checksum
-                checksum = int(checksum).to_bytes(2, 'big')
-
-            # # safe_print(bytearray(checksum).hex())
-            # # MODIFIED PART
-            # try:
-            #     result = self.connection.send(header_and_body + checksum[1:2] + checksum[0:1])
-            #     return result == len(header_and_body + checksum)
-            # except OSError as e:
-            #     print(f"Error sending data: {e}")
-
-            # END OF MODIFICATION
-            result = self.connection.send(header_and_body + checksum[1:2] + checksum[0:1])
-            return result == len(header_and_body + checksum)
-
-    def send_calibrate_package(self):
-        header_and_body, checksum = RMLPacker.make_calibrate_package()
-        return self.send_package(header_and_body, checksum)
-
-    def send_position_package(self, srv0_pos, srv1_pos, srv0_vel, srv1_vel):
-        (self.srv0_pos, self.srv1_pos, self.srv0_vel, self.srv1_vel) = (srv0_pos, srv1_pos, srv0_vel, srv1_vel)
-        header_and_body, checksum = RMLPacker.make_position_package(srv0_pos, srv1_pos, srv0_vel, srv1_vel)
-        return self.send_package(header_and_body, checksum)
-
-    def send_sinusoidal_package(self, start_time, a0, x0, ps0, p0, a1, x1, ps1, p1):
-        header_and_body, checksum = RMLPacker.make_sinusoidal_package(start_time, a0, x0, ps0, p0, a1, x1, ps1, p1)
-        return self.send_package(header_and_body, checksum)
 
-    def send_walk_package(self, nr_steps):
-        header_and_body, checksum = RMLPacker.make_walk_package(nr_steps)
-        return self.send_package(header_and_body, checksum)
+    # Writer thread of this link: sendall, so partial sends are completed instead of dropped
+    def write_loop(self):
+        frame = self.send_queue.get()
+        while frame is not None:
+            try:
+                self.connection.sendall(frame)
+            except OSError as e:
+                if self.__is__running__:
+                    safe_error_print("Link " + str(self.device_id) + " send failed: " + str(e))
+                    self.close_link()
+                return
+            self.frame_written(frame)
+            self.send_queue.done(frame)
+            frame = self.send_queue.get()
 
-    def send_epoch_package(self):
-        header_and_body, checksum = RMLPacker.make_epoch_package(self.server.start_epoch)
-        return self.send_package(header_and_body, checksum)
-
-    def send_position_only(self, srv0_pos, srv1_pos):
-        return self.send_position_package(srv0_pos, srv1_pos, 100, 100)
-
-    def send_list(self, body):
-        header_and_body, checksum = RMLPacker.make_list(body)
-        return self.send_package(header_and_body, checksum)
-
-    # This function interrupts run thread loop
-    # It also closes the connection socket
-    # It also removes self from server dictionary
-
-    def close_link(self):
-        self.__is__running__ = False
-        if self.device_id in self.server.links:
-            self.server.links.pop(self.device_id)
-            self.connection.close()
-        safe_print("Closed Link " + str(self.device_id))
+    def close_connection(self):
+        self.send_queue.close()
+        self.connection.close()
 
 
 class ListMaker:
@@ -343,14 +989,202 @@ class ListMaker:
         return RMLPacker.make_list_position(srv0_pos, srv1_pos, srv0_vel, srv1_vel, duration)
 
     @staticmethod
-    def SIN(start_time, period, duration):
-        return RMLPacker.make_list_sin(start_time, period, duration)
+    def SIN(start_time, a0, x0, ps0, p0, a1, x1, ps1, p1, duration):
+        return RMLPacker.make_list_sin(start_time, a0, x0, ps0, p0, a1, x1, ps1, p1, duration)
 
     @staticmethod
     def TAIL():
         return bytes([0]) + b'E'
 
 
+class GaitCompiler:
+
+    # Turns a gait into one list package per link, so the links run every phase locally from a
+    # shared list_start_time instead of the server sending each phase and waiting in between.
+    #
+    # A gait is a list of phases: (duration in seconds, {RobotLink: command}). A command is
+    #   (srv0_pos, srv1_pos)                          -> POSVEL with the default velocity
+    #   (srv0_pos, srv1_pos, srv0_vel, srv1_vel)      -> POSVEL
+    #   (start_time, a0, x0, ps0, p0, a1, x1, ps1, p1) -> SIN
+    # A link that has no command in a phase holds its previous command (or rest before its first one),
+    # so every list has the same phases and the links stay in lockstep.
+    # Durations are converted to the firmware's list ticks (rmlprotocol.LIST_TIME_UNIT), so the
+    # same phases can be run from the server (run_phases) or uploaded. A phase longer than
+    # MAX_LIST_DURATION raises ValueError.
+
+    DEFAULT_VEL = 100
+
+    def __init__(self, server, rest=(22, 22), lead_time=2):
+        self.server = server
+        self.rest = rest
+        self.lead_time = lead_time  # seconds between the upload and list_start_time
+
+    @classmethod
+    def make_entry(cls, command, duration):
+        duration = list_duration(duration)
+        if len(command) == 2:
+            return ListMaker.POSVEL(command[0], command[1], cls.DEFAULT_VEL, cls.DEFAULT_VEL, duration)
+        if len(command) == 4:
+            return ListMaker.POSVEL(*command, duration)
+        if len(command) == 9:
+            return ListMaker.SIN(*command, duration)
+        raise ValueError(f"Unknown gait command {command}")
+
+    # Returns {RobotLink: list body}
+    def compile(self, phases, nr_repeat=1, list_start_time=None):
+        if list_start_time is None:
+            list_start_time = self.server.get_server_time() + self.lead_time
+
+        links = []
+        for duration, commands in phases:
+            for link in commands:
+                if link not in links:
+                    links.append(link)
+
+        lists = {}
+        for link in links:
+            body = ListMaker.HEAD(nr_repeat, list_start_time)
+            command = self.rest
+            for duration, commands in phases:
+                command = commands.get(link, command)
+                body += self.make_entry(command, duration)
+            body += ListMaker.TAIL()
+
+            if len(body) > MAX_BODY_LENGTH:
+                raise ValueError(f"Gait too long for one list package ({len(body)} > {MAX_BODY_LENGTH} bytes)")
+            lists[link] = body
+        return lists
+
+    # Pre-encodes every list package and then sends them in one burst
+    def upload(self, lists):
+        packages = [(link, RMLPacker.make_list(body)) for link, body in lists.items()]
+        results = {}
+        for link, (header_and_body, checksum) in packages:
+            results[link.device_id] = link.send_package(header_and_body, checksum)
+        return results
+
+    def compile_and_upload(self, phases, nr_repeat=1, list_start_time=None):
+        return self.upload(self.compile(phases, nr_repeat, list_start_time))
+
+
+
+# (frame, checksum) of one send_group command, see LinkServer.send_group
+def encode_group_command(command, start_time=None, duration=MAX_LIST_DURATION):
+    if start_time is not None:
+        body = ListMaker.HEAD(1, start_time) + GaitCompiler.make_entry(command, duration) + ListMaker.TAIL()
+        return RMLPacker.make_list_frame(body)
+    if len(command) == 2:
+        return RMLPacker.get_position_frame(command[0], command[1], GaitCompiler.DEFAULT_VEL, GaitCompiler.DEFAULT_VEL)
+    if len(command) == 4:
+        return RMLPacker.get_position_frame(*command)
+    if len(command) == 9:
+        return RMLPacker.get_sinusoidal_frame(*command)
+    raise ValueError(f"Unknown group command {command}")
+
+
+# Quantized sinusoid parameters of one link, in the order of send_sinusoidal_package
+# (without start_time), and the quantization error of each of them
+SinusoidPlan = namedtuple('SinusoidPlan', ['params', 'errors'])
+
+
+class SinusoidPlanner:
+
+    # Plans the sinusoid parameters (amplitude, offset, phase shift, period) of every servo in a
+    # structure for a travelling or standing wave, quantizes them to the 'S' package fields and
+    # uploads all packages against one server time start, so the whole structure oscillates
+    # with one round of sends.
+    #
+    # Link i of n has wave phase i / wavelength (wavelength in links, default n).
+    #   travelling: servo phase = wave phase (+ servo_phase for srv1)
+    #   standing:   amplitude = amplitude * cos(2 pi * wave phase), a negative amplitude is
+    #               sent as half a period of phase shift
+    # Position = offset + amplitude * sin(2 pi (t - start_time - phase shift) / period),
+    # period and phase shift in ms.
+
+    AMPLITUDE_RANGE = (0, 255)    # B
+    OFFSET_RANGE = (0, 255)       # B
+    PHASE_SHIFT_RANGE = (-32768, 32767)  # h
+    PERIOD_RANGE = (1, 65535)     # H
+
+    def __init__(self, server, lead_time=2):
+        self.server = server
+        self.lead_time = lead_time  # seconds between the upload and start_time
+
+    @staticmethod
+    def quantize(value, value_range):
+        q = min(max(int(round(value)), value_range[0]), value_range[1])
+        return q, q - value
+
+    def plan_servo(self, amplitude, offset, phase, period_ms):
+        # phase in cycles, the sign of the amplitude goes into the phase shift
+        if amplitude < 0:
+            amplitude, phase = -amplitude, phase + 0.5
+        # wrap into [-0.5, 0.5) cycles so the phase shift fits into the int16 field
+        phase = (phase + 0.5) % 1.0 - 0.5
+
+        a, a_err = self.quantize(amplitude, self.AMPLITUDE_RANGE)
+        x, x_err = self.quantize(offset, self.OFFSET_RANGE)
+        p, p_err = self.quantize(period_ms, self.PERIOD_RANGE)
+        # the phase shift is relative to the quantized period
+        ps, ps_err = self.quantize(phase * p, self.PHASE_SHIFT_RANGE)
+        return (a, x, ps, p), {
+            'amplitude': a_err,
+            'offset': x_err,
+            'phase_shift_ms': ps_err,
+            'period_ms': p_err,
+            # phase error in cycles, includes the error from quantizing the period
+            'phase': ps / p - phase,
+        }
+
+    # Returns {device_id: SinusoidPlan}
+    def plan(self, link_ids, pattern='travelling', period=32.0, amplitude=42, offset=58,
+             wavelength=None, servo_phase=0.5):
+        if pattern not in ('travelling', 'standing'):
+            raise ValueError(f"Unknown wave pattern {pattern}")
+        if wavelength is None:
+            wavelength = len(link_ids)
+        period_ms = period * 1000
+
+        plans = {}
+        for i, device_id in enumerate(link_ids):
+            wave_phase = i / wavelength
+            if pattern == 'travelling':
+                servos = [(amplitude, wave_phase), (amplitude, wave_phase + servo_phase)]
+            else:
+                a = amplitude * math.cos(2 * math.pi * wave_phase)
+                servos = [(a, 0.0), (a, servo_phase)]
+
+            params = ()
+            errors = {}
+            for servo, (a, phase) in enumerate(servos):
+                servo_params, servo_errors = self.plan_servo(a, offset, phase, period_ms)
+                params += servo_params
+                errors.update({f"srv{servo}_{name}": err for name, err in servo_errors.items()})
+            plans[device_id] = SinusoidPlan(params, errors)
+        return plans
+
+    # Pre-encodes every package first, then sends them all. Returns {device_id: sent}
+    # start_time is server time (get_server_time_precise base, fractional); every link gets it on
+    # its own clock, the sub second part in the phase shifts (linkclock.schedule_sinusoid).
+    def upload(self, plans, start_time=None):
+        if start_time is None:
+            start_time = self.server.get_server_time_precise() + self.lead_time
+
+        frames = []
+        for device_id, plan in plans.items():
+            link = self.server.links[device_id]
+            params = schedule_sinusoid(link.link_time(start_time), plan.params)
+            frames.append((link, RMLPacker.get_sinusoidal_frame(*params)))
+
+        results = {}
+        for link, (frame, checksum) in frames:
+            results[link.device_id] = link.send_frame(frame, checksum)
+        return results
+
+    def plan_and_upload(self, link_ids, start_time=None, **kwargs):
+        plans = self.plan(link_ids, **kwargs)
+        return plans, self.upload(plans, start_time)
+
 DEFAULT_PORT = 54657  # "LINKS"
 DEFAULT_HOST = ''     # my_ip()
 
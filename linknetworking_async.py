@@ -0,0 +1,205 @@
+# asyncio variant of linknetworking: one event loop thread serves every link instead of one
+# RobotLink thread per connection, so hundreds of links don't mean hundreds of threads contending
+# for the GIL with Retinas and the controllers.
+#
+# AsyncLinkServer has the same public API as LinkServer (links, size(), get_server_time(),
+# close_server()) and its links have the same send_* API as RobotLink. send_* can be called from
+# any thread: the frame is encoded in the calling thread and handed to the loop, so the existing
+# controllers work unchanged.
+#
+# The links are asyncio.BufferedProtocols rather than streams: the loop reads straight into the
+# link's StreamFramer buffer and the packages are handled in the same callback, without a
+# coroutine switch or an asyncio.wait_for timer per read. Timeouts are checked by one watchdog.
+
+import asyncio
+import threading
+import time
+
+from linknetworking import (
+    LinkServer, LinkBase, CLIENT_SOCKET_TIMEOUT, DEFAULT_HOST, DEFAULT_PORT, safe_print, safe_error_print,
+)
+from linkudp import DatagramProtocol
+
+WATCHDOG_INTERVAL = 0.1  # dead links are detected within DEAD_LINK_MIN_TIMEOUT + this
+
+
+class AsyncRobotLink(LinkBase, asyncio.BufferedProtocol):
+
+    # One object per connected link, driven by the server's event loop
+
+    def __init__(self, server, log=False):
+        self.init_link(server, log)
+        self.transport = None
+        self.addr = None
+        self.said_hello = False
+        self.flush_scheduled = False
+        self.last_receive_time = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.last_receive_time = self.server.loop.time()
+        self.server.connections.add(self)
+        safe_print("Accepted new Link")
+
+    def get_buffer(self, sizehint):
+        return self.framer.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.framer.buffer_updated(nbytes)
+        self.last_receive_time = self.server.loop.time()
+        try:
+            package = self.next_package()
+            while package is not None and self.__is__running__:
+                package, package_type = package
+                if self.said_hello:
+                    self.handle_package(package, package_type)
+                else:
+                    self.handle_hello(package, package_type)
+                    self.said_hello = True
+                package = self.next_package()
+        except Exception as e:
+            safe_print(e)
+            self.close_link()
+
+    def handle_datagram(self, sequence, frame):
+        self.last_receive_time = self.server.loop.time()
+        return super().handle_datagram(sequence, frame)
+
+    def eof_received(self):
+        return False  # close the transport
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.close_link()
+
+    # Never blocks: the frame goes into the link's SendQueue, which the loop flushes into the
+    # transport (right away on the loop, with one scheduled flush for sends from other threads).
+    def write_frame(self, frame, on_written=None):
+        if self.transport is None or self.transport.is_closing():
+            return False
+        if not self.send_queue.put(frame, on_written):
+            return False
+        if self.server.in_loop():
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.server.loop.call_soon_threadsafe(self.flush)
+        return True
+
+    def flush(self):
+        self.flush_scheduled = False
+        frame = self.send_queue.take()
+        while frame is not None:
+            # handed to the transport, which writes to the socket right away unless it is backed up
+            written = not self.transport.is_closing()
+            if written:
+                self.transport.write(frame)
+                self.frame_written(frame)
+            self.send_queue.done(frame, written)
+            frame = self.send_queue.take()
+
+    # includes what the transport hasn't handed to the socket yet
+    @property
+    def bytes_in_flight(self):
+        buffered = self.transport.get_write_buffer_size() if self.transport is not None else 0
+        return self.send_queue.bytes_in_flight() + buffered
+
+    def close_connection(self):
+        self.send_queue.close()
+        if self.transport is None:
+            return
+        if self.server.in_loop():
+            self.transport.close()
+        elif not self.server.loop.is_closed():
+            self.server.loop.call_soon_threadsafe(self.transport.close)
+
+
+class AsyncLinkServer(LinkServer):
+
+    # Binding, epoch, logging, size() and get_server_time() come from LinkServer,
+    # only the accept loop runs on asyncio
+
+    link_class = AsyncRobotLink
+
+    def __init__(self, host, port, log=False, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread_id = None
+        self.serving = threading.Event()
+        self.serve_task = None
+        self.serve_error = None  # why serve() stopped, raised from __init__ if it never got going
+        self.udp_transport = None
+        self.connections = set()  # every open connection, including links that haven't said Hello yet
+        super().__init__(host, port, log, **kwargs)
+        self.serving.wait()
+        if self.serve_error is not None:
+            self.sock.close()
+            if self.udp_sock is not None:
+                self.udp_sock.close()
+            raise self.serve_error
+
+    def in_loop(self):
+        return threading.get_ident() == self.loop_thread_id
+
+    def run(self):
+        self.loop_thread_id = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        self.serve_task = self.loop.create_task(self.serve())
+        try:
+            self.loop.run_until_complete(self.serve_task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.serve_error = e
+            if self.serving.is_set():
+                safe_error_print(f"Server stopped: {e}")
+        finally:
+            self.serving.set()  # never leave __init__ waiting
+            # let the links see their closed connections before the loop goes away
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+            self.loop.close()
+
+    async def serve(self):
+        aserver = await self.loop.create_server(lambda: self.link_class(self, self.log), sock=self.sock, backlog=256)
+        if self.udp_sock is not None:
+            self.udp_transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: DatagramProtocol(self.udp_ingest), sock=self.udp_sock)
+        self.serving.set()
+        async with aserver:
+            while self.__is__running__:
+                await asyncio.sleep(WATCHDOG_INTERVAL)
+                self.close_timed_out_links()
+
+    # Same timeouts as the threaded RobotLink: adaptive once the link streams 'U' packages,
+    # CLIENT_SOCKET_TIMEOUT before that
+    def close_timed_out_links(self):
+        now = self.loop.time()
+        monotonic = time.monotonic()
+        for link in list(self.connections):
+            if link.liveness.is_dead(monotonic) or now - link.last_receive_time > CLIENT_SOCKET_TIMEOUT:
+                safe_error_print("Link " + str(link.device_id) + " timed out")
+                link.close_link()
+
+    def close_server(self):
+        if self.in_loop():
+            self.close_now()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.close_now)
+
+    def close_now(self):
+        self.__is__running__ = False
+        for link in list(self.connections):
+            link.close_link()
+        if self.capture is not None:
+            self.capture.close()
+        if self.bus is not None:
+            self.bus.close()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        if self.serve_task is not None:
+            self.serve_task.cancel()
+        safe_print("Closed all links... Server has been closed.")
+
+
+def get_default_server(log=False):
+    return AsyncLinkServer(DEFAULT_HOST, DEFAULT_PORT, log)
@@ -18,7 +18,7 @@ def eprint(*args, **kwargs):
 
 def safe_error_print(content):
     with thread_lock:
-        eprint(*content)
+        eprint(content)
 
 
 def safe_print(content, my_end="\n"):
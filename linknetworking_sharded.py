@@ -0,0 +1,459 @@
+# Multi-process variant of linknetworking: N shard processes accept on the same port with
+# SO_REUSEPORT (Linux spreads the connections over them) and each serves its links with an
+# AsyncLinkServer loop. Package decoding, CRC checks and retransmissions of a link all happen in
+# its shard, so telemetry for hundreds of links is no longer limited by one interpreter's GIL.
+#
+# ShardedLinkServer runs in the controller's process and has the same public API as LinkServer
+# (links, size(), get_server_time(), close_server()). Its links are ShardLink proxies with the
+# same send_* API as RobotLink: frames are encoded in the caller's process (cached, like RobotLink)
+# and routed to the owning shard over a pipe. The shards stream back Hello/close events and
+# batches of changed link state, so the attributes the controllers read (srv0_pos, bat_status,
+# executing_command_checksum, ...) stay up to date on the proxies.
+#
+# All shards share the coordinator's start epoch, so every link gets the same 'T' package.
+# A link that reconnects to another shard takes over its device_id like in LinkServer: the old
+# shard is told to close the superseded connection, and the ShardLink proxy is kept, so
+# controllers holding a reference to it keep working. The proxy of a link that dropped is kept
+# for SESSION_TTL too and resumed when it says Hello again.
+#
+#   server = ShardedLinkServer(DEFAULT_HOST, DEFAULT_PORT, nr_shards=4)
+
+import asyncio
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import threading
+import time
+import numpy as np
+
+import linknetworking
+from linknetworking import (
+    LinkServer, LinkBase, DEFAULT_HOST, DEFAULT_PORT, SESSION_TTL, safe_print, safe_error_print,
+)
+from linkstats import Histogram
+from linktelemetry import TELEMETRY_CAPACITY, TELEMETRY_DTYPE
+from linkstate import LinkStateTable
+from linkbus import TelemetryBus, default_bus_name
+from linknotify import UpdateNotifier
+from linkretransmit import DEFAULT_POLICY
+from linknetworking_async import AsyncLinkServer, AsyncRobotLink
+
+# Commands, coordinator -> shard. Sent as raw bytes: op, device_id, payload
+OP_FRAME = ord('F')  # payload is a complete wire frame for the link
+OP_FRAME_STAMPED = ord('S')  # payload is a 4 byte token and a frame, the shard reports when it was written
+OP_CLOSE = ord('C')  # close the link, it reconnected to another shard or the controller closed it
+OP_QUIT = ord('Q')  # close the shard
+
+# Events, shard -> coordinator. Sent as tuples:
+#   ('ready', shard, port)
+#   ('hello', shard, device_id, MAX_VEL)
+#   ('closed', shard, device_id)
+#   ('state', shard, {device_id: (state tuple in STATE_FIELDS order, new telemetry rows as bytes)})
+#   ('written', shard, token, time.time() the OP_FRAME_STAMPED frame was written, or None)
+
+# Link attributes mirrored on the ShardLink proxies
+STATE_FIELDS = ('device_status', 'srv0_pos', 'srv1_pos', 'srv0_raw', 'srv1_raw', 'bat_status',
+                'srv0_vel', 'srv1_vel', 'executing_command_checksum', 'current_command_checksum',
+                'resync_count', 'queue_depth', 'bytes_in_flight', 'coalesced_count',
+                'retransmit_count', 'give_up_count', 'converge_time')
+
+STATE_INTERVAL = 0.01  # seconds between state batches of a shard
+SHARD_START_TIMEOUT = 10
+
+
+def default_nr_shards():
+    return max(1, min(os.cpu_count() or 1, 8))
+
+
+class ShardRobotLink(AsyncRobotLink):
+
+    # AsyncRobotLink that reports to the coordinator
+
+    superseded = False
+
+    def handle_hello(self, package, package_type):
+        # a reconnect on the same shard replaces the old connection without closing the proxy
+        old = self.server.links.get(package[0]) if package_type == "H" else None
+        if old is not None:
+            old.superseded = True
+        super().handle_hello(package, package_type)
+        self.server.post_event(('hello', self.server.shard, self.device_id, self.MAX_VEL))
+        self.server.dirty.add(self.device_id)
+
+    def handle_package(self, package, package_type):
+        super().handle_package(package, package_type)
+        self.server.dirty.add(self.device_id)
+
+    def close_link(self):
+        was_registered = not self.superseded and self.server.links.get(self.device_id) is self
+        super().close_link()
+        if was_registered:
+            self.server.post_event(('closed', self.server.shard, self.device_id))
+
+
+class ShardServer(AsyncLinkServer):
+
+    # The AsyncLinkServer of one shard process. Commands from the coordinator are read on the
+    # event loop, state batches are sent from it.
+
+    link_class = ShardRobotLink
+
+    def __init__(self, shard, host, port, command_conn, event_conn, start_epoch_raw, log=False,
+                 telemetry_capacity=TELEMETRY_CAPACITY, retransmit_policy=DEFAULT_POLICY, capture=None):
+        self.shard = shard
+        self.command_conn = command_conn
+        self.event_conn = event_conn
+        self.dirty = set()
+        self.telemetry_sent = {}  # device_id -> (TelemetryRing, since index already sent)
+        super().__init__(host, port, log, start_epoch_raw=start_epoch_raw, reuse_port=True,
+                         telemetry_capacity=telemetry_capacity, retransmit_policy=retransmit_policy, capture=capture)
+        self.loop.call_soon_threadsafe(self.start_shard)
+
+    def start_shard(self):
+        self.loop.add_reader(self.command_conn.fileno(), self.read_commands)
+        self.loop.create_task(self.send_states())
+        self.post_event(('ready', self.shard, self.port))
+
+    def post_event(self, event):
+        try:
+            self.event_conn.send(event)
+        except (OSError, EOFError):
+            # coordinator is gone, nothing to serve for
+            self.close_now()
+
+    def read_commands(self):
+        try:
+            while self.command_conn.poll():
+                self.handle_command(self.command_conn.recv_bytes())
+        except (OSError, EOFError):
+            self.loop.remove_reader(self.command_conn.fileno())
+            self.close_now()
+
+    def handle_command(self, command):
+        op, device_id = command[0], command[1]
+        if op == OP_QUIT:
+            self.loop.remove_reader(self.command_conn.fileno())
+            self.close_now()
+            return
+        link = self.links.get(device_id)
+        if link is None:
+            if op == OP_FRAME_STAMPED:
+                self.post_event(('written', self.shard, command[2:6], None))
+            return
+        if op == OP_FRAME:
+            frame = command[2:]
+            link.send_frame(frame, frame[-2] | (frame[-1] << 8))  # footer is sent low byte first
+            self.dirty.add(device_id)
+        elif op == OP_FRAME_STAMPED:
+            token, frame = command[2:6], command[6:]
+            written = lambda t: self.post_event(('written', self.shard, token, t))
+            if not link.send_frame(frame, frame[-2] | (frame[-1] << 8), written):
+                written(None)
+            self.dirty.add(device_id)
+        elif op == OP_CLOSE:
+            link.close_link()
+
+    async def send_states(self):
+        while self.__is__running__:
+            await asyncio.sleep(STATE_INTERVAL)
+            if not self.dirty:
+                continue
+            states = {}
+            for device_id in self.dirty:
+                link = self.links.get(device_id)
+                if link is not None:
+                    states[device_id] = (tuple(getattr(link, name) for name in STATE_FIELDS), self.new_telemetry(link))
+            self.dirty.clear()
+            if states:
+                self.post_event(('state', self.shard, states))
+
+
+    # Telemetry rows of the link the coordinator hasn't got yet
+    def new_telemetry(self, link):
+        if link.telemetry is None:
+            return b''
+        sent_ring, first = self.telemetry_sent.get(link.device_id, (None, 0))
+        if sent_ring is not link.telemetry:
+            first = 0  # new connection without a resumed session, new ring
+        rows, first = link.telemetry.since(first)
+        self.telemetry_sent[link.device_id] = (link.telemetry, first)
+        return rows.tobytes()
+
+
+def run_shard(shard, host, port, command_conn, event_conn, start_epoch_raw, log, telemetry_capacity, retransmit_policy,
+              capture):
+    linknetworking.DEBUG = False
+    server = ShardServer(shard, host, port, command_conn, event_conn, start_epoch_raw, log, telemetry_capacity,
+                         retransmit_policy, capture)
+    server.join()
+
+
+class ShardLink(LinkBase):
+
+    # Coordinator side proxy of a link served by a shard process. Same send_* API as RobotLink,
+    # write_frame routes the encoded frame to the shard that owns the connection.
+
+    # mirrored from the shard, which owns the framer and the send queue
+    resync_count = 0
+    queue_depth = 0
+    bytes_in_flight = 0
+    coalesced_count = 0
+    retransmit_count = 0
+    give_up_count = 0
+    converge_time = None
+    # retransmits and command latency are tracked by the shard's link, which sees the 'U' packages
+    command_latency = None
+
+    def __init__(self, server, device_id, shard, MAX_VEL):
+        self.init_link(server)
+        self.retransmitter = None
+        self.device_id = device_id
+        self.shard = shard
+        self.MAX_VEL = MAX_VEL
+
+    # with on_written the shard reports when its writer sent the frame (see SendQueue.put)
+    def write_frame(self, frame, on_written=None):
+        if not self.__is__running__:
+            return False
+        if on_written is None:
+            return self.server.send_command(self.shard, OP_FRAME, self.device_id, frame)
+        token = (next(self.server.write_tokens) % (1 << 32)).to_bytes(4, 'big')
+        self.server.write_callbacks[token] = on_written
+        if not self.server.send_command(self.shard, OP_FRAME_STAMPED, self.device_id, token + frame):
+            self.server.write_callbacks.pop(token, None)
+            return False
+        return True
+
+    def close_connection(self):
+        self.server.send_command(self.shard, OP_CLOSE, self.device_id)
+
+
+class ShardedLinkServer(threading.Thread):
+
+    # Coordinator: starts the shard processes and keeps the merged links view.
+    # The thread only reads events from the shards.
+
+    def __init__(self, host, port, nr_shards=None, log=False, telemetry_capacity=TELEMETRY_CAPACITY,
+                 retransmit_policy=DEFAULT_POLICY, capture=None, bus=None):
+        super().__init__(daemon=True)
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError("SO_REUSEPORT is not supported on this platform")
+
+        self.start_epoch_raw = time.time()
+        self.start_epoch = int(self.start_epoch_raw + 0.5)
+        self.__is__running__ = True
+        self.host = host
+        self.port = port
+        self.log = log
+        self.telemetry_capacity = telemetry_capacity  # the proxies keep the same history as the shards
+        self.links = {}  # device_id -> ShardLink, for every link of every shard
+        self.newest = None
+        self.nr_shards = nr_shards or default_nr_shards()
+        self.group_skew = Histogram()
+        self.group_skew_by_size = {}
+        self.state = LinkStateTable()  # rows of the ShardLink proxies
+        self.sessions = {}  # device_id -> (ShardLink, closed time) of closed links
+        self.bus = None  # published from the merged view, set up once the port is known
+        self.link_events = UpdateNotifier()  # fires on Hello and close events
+        # token -> on_written of frames sent with OP_FRAME_STAMPED, until the shard reports them
+        self.write_tokens = itertools.count()
+        self.write_callbacks = {}
+
+        self.processes = []
+        self.command_conns = []
+        self.command_locks = []
+        self.event_conns = []
+        self.ready = threading.Event()
+        self.ready_shards = set()
+
+        # fork, not spawn: the controller scripts run at import time and must not run again per shard
+        context = multiprocessing.get_context('fork')
+        for shard in range(self.nr_shards):
+            # every shard captures its own connections, into <capture>.<shard>
+            shard_capture = None if capture is None else f"{capture}.{shard}"
+            command_recv, command_send = context.Pipe(duplex=False)
+            event_recv, event_send = context.Pipe(duplex=False)
+            process = context.Process(
+                target=run_shard, name=f"LinkShard-{shard}", daemon=True,
+                args=(shard, host, port, command_recv, event_send, self.start_epoch_raw, log, telemetry_capacity,
+                      retransmit_policy, shard_capture))
+            process.start()
+            command_recv.close()
+            event_send.close()
+            self.processes.append(process)
+            self.command_conns.append(command_send)
+            self.command_locks.append(threading.Lock())
+            self.event_conns.append(event_recv)
+
+        self.start()
+        if not self.ready.wait(SHARD_START_TIMEOUT):
+            safe_error_print(f"Only {len(self.ready_shards)} of {self.nr_shards} shards started")
+        if bus is True or isinstance(bus, str):
+            bus = TelemetryBus(default_bus_name(self.port) if bus is True else bus,
+                               start_epoch_raw=self.start_epoch_raw)
+        self.bus = bus
+
+    def get_server_time(self):
+        return int(time.time() + 0.5) - self.start_epoch
+
+    def get_server_time_raw(self):
+        return time.time() - self.start_epoch_raw
+
+    get_server_time_precise = LinkServer.get_server_time_precise
+
+    def size(self):
+        return len(self.links)
+
+    wait_for_links = LinkServer.wait_for_links
+    wait_for_links_async = LinkServer.wait_for_links_async
+    wait_for_link = LinkServer.wait_for_link
+    wait_for_link_async = LinkServer.wait_for_link_async
+
+    # Same as LinkServer, the proxies route the pre-encoded frames to their shards
+    send_group = LinkServer.send_group
+    group_skew_summary = LinkServer.group_skew_summary
+    clock_report = LinkServer.clock_report
+
+    def shard_sizes(self):
+        sizes = [0] * self.nr_shards
+        for link in list(self.links.values()):
+            sizes[link.shard] += 1
+        return sizes
+
+    # The proxy of a link that closed less than SESSION_TTL ago, None otherwise
+    def take_session(self, device_id):
+        link, closed_time = self.sessions.pop(device_id, (None, None))
+        if link is None or time.monotonic() - closed_time > SESSION_TTL:
+            return None
+        return link
+
+    # Called from any controller thread, a pipe is not safe for concurrent writers
+    def send_command(self, shard, op, device_id, payload=b''):
+        message = bytes((op, device_id)) + bytes(payload)
+        try:
+            with self.command_locks[shard]:
+                self.command_conns[shard].send_bytes(message)
+            return True
+        except OSError:
+            return False
+
+    def run(self):
+        conns = list(self.event_conns)
+        while conns:
+            for conn in multiprocessing.connection.wait(conns):
+                try:
+                    event = conn.recv()
+                except (EOFError, OSError):
+                    conns.remove(conn)
+                    continue
+                self.handle_event(event)
+        self.__is__running__ = False
+
+    def handle_event(self, event):
+        kind, shard = event[0], event[1]
+        if kind == 'state':
+            for device_id, (state, telemetry) in event[2].items():
+                link = self.links.get(device_id)
+                # a connection that was taken over by another shard may still report for a moment
+                if link is not None and link.shard == shard:
+                    with self.state.lock:  # a snapshot sees all fields of a batch or none
+                        for name, value in zip(STATE_FIELDS, state):
+                            setattr(link, name, value)
+                    rows = np.frombuffer(telemetry, dtype=TELEMETRY_DTYPE) if telemetry else None
+                    if rows is not None and link.telemetry is not None:
+                        link.telemetry.extend(rows)
+                    if self.bus is not None:
+                        self.bus.publish(device_id, self.state.rows[link.state_row], rows)
+                    # once per batch: the proxy only sees the shard's latest state
+                    link.completions.update(link.executing_command_checksum, link.srv0_pos, link.srv1_pos,
+                                            self.get_server_time_raw())
+                    link.updates.notify()
+
+        elif kind == 'hello':
+            device_id, max_vel = event[2], event[3]
+            link = self.links.get(device_id)
+            if link is None:
+                link = self.take_session(device_id)
+                if link is None:
+                    link = ShardLink(self, device_id, shard, max_vel)
+                elif link.shard != shard and link.last_sent_frame is not None and link.last_sent_frame[1] != ord('T'):
+                    # the new shard doesn't know the command in force (the old one resumes it itself)
+                    self.send_command(shard, OP_FRAME, device_id, link.last_sent_frame)
+                link.shard = shard
+                link.MAX_VEL = max_vel
+                link.__is__running__ = True
+                self.links[device_id] = link
+                self.state.register(link.state_row, device_id)
+            else:
+                if link.shard != shard:
+                    safe_print("Overwriting existing link " + str(device_id) + " on shard " + str(link.shard))
+                    self.send_command(link.shard, OP_CLOSE, device_id)
+                link.shard = shard
+                link.MAX_VEL = max_vel
+                link.__is__running__ = True
+            self.newest = link
+            if self.bus is not None:
+                self.bus.publish(device_id, self.state.rows[link.state_row])
+            safe_print("P" + str(device_id) + " said Hello on shard " + str(shard) + ". Total is " + str(self.size()))
+            self.link_events.notify()
+
+        elif kind == 'closed':
+            device_id = event[2]
+            link = self.links.get(device_id)
+            # ignore the close of a connection that was already taken over by another shard
+            if link is not None and link.shard == shard:
+                link.__is__running__ = False
+                self.links.pop(device_id)
+                self.state.unregister(link.state_row)
+                if self.bus is not None:
+                    self.bus.deactivate(device_id)
+                # kept for a reconnect, so controllers holding the proxy keep working
+                self.sessions[device_id] = (link, time.monotonic())
+                self.link_events.notify()
+                link.completions.close(self.get_server_time_raw())
+                link.updates.notify()
+
+        elif kind == 'written':
+            on_written = self.write_callbacks.pop(event[2], None)
+            if on_written is not None:
+                on_written(event[3])
+
+        elif kind == 'ready':
+            port = event[2]
+            if not self.ready_shards:
+                self.port = port
+            elif port != self.port:
+                safe_error_print(f"Shard {shard} bound port {port} instead of {self.port}")
+            self.ready_shards.add(shard)
+            if len(self.ready_shards) == self.nr_shards:
+                self.ready.set()
+
+    def close_server(self):
+        self.__is__running__ = False
+        for shard in range(self.nr_shards):
+            self.send_command(shard, OP_QUIT, 0)
+        for process in self.processes:
+            process.join(2)
+            if process.is_alive():
+                process.terminate()
+        for conn in self.command_conns:
+            conn.close()
+        for link in list(self.links.values()):
+            link.__is__running__ = False
+            link.completions.close(self.get_server_time_raw())
+            link.updates.notify()
+        self.links.clear()
+        self.link_events.notify()
+        for token in list(self.write_callbacks):
+            on_written = self.write_callbacks.pop(token, None)
+            if on_written is not None:
+                on_written(None)
+        if self.bus is not None:
+            self.bus.close()
+        safe_print("Closed all links... Server has been closed.")
+
+
+def get_default_server(log=False, nr_shards=None):
+    return ShardedLinkServer(DEFAULT_HOST, DEFAULT_PORT, nr_shards, log)
@@ -0,0 +1,74 @@
+# Notifications instead of polling: a controller waits on an UpdateNotifier and is woken by the
+# link thread (or event loop) that handled the package, instead of finding out on its next sleep.
+# Every link has one that fires on each 'U' package and every server one that fires when a link
+# says Hello or closes:
+#
+#   server.wait_for_links(4, timeout=30)                         # True once 4 links are connected
+#   link.wait_for_update(lambda link: link.executing_command_checksum == checksum, timeout=2)
+#   await link.wait_for_update_async(timeout=1)                  # same from a coroutine
+#
+# Threads wait on a threading.Condition. Coroutines can wait on any event loop, including the
+# AsyncLinkServer's: each one parks a future that notify() resolves with call_soon_threadsafe.
+# Predicates are evaluated under the notifier's lock, they should only read attributes.
+
+import asyncio
+import threading
+import time
+
+
+class UpdateNotifier:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.count = 0  # notifications so far
+        self.futures = set()  # futures of waiting coroutines
+
+    def notify(self):
+        with self.condition:
+            self.count += 1
+            self.condition.notify_all()
+            if self.futures:
+                futures, self.futures = self.futures, set()
+                for future in futures:
+                    future.get_loop().call_soon_threadsafe(wake, future)
+
+    # Blocks until predicate() is true, rechecking it on every notification. Without predicate it
+    # waits for the next notification. Returns the last value of predicate (False on timeout).
+    def wait_for(self, predicate=None, timeout=None):
+        with self.condition:
+            if predicate is None:
+                count = self.count
+                return self.condition.wait_for(lambda: self.count != count, timeout)
+            return self.condition.wait_for(predicate, timeout)
+
+    async def wait_for_async(self, predicate=None, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            count = self.count
+        while True:
+            with self.condition:
+                result = predicate() if predicate is not None else self.count != count
+                if result:
+                    return result
+                future = loop.create_future()
+                self.futures.add(future)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self.discard(future)
+                return result
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                self.discard(future)
+                with self.condition:
+                    return predicate() if predicate is not None else self.count != count
+
+    def discard(self, future):
+        with self.condition:
+            self.futures.discard(future)
+
+
+def wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,361 @@
+# TCP proxy that impairs the traffic between links (real or emulated) and a LinkServer, for tuning
+# retransmission, timeouts and gait timing without the lab network. Plain asyncio on localhost, no
+# root or tc/netem needed. Per direction (up: link -> server, down: server -> link) an Impairment
+# sets:
+#   latency, jitter, distribution  delay of every chunk: constant, uniform (latency +- jitter),
+#                                  normal (sd jitter) or exponential (latency + mean jitter)
+#   bandwidth                      bytes per second, chunks queue behind each other
+#   corrupt                        probability per byte of one flipped bit (the framer's CRC check
+#                                  should catch and resync on them)
+#   reset_rate                     connection resets per connection per second (RST both ways)
+# Like TCP, a direction never reorders: a chunk is delivered after the previous one even when its
+# own delay is shorter.
+#
+# Everything injected (connects, resets, corrupted bytes, optionally every delay) is appended to a
+# JSON lines log with wall clock and monotonic time, to line up with the server's metrics.
+#
+# The links connect to the proxy, so with real links the proxy takes the usual port 54657 and the
+# server is started on another one (LinkServer(host, 54658)):
+#
+#   python linkproxy.py --listen-port 54657 --server-port 54658 --latency 0.05 --jitter 0.02 \
+#       --bandwidth 20000 --corrupt 1e-4 --reset-rate 0.01 --log proxy.jsonl
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from linkstats import Histogram
+
+DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'exponential')
+
+
+class Impairment:
+
+    def __init__(self, latency=0.0, jitter=0.0, distribution='normal', bandwidth=None, corrupt=0.0, reset_rate=0.0):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown distribution {distribution}")
+        self.latency = latency  # seconds
+        self.jitter = jitter  # seconds
+        self.distribution = distribution
+        self.bandwidth = bandwidth  # bytes per second, None is unlimited
+        self.corrupt = corrupt
+        self.reset_rate = reset_rate
+
+    def delay(self, rng):
+        if not self.jitter or self.distribution == 'constant':
+            return self.latency
+        if self.distribution == 'uniform':
+            delay = self.latency + rng.uniform(-self.jitter, self.jitter)
+        elif self.distribution == 'normal':
+            delay = rng.gauss(self.latency, self.jitter)
+        else:
+            delay = self.latency + rng.expovariate(1 / self.jitter)
+        return max(0.0, delay)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+NO_IMPAIRMENT = Impairment()
+
+
+class ImpairmentLog:
+
+    # JSON lines, one per injected event
+
+    def __init__(self, path=None, log_delays=False):
+        self.file = open(path, 'a') if path else None
+        self.log_delays = log_delays
+
+    def write(self, event, **fields):
+        if self.file is None:
+            return
+        fields.update(event=event, time=time.time(), monotonic=time.monotonic())
+        self.file.write(json.dumps(fields) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ImpairedPipe:
+
+    # One direction of one connection: delays, rate limits and corrupts what is fed in, then writes
+    # it to the other side's transport in order
+
+    def __init__(self, proxy, connection, direction, impairment):
+        self.proxy = proxy
+        self.connection = connection
+        self.direction = direction
+        self.impairment = impairment
+        self.rng = random.Random(proxy.rng.random())
+        self.transport = None  # set once the other side is connected
+        self.pending = deque()  # (delivery time, data)
+        self.handle = None
+        self.next_free = 0.0  # end of the last delivery (order and bandwidth)
+        self.closing = False
+        self.stats = {'bytes': 0, 'chunks': 0, 'corrupted_bytes': 0}
+        self.delays = Histogram()
+
+    def feed(self, data):
+        loop = self.proxy.loop
+        now = loop.time()
+        impairment = self.impairment
+        if impairment.corrupt:
+            data = self.corrupt(data)
+        delay = impairment.delay(self.rng)
+        when = max(now + delay, self.next_free)
+        if impairment.bandwidth:
+            when += len(data) / impairment.bandwidth
+        self.next_free = when
+        self.delays.record(when - now)
+        self.stats['bytes'] += len(data)
+        self.stats['chunks'] += 1
+        if self.proxy.log.log_delays:
+            self.proxy.log.write('delay', connection=self.connection.id, direction=self.direction,
+                                 bytes=len(data), delay=when - now)
+        self.pending.append((when, data))
+        if self.handle is None:
+            self.handle = loop.call_at(when, self.deliver)
+
+    def corrupt(self, data):
+        p = self.impairment.corrupt
+        # geometric jumps between corrupted bytes instead of a random number per byte
+        index = int(math.log(1 - self.rng.random()) / math.log(1 - p)) if p < 1 else 0
+        if index >= len(data):
+            return data
+        data = bytearray(data)
+        while index < len(data):
+            bit = self.rng.randrange(8)
+            data[index] ^= 1 << bit
+            self.stats['corrupted_bytes'] += 1
+            self.proxy.log.write('corrupt', connection=self.connection.id, direction=self.direction,
+                                 offset=self.stats['bytes'] + index, bit=bit)
+            index += 1 + (int(math.log(1 - self.rng.random()) / math.log(1 - p)) if p < 1 else 0)
+        return bytes(data)
+
+    def deliver(self):
+        self.handle = None
+        now = self.proxy.loop.time()
+        while self.pending and self.pending[0][0] <= now:
+            data = self.pending.popleft()[1]
+            if self.transport is not None and not self.transport.is_closing():
+                self.transport.write(data)
+        if self.pending:
+            self.handle = self.proxy.loop.call_at(self.pending[0][0], self.deliver)
+        elif self.closing and self.transport is not None:
+            self.transport.close()
+
+    # Closes the other side once everything pending is delivered
+    def close(self):
+        self.closing = True
+        if not self.pending and self.transport is not None:
+            self.transport.close()
+
+    def abort(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.pending.clear()
+
+
+class SideProtocol(asyncio.Protocol):
+
+    # One socket of a proxied connection, feeds what it reads into a pipe
+
+    def __init__(self, connection, pipe):
+        self.connection = connection
+        self.pipe = pipe
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self is self.connection.link_side:
+            self.connection.proxy.loop.create_task(self.connection.start())
+
+    def data_received(self, data):
+        self.pipe.feed(data)
+
+    def eof_received(self):
+        self.pipe.close()
+        return False
+
+    def connection_lost(self, exc):
+        self.pipe.close()
+        self.connection.side_lost(self)
+
+
+class ProxyConnection:
+
+    def __init__(self, proxy, connection_id):
+        self.proxy = proxy
+        self.id = connection_id
+        self.up = ImpairedPipe(proxy, self, 'up', proxy.up)
+        self.down = ImpairedPipe(proxy, self, 'down', proxy.down)
+        self.link_side = SideProtocol(self, self.up)
+        self.server_side = SideProtocol(self, self.down)
+        self.reset_handle = None
+        self.open = True
+
+    async def start(self):
+        loop = self.proxy.loop
+        link_transport = self.link_side.transport
+        link_transport.pause_reading()
+        try:
+            server_transport, _ = await loop.create_connection(
+                lambda: self.server_side, self.proxy.server_host, self.proxy.server_port)
+        except OSError as e:
+            self.proxy.log.write('upstream_failed', connection=self.id, error=str(e))
+            link_transport.close()
+            return
+        server_transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.up.transport = server_transport
+        self.down.transport = link_transport
+        link_transport.resume_reading()
+
+        rate = max(self.proxy.up.reset_rate, self.proxy.down.reset_rate)
+        if rate:
+            self.reset_handle = loop.call_later(self.up.rng.expovariate(rate), self.reset)
+
+    # RST on both sockets, like a connection killed by the network
+    def reset(self):
+        self.reset_handle = None
+        if not self.open:
+            return
+        self.proxy.stats['resets'] += 1
+        self.proxy.log.write('reset', connection=self.id)
+        for pipe in (self.up, self.down):
+            pipe.abort()
+        for side in (self.link_side, self.server_side):
+            transport = side.transport
+            if transport is not None and not transport.is_closing():
+                sock = transport.get_extra_info('socket')
+                if sock is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                transport.abort()
+
+    def side_lost(self, side):
+        if not self.open:
+            return
+        self.open = False
+        if self.reset_handle is not None:
+            self.reset_handle.cancel()
+        self.proxy.connections.discard(self)
+        self.proxy.log.write('closed', connection=self.id, up=self.up.stats, down=self.down.stats)
+        self.proxy.up_delays.merge(self.up.delays)
+        self.proxy.down_delays.merge(self.down.delays)
+
+
+class LinkProxy:
+
+    def __init__(self, listen_host='127.0.0.1', listen_port=54657, server_host='127.0.0.1', server_port=54658,
+                 up=NO_IMPAIRMENT, down=NO_IMPAIRMENT, log=None, log_delays=False, seed=None):
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.server_host = server_host
+        self.server_port = server_port
+        self.up = up
+        self.down = down
+        self.rng = random.Random(seed)
+        self.log = ImpairmentLog(log, log_delays)
+        self.loop = None
+        self.server = None
+        self.connections = set()
+        self.next_id = 0
+        self.stats = {'connections': 0, 'resets': 0}
+        self.up_delays = Histogram()  # of closed connections
+        self.down_delays = Histogram()
+        self.ready = threading.Event()
+        self.thread = None
+
+    def accept(self):
+        connection = ProxyConnection(self, self.next_id)
+        self.next_id += 1
+        self.stats['connections'] += 1
+        self.connections.add(connection)
+        self.log.write('connect', connection=connection.id)
+        return connection.link_side
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await self.loop.create_server(self.accept, self.listen_host, self.listen_port,
+                                                    reuse_address=True)
+        self.listen_port = self.server.sockets[0].getsockname()[1]
+        self.log.write('start', listen_port=self.listen_port, server_port=self.server_port,
+                       up=self.up.to_dict(), down=self.down.to_dict())
+        self.ready.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.log.write('stop', **self.stats)
+            self.log.close()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def start_thread(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def close(self):
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        def stop():
+            self.server.close()
+            for connection in list(self.connections):
+                for side in (connection.link_side, connection.server_side):
+                    if side.transport is not None:
+                        side.transport.abort()
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+
+        self.loop.call_soon_threadsafe(stop)
+        if self.thread is not None:
+            self.thread.join()
+
+    def summary(self):
+        return dict(self.stats, up_delay=self.up_delays.summary(), down_delay=self.down_delays.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--listen-host', default='127.0.0.1')
+    parser.add_argument('--listen-port', type=int, default=54657)
+    parser.add_argument('--server-host', default='127.0.0.1')
+    parser.add_argument('--server-port', type=int, default=54658)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds, each direction")
+    parser.add_argument('--jitter', type=float, default=0.0, help="seconds")
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='normal')
+    parser.add_argument('--bandwidth', type=float, default=None, help="bytes per second, each direction")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="probability per byte")
+    parser.add_argument('--reset-rate', type=float, default=0.0, help="resets per connection per second")
+    parser.add_argument('--direction', choices=('both', 'up', 'down'), default='both',
+                        help="up is link -> server, down is server -> link")
+    parser.add_argument('--log', default=None, help="JSON lines file of the injected events")
+    parser.add_argument('--log-delays', action='store_true', help="also log the delay of every chunk")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    impairment = Impairment(args.latency, args.jitter, args.distribution, args.bandwidth, args.corrupt, args.reset_rate)
+    up = impairment if args.direction in ('both', 'up') else NO_IMPAIRMENT
+    down = impairment if args.direction in ('both', 'down') else NO_IMPAIRMENT
+    proxy = LinkProxy(args.listen_host, args.listen_port, args.server_host, args.server_port, up, down,
+                      args.log, args.log_delays, args.seed)
+    print(f"Proxying {args.listen_host}:{args.listen_port} -> {args.server_host}:{args.server_port}")
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,193 @@
+# Retransmission of the last command when a link reports a different executing_command_checksum.
+# Every 'U' package of a link that hasn't got the command yet used to trigger a resend; with many
+# links reporting at high rate on a congested network that floods the air with duplicates exactly
+# when bandwidth is scarce. A RetransmitPolicy limits this: a minimum interval after the send,
+# exponential backoff between retries (capped at max_interval), an optional maximum number of
+# retries after which the link is given up on until the next command, and optional jitter so links
+# that lost the same burst don't retry in lockstep.
+#
+# Each link has a Retransmitter (link.retransmitter) with its counters: retransmits, give_ups and
+# the latency from sending a command until the first 'U' package reporting it as executing
+# (linkstats.CommandLatency, also recorded into the server's fleet wide one).
+#
+# Sessions (command sends and reported checksums of a link) can be recorded and replayed offline
+# against other policies to compare them:
+#
+#   link.retransmitter.start_recording()
+#   ...
+#   save_sessions('session.jsonl', server.links.values())
+#   python linkretransmit.py session.jsonl
+
+import json
+import random
+import threading
+
+from linkstats import CommandLatency
+
+
+class RetransmitPolicy:
+
+    def __init__(self, min_interval=0.1, backoff=2.0, max_interval=2.0, max_retries=None, jitter=0.0, seed=None):
+        self.min_interval = min_interval  # seconds after a (re)send before the next retry
+        self.backoff = backoff  # interval multiplier per retry
+        self.max_interval = max_interval
+        self.max_retries = max_retries  # None retries forever
+        self.jitter = jitter  # +- fraction of the interval
+        self.rng = random.Random(seed)
+
+    def interval(self, retries):
+        interval = min(self.max_interval, self.min_interval * self.backoff ** retries)
+        if self.jitter:
+            interval *= 1 + self.jitter * self.rng.uniform(-1, 1)
+        return interval
+
+    def __repr__(self):
+        return (f"RetransmitPolicy(min_interval={self.min_interval}, backoff={self.backoff}, "
+                f"max_interval={self.max_interval}, max_retries={self.max_retries}, jitter={self.jitter})")
+
+
+# The old behaviour: resend on every mismatching 'U' package
+IMMEDIATE_POLICY = RetransmitPolicy(min_interval=0, backoff=1, max_interval=0)
+DEFAULT_POLICY = RetransmitPolicy()
+
+
+class Retransmitter:
+
+    # Retransmission state of one link. Times are seconds on any monotonic clock (the links use
+    # server time).
+
+    def __init__(self, policy=None, fleet_latency=None):
+        self.policy = policy or DEFAULT_POLICY
+        self.fleet_latency = fleet_latency
+        self.lock = threading.Lock()
+        self.checksum = None
+        self.sent_time = None
+        self.next_time = None
+        self.retries = 0
+        self.converged = True
+        self.gave_up = False
+
+        self.retransmits = 0
+        self.give_ups = 0
+        self.latency = CommandLatency()
+        self.last_converge_time = None
+
+        self.recording = None  # list of events while recording
+
+    # A new command was sent
+    def command_sent(self, checksum, now):
+        with self.lock:
+            if not self.converged:
+                self.latency.record_superseded()
+                if self.fleet_latency is not None:
+                    self.fleet_latency.record_superseded()
+            self.checksum = checksum
+            self.sent_time = now
+            self.retries = 0
+            self.next_time = now + self.policy.interval(0)
+            self.converged = False
+            self.gave_up = False
+            if self.recording is not None:
+                self.recording.append(('C', now, checksum))
+
+    # A 'U' package reported executing; returns whether the last command should be resent now
+    def on_update(self, executing, now):
+        with self.lock:
+            if self.recording is not None:
+                self.recording.append(('U', now, executing))
+            if self.checksum is None:
+                return False
+            if executing == self.checksum:
+                if not self.converged:
+                    self.converged = True
+                    self.last_converge_time = now - self.sent_time
+                    self.latency.record(self.last_converge_time, self.retries)
+                    if self.fleet_latency is not None:
+                        self.fleet_latency.record(self.last_converge_time, self.retries)
+                return False
+            if self.gave_up or now < self.next_time:
+                return False
+            if self.policy.max_retries is not None and self.retries >= self.policy.max_retries:
+                self.gave_up = True
+                self.give_ups += 1
+                return False
+            self.retries += 1
+            self.retransmits += 1
+            self.next_time = now + self.policy.interval(self.retries)
+            return True
+
+    def stats(self):
+        return {
+            'retransmits': self.retransmits,
+            'give_ups': self.give_ups,
+            'converged': self.converged,
+            'last_converge_time': self.last_converge_time,
+            'latency': self.latency.summary(),
+        }
+
+    def start_recording(self):
+        with self.lock:
+            self.recording = []
+            if self.checksum is not None:
+                # the command in force, so the replay knows what the first reports are compared to
+                self.recording.append(('C', self.sent_time, self.checksum))
+
+    def stop_recording(self):
+        with self.lock:
+            recording, self.recording = self.recording or [], None
+            return recording
+
+
+# One JSON line per link: {"device_id": .., "events": [[kind, time, checksum], ...]}
+def save_sessions(path, links):
+    with open(path, 'w') as f:
+        for link in links:
+            events = link.retransmitter.recording or []
+            f.write(json.dumps({'device_id': link.device_id, 'events': events}) + '\n')
+
+
+def load_sessions(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Replays the recorded sessions against a policy. The link's reports are taken as recorded (a
+# replay can't know if an earlier retry would have made it converge earlier), so this compares
+# how many duplicates each policy would have sent and how often it would have given up before
+# the link converged; convergence times are the recorded ones.
+def replay(policy, sessions):
+    total = {'policy': repr(policy), 'commands': 0, 'retransmits': 0, 'give_ups': 0}
+    latency = CommandLatency()
+    for session in sessions:
+        retransmitter = Retransmitter(policy)
+        for kind, now, checksum in session['events']:
+            if kind == 'C':
+                retransmitter.command_sent(checksum, now)
+                total['commands'] += 1
+            else:
+                retransmitter.on_update(checksum, now)
+        total['retransmits'] += retransmitter.retransmits
+        total['give_ups'] += retransmitter.give_ups
+        latency.merge(retransmitter.latency)
+    total['converge_time'] = latency.histogram.summary()
+    return total
+
+
+def compare_policies(sessions, policies):
+    return [replay(policy, sessions) for policy in policies]
+
+
+if __name__ == '__main__':
+    import sys
+
+    sessions = load_sessions(sys.argv[1])
+    policies = [
+        IMMEDIATE_POLICY,
+        RetransmitPolicy(min_interval=0.05, backoff=1.5, max_interval=1.0),
+        DEFAULT_POLICY,
+        RetransmitPolicy(min_interval=0.2, backoff=2.0, max_interval=5.0, max_retries=10, jitter=0.2, seed=0),
+    ]
+    for result in compare_policies(sessions, policies):
+        print(result['policy'])
+        print(f"  commands {result['commands']}, retransmits {result['retransmits']}, give ups {result['give_ups']}, "
+              f"converge p50 {result['converge_time']['p50']}, p99 {result['converge_time']['p99']}")
@@ -0,0 +1,243 @@
+# Compares the threaded LinkServer with the asyncio AsyncLinkServer: server process CPU and
+# command -> telemetry confirmation latency with N emulated links streaming 'U' packages.
+#
+#   python linkserver_benchmark.py --links 10 100 250 --rate 20 --duration 10
+#
+# The emulated links (linkemulator.FleetEmulator) run in a child process. They echo the checksum of
+# the last package they received as executing_command_checksum, immediately and then at --rate Hz.
+# device_id is one byte in the Hello package, so at most 256 links can be connected at once.
+#
+#   python linkserver_benchmark.py --recovery
+#
+# measures how fast a link that dropped off the network is detected and gets its command back
+# after it reconnects (session resumption).
+#
+#   python linkserver_benchmark.py --telemetry-age --loss 0.02
+#
+# compares the age of the 'U' packages when the server handles them (send time on the emulated
+# link to handle_package) over TCP and over UDP (linkudp), with --loss of the frames lost and,
+# on TCP, retransmitted after --rto seconds.
+
+import argparse
+import random
+import numpy as np
+import socket
+import threading
+import time
+
+import linknetworking
+import linknetworking_async
+from linknetworking import LinkBase
+from linkemulator import FleetEmulator, FaultProfile, make_frame
+from rmlprotocol import FOOTER_STRUCT, FOOTER_LENGTH, StreamFramer
+
+
+def measure(server_class, port, nr_links, rate, duration, command_rate=100):
+    server = server_class('127.0.0.1', port)
+    emulator = FleetEmulator('127.0.0.1', server.port, nr_links, rate)
+    emulator.start_process()
+
+    server.wait_for_links(nr_links)
+    time.sleep(1)
+
+    pending = {}
+    latencies = []
+    handle_package = LinkBase.handle_package
+
+    def timed_handle_package(link, package, package_type):
+        handle_package(link, package, package_type)
+        sent = pending.get(link.device_id)
+        if sent is not None and package_type == "U" and package[8] == sent[0]:
+            latencies.append(time.perf_counter() - sent[1])
+            del pending[link.device_id]
+
+    LinkBase.handle_package = timed_handle_package
+    stop = threading.Event()
+
+    def send_commands():
+        rng = random.Random(0)
+        while not stop.wait(1 / command_rate):
+            device_id = rng.randrange(nr_links)
+            link = server.links.get(device_id)
+            if link is None or device_id in pending:
+                continue
+            pos = rng.randrange(22, 101)
+            t = time.perf_counter()
+            link.send_position_only(pos, pos)
+            pending[device_id] = (link.current_command_checksum, t)
+
+    commander = threading.Thread(target=send_commands, daemon=True)
+    cpu, wall = time.process_time(), time.perf_counter()
+    commander.start()
+    time.sleep(duration)
+    stop.set()
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    commander.join()
+    LinkBase.handle_package = handle_package
+
+    emulator.close()
+    server.close_server()
+    time.sleep(0.5)
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e3 if latencies else float('nan')
+    return {
+        'cpu_percent': 100 * cpu / wall,
+        'threads': threading.active_count(),
+        'commands': len(latencies),
+        'p50_ms': pct(0.5),
+        'p99_ms': pct(0.99),
+    }
+
+
+# One emulated link that drops off the network (stops sending, no FIN) for `outage` seconds and
+# then reconnects with a new connection. Returns (seconds until the server closed the silent
+# connection or None, seconds from the new Hello until the resumed command arrived).
+def measure_recovery(server_class, port, outage, rate=20):
+    server = server_class('127.0.0.1', port)
+    time.sleep(0.3)
+    update = lambda checksum: make_frame(b'U', b'R', 50, 50, 0, 0, 90, 100, 100, checksum)
+
+    def stream(sock, until):
+        framer = StreamFramer()
+        checksum = 0
+        sock.settimeout(1 / rate)
+        while time.perf_counter() < until:
+            sock.sendall(update(checksum))
+            try:
+                framer.recv_from(sock)
+            except socket.timeout:
+                continue
+            frame = framer.next_frame()
+            while frame is not None:
+                checksum = FOOTER_STRUCT.unpack_from(frame, len(frame) - FOOTER_LENGTH)[0]
+                frame = framer.next_frame()
+
+    old = socket.create_connection(('127.0.0.1', server.port))
+    old.sendall(make_frame(b'H', 7, 100))
+    time.sleep(0.1)
+    server.links[7].send_position_only(60, 70)
+    stream(old, time.perf_counter() + 2)
+
+    # outage: the old connection goes silent, the server may or may not notice before the reconnect
+    silent = time.perf_counter()
+    old.settimeout(outage)
+    try:
+        detected = time.perf_counter() - silent if old.recv(4096) == b'' else None
+    except (socket.timeout, ConnectionResetError):
+        detected = None
+    remaining = outage - (time.perf_counter() - silent)
+    if remaining > 0:
+        time.sleep(remaining)
+
+    new = socket.create_connection(('127.0.0.1', server.port))
+    hello = time.perf_counter()
+    new.sendall(make_frame(b'H', 7, 100))
+    framer = StreamFramer()
+    new.settimeout(2)
+    resumed = None
+    while resumed is None:
+        framer.recv_from(new)
+        frame = framer.next_frame()
+        while frame is not None:
+            if frame[1] == ord('P'):
+                resumed = time.perf_counter() - hello
+            frame = framer.next_frame()
+
+    old.close()
+    new.close()
+    server.close_server()
+    time.sleep(0.5)
+    return detected, resumed
+
+
+# Age of every 'U' package the server handled, in seconds. The emulator runs in this process so
+# its send times can be matched: by order on TCP, which delivers everything in order, by sequence
+# number on UDP.
+def measure_telemetry_age(server_class, port, nr_links, rate, duration, udp, loss, rto=0.2):
+    ages = []
+    received = {}
+    handle_package = LinkBase.handle_package
+    emulator = None
+
+    def timed_handle_package(link, package, package_type):
+        handle_package(link, package, package_type)
+        if package_type == "U":
+            now = time.perf_counter()
+            index = link.udp_sequence if udp else received.get(link.device_id, 0)
+            received[link.device_id] = received.get(link.device_id, 0) + 1
+            sent = emulator.links[link.device_id].update_times
+            if index < len(sent):
+                ages.append(now - sent[index])
+
+    LinkBase.handle_package = timed_handle_package
+    server = server_class('127.0.0.1', port, udp_port=True if udp else None)
+    faults = FaultProfile(loss=loss, rto=rto, seed=1)
+    emulator = FleetEmulator('127.0.0.1', server.port, nr_links, rate, faults,
+                             udp_port=server.udp_port if udp else None, record_updates=True)
+    emulator.start_thread()
+    time.sleep(duration)
+    LinkBase.handle_package = handle_package
+    generated = sum(len(link.update_times) for link in emulator.links)
+    udp_stats = server.udp_stats()
+    emulator.close()
+    server.close_server()
+    time.sleep(0.5)
+
+    ages = np.array(ages) * 1e3
+    return {
+        'received_percent': 100 * sum(received.values()) / max(generated, 1),
+        'p50_ms': np.percentile(ages, 50),
+        'p99_ms': np.percentile(ages, 99),
+        'max_ms': ages.max(),
+        'udp': udp_stats,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--links', type=int, nargs='+', default=[10, 100, 250])
+    parser.add_argument('--rate', type=float, default=20, help="'U' packages per second per link")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=linknetworking.DEFAULT_PORT + 100)
+    parser.add_argument('--recovery', action='store_true', help="measure recovery from a dropped link instead")
+    parser.add_argument('--telemetry-age', action='store_true', help="compare telemetry age over TCP and UDP instead")
+    parser.add_argument('--loss', type=float, default=0.02, help="fraction of frames lost, with --telemetry-age")
+    parser.add_argument('--rto', type=float, default=0.2, help="TCP retransmission timeout, with --telemetry-age")
+    args = parser.parse_args()
+
+    linknetworking.DEBUG = False
+    servers = [('threaded', linknetworking.LinkServer), ('asyncio', linknetworking_async.AsyncLinkServer)]
+
+    if args.recovery:
+        print(f"{'server':>9} {'outage s':>9} {'detected s':>11} {'resumed ms':>11}")
+        port = args.port
+        for outage in (0.3, 3):
+            for name, server_class in servers:
+                detected, resumed = measure_recovery(server_class, port, outage, args.rate)
+                port += 1
+                detected = f"{detected:.2f}" if detected is not None else '-'
+                print(f"{name:>9} {outage:>9} {detected:>11} {resumed * 1e3:>11.2f}")
+        raise SystemExit
+
+    if args.telemetry_age:
+        print(f"{'server':>9} {'links':>6} {'transport':>10} {'received %':>11} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        port = args.port
+        for nr_links in args.links:
+            for name, server_class in servers:
+                for transport in ('tcp', 'udp'):
+                    result = measure_telemetry_age(server_class, port, nr_links, args.rate, args.duration,
+                                                   transport == 'udp', args.loss, args.rto)
+                    port += 1
+                    print(f"{name:>9} {nr_links:>6} {transport:>10} {result['received_percent']:>11.1f} "
+                          f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['max_ms']:>8.1f}")
+        raise SystemExit
+
+    print(f"{'server':>9} {'links':>6} {'cpu %':>7} {'p50 ms':>8} {'p99 ms':>8} {'confirmed':>10}")
+    port = args.port
+    for nr_links in args.links:
+        for name, server_class in servers:
+            result = measure(server_class, port, nr_links, args.rate, args.duration)
+            port += 1
+            print(f"{name:>9} {nr_links:>6} {result['cpu_percent']:>7.1f} {result['p50_ms']:>8.2f} "
+                  f"{result['p99_ms']:>8.2f} {result['commands']:>10}")
@@ -0,0 +1,142 @@
+# Server wide link state as one structured NumPy table, one row per link object. The link
+# attributes listed in STATE_FIELDS (srv0_pos, bat_status, executing_command_checksum, ...) are
+# views onto the link's row (StateField descriptors on LinkBase), so existing code reading and
+# writing them keeps working, while bulk readers (dashboard, controllers) take one consistent
+# snapshot() of every link instead of reading attributes link by link.
+#
+# Numeric fields hold NONE where the attribute is None (e.g. before the first 'U' package),
+# device_status holds b'' for None. Reading through a link converts back to Python values.
+#
+# Rows are taken when a link object is created and only given back when it is garbage collected,
+# so a closed link that a controller still holds never shows another link's data. register()
+# marks the row active and indexes it by device_id once the link said Hello.
+#
+#   state = server.state.snapshot()        # copy of the active rows
+#   state['srv0_pos'][state['device_id'] == 3]
+#   server.state.index[3]                  # device_id -> row of the table
+
+import threading
+import weakref
+import numpy as np
+
+NONE = -2 ** 31
+
+# Fields written by one 'U' package, in package order (bat_status shifted like the attribute)
+UPDATE_FIELDS = ('device_status', 'srv0_pos', 'srv1_pos', 'srv0_raw', 'srv1_raw', 'bat_status',
+                 'srv0_vel', 'srv1_vel', 'executing_command_checksum')
+
+STATE_FIELDS = UPDATE_FIELDS + ('MAX_VEL', 'current_command_checksum',
+                                'srv0_min_ms', 'srv0_max_ms', 'srv1_min_ms', 'srv1_max_ms',
+                                'srv0_raw_min', 'srv0_raw_max', 'srv1_raw_min', 'srv1_raw_max')
+
+STATE_DTYPE = np.dtype(
+    [('device_id', '<i4'), ('active', '?'), ('update_time', '<f8'), ('device_status', 'S1')]
+    + [(name, '<i4') for name in STATE_FIELDS[1:]])
+
+INITIAL_CAPACITY = 256
+
+
+def empty_row():
+    row = np.zeros((), dtype=STATE_DTYPE)
+    for name in STATE_FIELDS[1:]:
+        row[name] = NONE
+    row['device_id'] = NONE
+    return row
+
+
+class LinkStateTable:
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.lock = threading.RLock()
+        self.empty = empty_row()
+        self.rows = np.empty(capacity, dtype=STATE_DTYPE)
+        self.rows[:] = self.empty
+        self.size = 0  # rows ever handed out, the table is rows[:size]
+        self.free = []
+        self.index = {}  # device_id -> row of the registered link
+
+    # A row for a new link object, given back when the object is garbage collected
+    def allocate(self, link):
+        with self.lock:
+            if self.free:
+                row = self.free.pop()
+            else:
+                if self.size == len(self.rows):
+                    rows = np.empty(2 * len(self.rows), dtype=STATE_DTYPE)
+                    rows[:self.size] = self.rows
+                    rows[self.size:] = self.empty
+                    self.rows = rows
+                row = self.size
+                self.size += 1
+            self.rows[row] = self.empty
+        weakref.finalize(link, self.release, row)
+        return row
+
+    def release(self, row):
+        with self.lock:
+            self.unregister(row)
+            self.rows[row] = self.empty
+            self.free.append(row)
+
+    def register(self, row, device_id):
+        with self.lock:
+            self.rows['device_id'][row] = device_id
+            self.rows['active'][row] = True
+            self.index[device_id] = row
+
+    # Inactive, but keeps its values (the link object may still be read)
+    def unregister(self, row):
+        with self.lock:
+            self.rows['active'][row] = False
+            device_id = int(self.rows['device_id'][row])
+            if self.index.get(device_id) == row:
+                del self.index[device_id]
+
+    def get(self, row, name):
+        value = self.rows[name][row]
+        if name == 'device_status':
+            return value.decode("ASCII") if value else None
+        value = int(value)
+        return None if value == NONE else value
+
+    def set(self, row, name, value):
+        with self.lock:
+            if name == 'device_status':
+                self.rows[name][row] = b'' if value is None else value
+            else:
+                self.rows[name][row] = NONE if value is None else value
+
+    # All fields of one 'U' package at once, so a snapshot never sees half of it
+    def write_update(self, row, values, update_time):
+        with self.lock:
+            rows = self.rows
+            for name, value in zip(UPDATE_FIELDS, values):
+                rows[name][row] = value
+            rows['update_time'][row] = update_time
+
+    # Copy of the active rows (the whole table is copied in one go, under the lock)
+    def snapshot(self):
+        with self.lock:
+            rows = self.rows[:self.size].copy()
+        return rows[rows['active']]
+
+    def row_of(self, device_id):
+        with self.lock:
+            row = self.index.get(device_id)
+            return None if row is None else self.rows[row].copy()
+
+
+class StateField:
+
+    # Descriptor making a link attribute a view onto the link's row of server.state
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, link, owner=None):
+        if link is None:
+            return self
+        return link.state_table.get(link.state_row, self.name)
+
+    def __set__(self, link, value):
+        link.state_table.set(link.state_row, self.name, value)
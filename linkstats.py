@@ -0,0 +1,173 @@
+# Small HDR style histograms for timings measured by the server (group send skew, command
+# latencies, ...). Values are stored as integer counts of `unit` (microseconds by default) in
+# log-linear buckets: exact below 2**SUB_BUCKET_BITS units, above that every power of two is split
+# into 2**(SUB_BUCKET_BITS - 1) buckets, so percentiles are within ~1.6% of the recorded values.
+
+import threading
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+
+
+def bucket_index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + (value >> shift) - SUB_BUCKET_HALF
+
+
+# Highest value that falls into the bucket, so percentiles never under-report
+def bucket_value(index):
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift, sub = divmod(index - SUB_BUCKET_COUNT, SUB_BUCKET_HALF)
+    shift += 1
+    return ((sub + SUB_BUCKET_HALF + 1) << shift) - 1
+
+
+class Histogram:
+
+    def __init__(self, unit=1e-6):
+        self.unit = unit
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}  # bucket index -> count
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+    # value in seconds (or whatever unit is a fraction of), negative values count as 0
+    def record(self, value, count=1):
+        units = max(0, int(round(value / self.unit)))
+        index = bucket_index(units)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + count
+            self.count += count
+            self.total += units * count
+            if self.min is None or units < self.min:
+                self.min = units
+            if self.max is None or units > self.max:
+                self.max = units
+
+    def merge(self, other):
+        with other.lock:
+            counts, count, total, lo, hi = dict(other.counts), other.count, other.total, other.min, other.max
+        scale = other.unit / self.unit
+        with self.lock:
+            for index, n in counts.items():
+                if scale != 1:
+                    index = bucket_index(int(round(bucket_value(index) * scale)))
+                self.counts[index] = self.counts.get(index, 0) + n
+            if count:
+                self.count += count
+                self.total += int(round(total * scale))
+                lo, hi = int(round(lo * scale)), int(round(hi * scale))
+                self.min = lo if self.min is None else min(self.min, lo)
+                self.max = hi if self.max is None else max(self.max, hi)
+        return self
+
+    # p in 0..100, returns seconds (None if empty)
+    def percentile(self, p):
+        with self.lock:
+            if not self.count:
+                return None
+            target = max(1, int(self.count * p / 100 + 0.5))
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                if seen >= target:
+                    return min(bucket_value(index), self.max) * self.unit
+            return self.max * self.unit
+
+    def mean(self):
+        with self.lock:
+            return self.total / self.count * self.unit if self.count else None
+
+    def summary(self, percentiles=(50, 95, 99)):
+        out = {'count': self.count, 'mean': self.mean(),
+               'min': None if self.min is None else self.min * self.unit,
+               'max': None if self.max is None else self.max * self.unit}
+        for p in percentiles:
+            out[f'p{p:g}'] = self.percentile(p)
+        return out
+
+    # Plain dict (JSON friendly), from_dict(to_dict()) gives the same histogram back
+    def to_dict(self):
+        with self.lock:
+            return {'unit': self.unit, 'count': self.count, 'total': self.total, 'min': self.min,
+                    'max': self.max, 'buckets': [[bucket_value(i), n] for i, n in sorted(self.counts.items())]}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['unit'])
+        for value, n in data['buckets']:
+            index = bucket_index(value)
+            histogram.counts[index] = histogram.counts.get(index, 0) + n
+        histogram.count, histogram.total = data['count'], data['total']
+        histogram.min, histogram.max = data['min'], data['max']
+        return histogram
+
+
+# Command -> execution latencies: one histogram over all commands and one per number of
+# retransmissions the command needed (the last bucket collects MAX_RETRY_BUCKET and more)
+class CommandLatency:
+
+    MAX_RETRY_BUCKET = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histogram = Histogram()
+        self.by_retransmits = {}
+        self.commands = 0
+        self.retransmits = 0
+        self.superseded = 0  # replaced by a newer command before they were confirmed
+
+    def record(self, latency, retransmits=0):
+        bucket = min(retransmits, self.MAX_RETRY_BUCKET)
+        with self.lock:
+            self.commands += 1
+            self.retransmits += retransmits
+            if bucket not in self.by_retransmits:
+                self.by_retransmits[bucket] = Histogram()
+        self.histogram.record(latency)
+        self.by_retransmits[bucket].record(latency)
+
+    def record_superseded(self):
+        with self.lock:
+            self.superseded += 1
+
+    def merge(self, other):
+        with self.lock:
+            self.commands += other.commands
+            self.retransmits += other.retransmits
+            self.superseded += other.superseded
+            for bucket, histogram in list(other.by_retransmits.items()):
+                if bucket not in self.by_retransmits:
+                    self.by_retransmits[bucket] = Histogram()
+                self.by_retransmits[bucket].merge(histogram)
+        self.histogram.merge(other.histogram)
+        return self
+
+    def summary(self):
+        out = self.histogram.summary()
+        out.update({'commands': self.commands, 'retransmits': self.retransmits, 'superseded': self.superseded,
+                    'by_retransmits': {bucket: self.by_retransmits[bucket].summary() for bucket in sorted(self.by_retransmits)}})
+        return out
+
+    def to_dict(self):
+        return {'commands': self.commands, 'retransmits': self.retransmits, 'superseded': self.superseded,
+                'histogram': self.histogram.to_dict(),
+                'by_retransmits': {str(bucket): h.to_dict() for bucket, h in sorted(self.by_retransmits.items())}}
+
+    @classmethod
+    def from_dict(cls, data):
+        latency = cls()
+        latency.commands, latency.retransmits, latency.superseded = data['commands'], data['retransmits'], data['superseded']
+        latency.histogram = Histogram.from_dict(data['histogram'])
+        latency.by_retransmits = {int(bucket): Histogram.from_dict(h) for bucket, h in data['by_retransmits'].items()}
+        return latency
@@ -0,0 +1,125 @@
+# Telemetry history of a link: a preallocated NumPy ring buffer of timestamped 'U' packages.
+# Every received package is written in place into the next row (no allocation per package), the
+# oldest rows are overwritten once the buffer is full, so memory stays fixed for long experiments.
+#
+# Rows have the fields of the 'U' package as received (rmlarray.UPDATE_DTYPE, so bat_status is the
+# raw value, not shifted like RobotLink.bat_status) plus 'time', the server time (seconds since the
+# server start, see LinkServer.get_server_time_raw) at which the package was handled.
+#
+# The receiver writes and controller threads read under a short lock; every query returns a copy
+# ordered oldest -> newest, so readers never see a row being overwritten.
+#
+#   history = server.links[3].telemetry
+#   history.last(50)['srv0_pos']
+#   history.window(t0, t1)
+#   history.resample(0.1, start=t0)
+
+import threading
+import numpy as np
+
+from rmlarray import UPDATE_DTYPE
+
+TELEMETRY_CAPACITY = 4096  # rows per link, ~3.5 minutes at 20 packages per second
+
+TELEMETRY_DTYPE = np.dtype([('time', '<f8')] + [(name, UPDATE_DTYPE.fields[name][0]) for name in UPDATE_DTYPE.names])
+
+
+class TelemetryRing:
+
+    def __init__(self, capacity=TELEMETRY_CAPACITY):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.rows = np.zeros(capacity, dtype=TELEMETRY_DTYPE)
+        # views onto the columns of rows, append writes the package fields through them
+        self.times = self.rows['time']
+        self.columns = [self.rows[name] for name in UPDATE_DTYPE.names]
+        self.count = 0  # rows written since the start, the next row goes to count % capacity
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes
+
+    # Number of rows currently held
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # package is the decoded 'U' tuple (same order as UPDATE_DTYPE)
+    def append(self, time, package):
+        with self.lock:
+            i = self.count % self.capacity
+            self.times[i] = time
+            for column, value in zip(self.columns, package):
+                column[i] = value
+            self.count += 1
+
+    # rows with logical index first..count-1, oldest first. Caller holds the lock.
+    def take_from(self, first):
+        first = max(first, self.count - self.capacity, 0)
+        start, stop = first % self.capacity, (self.count - 1) % self.capacity + 1
+        if self.count == first:
+            return self.rows[:0].copy()
+        if start < stop:
+            return self.rows[start:stop].copy()
+        return np.concatenate((self.rows[start:], self.rows[:stop]))
+
+    def snapshot(self):
+        with self.lock:
+            return self.take_from(0)
+
+    def last(self, n=1):
+        with self.lock:
+            return self.take_from(self.count - n)
+
+    # Rows written after logical index first (a previous return value, 0 for everything) and the
+    # index to pass next time. Rows already overwritten are skipped.
+    def since(self, first):
+        with self.lock:
+            return self.take_from(first), self.count
+
+    # Appends rows with TELEMETRY_DTYPE, e.g. from since() of another ring
+    def extend(self, rows):
+        rows = rows[-self.capacity:]
+        with self.lock:
+            start = self.count % self.capacity
+            head = min(len(rows), self.capacity - start)
+            self.rows[start:start + head] = rows[:head]
+            self.rows[:len(rows) - head] = rows[head:]
+            self.count += len(rows)
+
+    # The newest row as a 0-d structured array, or None before the first package
+    def latest(self):
+        with self.lock:
+            if not self.count:
+                return None
+            return self.rows[(self.count - 1) % self.capacity].copy()
+
+    # Rows with start <= time <= end (end=None: up to the newest)
+    def window(self, start, end=None):
+        rows = self.snapshot()
+        times = rows['time']
+        lo = np.searchsorted(times, start, side='left')
+        hi = len(rows) if end is None else np.searchsorted(times, end, side='right')
+        return rows[lo:hi]
+
+    # Rows on a uniform time grid (start, start + period, ... <= end). Each grid row holds the
+    # newest package received at or before its time (zero order hold); its 'time' is the grid time.
+    # Grid times before the first held package are left out.
+    def resample(self, period, start=None, end=None):
+        rows = self.snapshot()
+        if not len(rows):
+            return rows
+        times = rows['time']
+        start = times[0] if start is None else max(start, times[0])
+        end = times[-1] if end is None else end
+        if end < start:
+            return rows[:0]
+        grid = start + period * np.arange(int((end - start) / period + 1e-9) + 1)
+        out = rows[np.searchsorted(times, grid, side='right') - 1]
+        out['time'] = grid
+        return out
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
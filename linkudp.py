@@ -0,0 +1,138 @@
+# Telemetry over UDP. On a lossy WiFi link one lost TCP segment holds back every later 'U' package
+# until it has been retransmitted (head of line blocking), although only the newest one matters.
+# With LinkServer(..., udp_port=True) the server also takes 'U' packages as datagrams:
+#
+#   DATAGRAM_HEADER_STRUCT (device_id, sequence) + 'U' wire frame (with its CRC)
+#
+# sent to the server's host on udp_port (True: the same number as the TCP port). Commands, Hello
+# and everything else stay on the TCP connection, which is also what the datagrams are matched
+# to: a datagram is only taken for a connected link (said Hello) and from the address of its
+# connection. Datagrams that are older than the newest one taken for the link (sequence numbers
+# compared modulo 2**32) are dropped as stale instead of rolling the link's state back.
+#
+# The threaded LinkServer reads the socket in one extra thread, AsyncLinkServer on its loop.
+# ShardedLinkServer doesn't take udp_port: SO_REUSEPORT would spread a link's datagrams over the
+# shards independently of which one serves its TCP connection.
+#
+#   server = LinkServer(host, port, udp_port=True)
+#   server.udp_stats()    # datagrams received / taken / stale / invalid / for unknown links / failed
+
+import asyncio
+import socket
+import threading
+import time
+
+from rmlprotocol import (
+    DATAGRAM_HEADER_STRUCT, DATAGRAM_LENGTH, UPDATE_FRAME_LENGTH, STRUCT_LENGTH_UPDATE,
+    FOOTER_STRUCT, FOOTER_LENGTH, get_crc_15,
+)
+
+SEQUENCE_MODULUS = 1 << 32
+UDP_RECEIVE_BUFFER = 1 << 20  # bytes of socket buffer, a burst of hundreds of links fits
+UPDATE_TYPE = ord('U')
+ERROR_PRINT_INTERVAL = 5.0  # seconds between printed datagram errors, the others are only counted
+
+
+# Whether sequence comes after last (None: nothing taken yet), with wrap around
+def is_newer(sequence, last):
+    return last is None or 0 < (sequence - last) % SEQUENCE_MODULUS < SEQUENCE_MODULUS // 2
+
+
+def make_datagram(device_id, sequence, frame):
+    return DATAGRAM_HEADER_STRUCT.pack(device_id, sequence % SEQUENCE_MODULUS) + frame
+
+
+def open_udp_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER)
+    except OSError:
+        pass
+    sock.bind((host, port))
+    return sock
+
+
+class TelemetryIngest:
+
+    # Checks datagrams and hands them to their links (LinkBase.handle_datagram). Called by the
+    # reader thread or the event loop, one datagram at a time.
+
+    def __init__(self, server):
+        self.server = server
+        self.received = 0
+        self.accepted = 0
+        self.stale = 0
+        self.invalid = 0  # wrong length or type, bad CRC
+        self.unknown = 0  # no connected link with that device_id at that address
+        self.errors = 0  # raised while handling the datagram
+        self.last_error_print = None
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        if len(data) != DATAGRAM_LENGTH:
+            self.invalid += 1
+            return
+        device_id, sequence = DATAGRAM_HEADER_STRUCT.unpack_from(data)
+        frame = memoryview(data)[DATAGRAM_HEADER_STRUCT.size:]
+        n = UPDATE_FRAME_LENGTH - FOOTER_LENGTH
+        if (frame[0] != STRUCT_LENGTH_UPDATE or frame[1] != UPDATE_TYPE
+                or FOOTER_STRUCT.unpack_from(frame, n)[0] != get_crc_15(frame[:n])):
+            self.invalid += 1
+            return
+        link = self.server.links.get(device_id)
+        if link is None or link.addr is None or link.addr[0] != addr[0]:
+            self.unknown += 1
+            return
+        if link.handle_datagram(sequence, frame):
+            self.accepted += 1
+        else:
+            self.stale += 1
+
+    # datagram_received raised e. A flood of broken datagrams must not flood stderr, so errors are
+    # counted and only printed every ERROR_PRINT_INTERVAL seconds.
+    def failed(self, addr, e):
+        self.errors += 1
+        now = time.monotonic()
+        if self.last_error_print is not None and now - self.last_error_print < ERROR_PRINT_INTERVAL:
+            return
+        self.last_error_print = now
+        from linknetworking import safe_error_print  # linknetworking imports this module
+        safe_error_print(f"Telemetry datagram from {addr} failed: {e} ({self.errors} errors so far)")
+
+    def stats(self):
+        return {'received': self.received, 'accepted': self.accepted, 'stale': self.stale,
+                'invalid': self.invalid, 'unknown': self.unknown, 'errors': self.errors}
+
+
+# Reader thread of the threaded LinkServer
+class DatagramReader(threading.Thread):
+
+    def __init__(self, sock, ingest):
+        super().__init__(name="TelemetryDatagrams", daemon=True)
+        self.sock = sock
+        self.ingest = ingest
+
+    def run(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(DATAGRAM_LENGTH + 1)
+            except OSError:
+                return  # socket closed by close_server
+            try:
+                self.ingest.datagram_received(data, addr)
+            except Exception as e:
+                self.ingest.failed(addr, e)
+
+
+# asyncio side of AsyncLinkServer
+class DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, ingest):
+        self.ingest = ingest
+
+    def datagram_received(self, data, addr):
+        try:
+            self.ingest.datagram_received(data, addr)
+        except Exception as e:
+            self.ingest.failed(addr, e)
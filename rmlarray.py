@@ -0,0 +1,154 @@
+# Vectorized (NumPy) decoding of RML frames, for offline analysis and fast replay of telemetry.
+# Decodes a buffer of many 'U' frames into a structured array in a few array operations instead
+# of one struct.unpack per package. The dtypes are derived from STRUCT_FORMATS in rmlprotocol.
+
+import struct
+import numpy as np
+
+from rmlprotocol import (
+    STRUCT_FORMATS, STRUCT_FORMAT_HEADER, STRUCT_FIELDS_UPDATE, CRC_15_TABLE, REV7,
+    HEADER_LENGTH, FOOTER_LENGTH,
+)
+
+# struct format character -> numpy type, native byte order like the formats themselves
+STRUCT_TO_NUMPY = {
+    'c': 'S1',
+    'b': '=i1', 'B': '=u1',
+    'h': '=i2', 'H': '=u2',
+    'i': '=i4', 'I': '=u4',
+    'q': '=i8', 'Q': '=u8',
+}
+
+CRC_15_TABLE_NP = np.array(CRC_15_TABLE, dtype=np.uint16)
+REV7_NP = np.array(REV7, dtype=np.uint16)
+
+
+# Builds a dtype with the same layout (native alignment included) as struct.Struct(fmt)
+def struct_dtype(fmt, names, offset=0):
+    codes = fmt.split()
+    assert len(codes) == len(names), "one name per struct field needed"
+    formats = []
+    offsets = []
+    prefix = ''
+    for code in codes:
+        # offset of this field = size of everything before it, padded to its alignment
+        offsets.append(offset + struct.calcsize(prefix + code) - struct.calcsize(code))
+        formats.append(STRUCT_TO_NUMPY[code])
+        prefix += code
+    return np.dtype({'names': list(names), 'formats': formats, 'offsets': offsets,
+                     'itemsize': offset + struct.calcsize(fmt)})
+
+
+# dtype of a complete wire frame: header, body and the (low byte first) CRC footer
+def frame_dtype(package_type, names):
+    body = struct_dtype(STRUCT_FORMATS[package_type], names, offset=HEADER_LENGTH)
+    header_names = ['length', 'package_type']
+    header = struct_dtype(STRUCT_FORMAT_HEADER, header_names)
+    fields = {name: body.fields[name] for name in body.names}
+    fields.update({name: header.fields[name] for name in header_names})
+    fields['crc'] = (np.dtype('<u2'), body.itemsize)
+    names = header_names + list(body.names) + ['crc']
+    return np.dtype({'names': names,
+                     'formats': [fields[n][0] for n in names],
+                     'offsets': [fields[n][1] for n in names],
+                     'itemsize': body.itemsize + FOOTER_LENGTH})
+
+
+UPDATE_DTYPE = struct_dtype(STRUCT_FORMATS[b'U'], STRUCT_FIELDS_UPDATE)
+UPDATE_FRAME_DTYPE = frame_dtype(b'U', STRUCT_FIELDS_UPDATE)
+UPDATE_FRAME_LENGTH = UPDATE_FRAME_DTYPE.itemsize
+
+
+# CRC-15 of every row of a (n, length) uint8 array, one vector operation per byte column
+def crc_15_rows(rows):
+    crc = np.zeros(len(rows), dtype=np.uint16)
+    for column in rows.T:
+        crc = ((crc & 0xff) << 7) ^ CRC_15_TABLE_NP[(column & 0x7f) ^ REV7_NP[crc >> 8]]
+    return crc
+
+
+# Decodes a buffer of back to back 'U' frames. Returns (frames, valid) where frames is a
+# structured array with UPDATE_FRAME_DTYPE and valid is a bool mask (right header and CRC).
+# Trailing bytes that don't make a full frame are ignored.
+def decode_update_frames(buffer):
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    n = len(raw) // UPDATE_FRAME_LENGTH
+    rows = raw[:n * UPDATE_FRAME_LENGTH].reshape(n, UPDATE_FRAME_LENGTH)
+    frames = rows.view(UPDATE_FRAME_DTYPE).reshape(n)
+
+    valid = (frames['length'] == UPDATE_DTYPE.itemsize) & (frames['package_type'] == b'U')
+    valid &= crc_15_rows(rows[:, :-FOOTER_LENGTH]) == frames['crc']
+    return frames, valid
+
+
+# Finds and decodes the 'U' frames in an arbitrary stream (other package types, partial or
+# corrupted frames in between, e.g. a raw capture). Returns (offsets, frames) of the valid ones.
+def find_update_frames(buffer):
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    if len(raw) < UPDATE_FRAME_LENGTH:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=UPDATE_FRAME_DTYPE)
+
+    # candidate offsets: right length byte followed by 'U'
+    last = len(raw) - UPDATE_FRAME_LENGTH
+    offsets = np.flatnonzero((raw[:last + 1] == UPDATE_DTYPE.itemsize) & (raw[1:last + 2] == ord('U')))
+    rows = raw[offsets[:, None] + np.arange(UPDATE_FRAME_LENGTH)]
+    frames = rows.view(UPDATE_FRAME_DTYPE).reshape(len(offsets))
+    valid = crc_15_rows(rows[:, :-FOOTER_LENGTH]) == frames['crc']
+    offsets, frames = offsets[valid], frames[valid]
+
+    # a valid candidate inside another valid frame is a false positive, keep the first one
+    keep = np.ones(len(offsets), dtype=bool)
+    end = -1
+    for i, offset in enumerate(offsets.tolist()):
+        if offset < end:
+            keep[i] = False
+        else:
+            end = offset + UPDATE_FRAME_LENGTH
+    return offsets[keep], frames[keep]
+
+
+# Drops the header and footer, returns a plain array with UPDATE_DTYPE fields
+def update_bodies(frames):
+    out = np.empty(len(frames), dtype=UPDATE_DTYPE)
+    for name in STRUCT_FIELDS_UPDATE:
+        out[name] = frames[name]
+    return out
+
+
+if __name__ == '__main__':
+    # Compares the vectorized decoder with one struct.unpack per package
+    import random
+    import timeit
+    from rmlprotocol import RMLPacker, STRUCTS, get_crc_15, FOOTER_STRUCT
+
+    def make_update_frame(values):
+        header_and_body = bytes([STRUCTS[b'U'].size]) + b'U' + STRUCTS[b'U'].pack(*values)
+        return header_and_body + FOOTER_STRUCT.pack(get_crc_15(header_and_body))
+
+    rng = random.Random(0)
+    updates = [(b'R', rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(256),
+                rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(65536))
+               for _ in range(100000)]
+    buffer = bytearray(b''.join(make_update_frame(u) for u in updates))
+    buffer[5 * UPDATE_FRAME_LENGTH + 3] ^= 1
+
+    frames, valid = decode_update_frames(bytes(buffer))
+    assert valid.sum() == len(updates) - 1 and not valid[5]
+    for i in (0, 1, 99999):
+        assert tuple(update_bodies(frames[i:i + 1])[0]) == updates[i]
+
+    offsets, found = find_update_frames(b'\x01A\x00' + bytes(buffer))
+    assert len(found) == len(updates) - 1
+
+    def decode_python(buf):
+        out = []
+        for i in range(0, len(buf), UPDATE_FRAME_LENGTH):
+            header, body, footer = buf[i:i + 2], buf[i + 2:i + 12], buf[i + 12:i + 14]
+            if RMLPacker.verify_checksum(header, body, footer):
+                out.append(RMLPacker.decode(b'U', body))
+        return out
+
+    buf = bytes(buffer)
+    t_np = timeit.timeit(lambda: decode_update_frames(buf), number=5) / 5
+    t_py = timeit.timeit(lambda: decode_python(buf), number=1)
+    print(f"{len(updates)} frames: numpy {t_np * 1e3:.1f} ms, struct.unpack {t_py * 1e3:.1f} ms")
@@ -1,4 +1,6 @@
 import struct
+import threading
+from collections import OrderedDict
 
 # Hardcoded protocol information
 HEADER_LENGTH_SIZE = 1
@@ -23,15 +25,25 @@ STRUCT_FORMAT_EPOCH = 'q'
 
 STRUCT_FORMAT_LIST_ACTUAL = 'h H'
 
-STRUCT_LENGTH_HELLO = 2
-STRUCT_LENGTH_ACK = 1
-STRUCT_LENGTH_UPDATE = 8
-STRUCT_LENGTH_CAL_CON = 24
-STRUCT_LENGTH_CAL = 0
-STRUCT_LENGTH_POS = 4
-STRUCT_LENGTH_SIN = 14
-STRUCT_LENGTH_WALK = 1
-STRUCT_LENGTH_EPOCH = 8
+# A list entry runs for its duration byte times LIST_TIME_UNIT seconds (firmware tick), so at most
+# MAX_LIST_DURATION. Everything above ListMaker takes seconds and converts with list_duration.
+LIST_TIME_UNIT = 0.1
+MAX_LIST_DURATION = 255 * LIST_TIME_UNIT
+
+# Capability negotiation: a link that supports more than the original packages says Hello with
+# the extended format (device_id, MAX_VEL, its protocol version, capability bits). The server
+# answers with an 'N' package (protocol version, the capabilities it accepts, keyframe interval)
+# before the epoch. Links that send the short Hello never get an 'N' and keep the original packages.
+STRUCT_FORMAT_HELLO_EXTENDED = 'B B B B'
+STRUCT_FORMAT_NEGOTIATE = 'B B B'
+PROTOCOL_VERSION = 1
+CAP_DELTA_TELEMETRY = 0x01  # 'D' packages, see below
+
+# Names of the 'U' fields, in order (see RobotLink.run)
+STRUCT_FIELDS_UPDATE = (
+    'device_status', 'srv0_pos', 'srv1_pos', 'srv0_raw', 'srv1_raw',
+    'bat_status', 'srv0_vel', 'srv1_vel', 'executing_command_checksum',
+)
 
 STRUCT_FORMATS = {
     b'H': STRUCT_FORMAT_HELLO,
@@ -43,37 +55,396 @@ STRUCT_FORMATS = {
     b'W': STRUCT_FORMAT_WALK,
     b'F': STRUCT_FORMAT_FOOTER,
     b'T': STRUCT_FORMAT_EPOCH,
+    b'N': STRUCT_FORMAT_NEGOTIATE,
 }
 
+# Bodies of the packages we send to the Link. Same as above except for 'C', which has no body
+# when sent (the Link answers with the 'C' calibration confirmation above)
+SEND_STRUCT_FORMATS = {
+    b'A': STRUCT_FORMAT_ACK,
+    b'C': STRUCT_FORMAT_CAL,
+    b'P': STRUCT_FORMAT_POS,
+    b'S': STRUCT_FORMAT_SIN,
+    b'W': STRUCT_FORMAT_WALK,
+    b'T': STRUCT_FORMAT_EPOCH,
+    b'N': STRUCT_FORMAT_NEGOTIATE,
+}
+
+# Compiled codec: one struct.Struct per package type, built once from the formats above.
+# Everything below (lengths, headers) is derived from these so it can't drift from the formats.
+# Formats keep native byte order and alignment, which is what the firmware uses.
+STRUCTS = {package_type: struct.Struct(fmt) for package_type, fmt in STRUCT_FORMATS.items()}
+SEND_STRUCTS = {package_type: struct.Struct(fmt) for package_type, fmt in SEND_STRUCT_FORMATS.items()}
+
+HEADER_STRUCT = struct.Struct(STRUCT_FORMAT_HEADER)
+LIST_HEADER_STRUCT = struct.Struct(STRUCT_FORMAT_LIST_ACTUAL)
+# The CRC goes on the wire low byte first
+FOOTER_STRUCT = struct.Struct('<H')
+
+STRUCT_LENGTH_HELLO = STRUCTS[b'H'].size
+STRUCT_LENGTH_ACK = STRUCTS[b'A'].size
+STRUCT_LENGTH_UPDATE = STRUCTS[b'U'].size
+STRUCT_LENGTH_CAL_CON = STRUCTS[b'C'].size
+STRUCT_LENGTH_CAL = SEND_STRUCTS[b'C'].size
+STRUCT_LENGTH_POS = STRUCTS[b'P'].size
+STRUCT_LENGTH_SIN = STRUCTS[b'S'].size
+STRUCT_LENGTH_WALK = STRUCTS[b'W'].size
+STRUCT_LENGTH_EPOCH = STRUCTS[b'T'].size
+
 HEADERS = {
-    'A': bytes([STRUCT_LENGTH_ACK]) + b'A',
-    'C': bytes([STRUCT_LENGTH_CAL]) + b'C',
-    'P': bytes([STRUCT_LENGTH_POS]) + b'P',
-    'S': bytes([STRUCT_LENGTH_SIN]) + b'S',
-    'W': bytes([STRUCT_LENGTH_WALK]) + b'W',
-    'T': bytes([STRUCT_LENGTH_EPOCH]) + b'T',
+    package_type.decode("ASCII"): bytes([s.size]) + package_type for package_type, s in SEND_STRUCTS.items()
 }
 
+# The length field is a single byte
+MAX_BODY_LENGTH = 255
+MAX_FRAME_LENGTH = HEADER_LENGTH + MAX_BODY_LENGTH + FOOTER_LENGTH
+
+HELLO_EXTENDED_STRUCT = struct.Struct(STRUCT_FORMAT_HELLO_EXTENDED)
+
+# Delta telemetry ('D', with CAP_DELTA_TELEMETRY): a bitmap of the 'U' fields that changed since
+# the link's previous 'U' or 'D' package (bit i is STRUCT_FIELDS_UPDATE[i]) followed by just those
+# fields, little endian and without padding. An empty bitmap says nothing changed. A full 'U'
+# package is the keyframe: the link sends one first, then at least every keyframe_interval
+# packages and as the next package after every 'N'.
+DELTA_BITMAP_STRUCT = struct.Struct('<H')
+UPDATE_FIELD_FORMATS = tuple(STRUCT_FORMAT_UPDATE.split())
+DELTA_MAX_BODY_LENGTH = DELTA_BITMAP_STRUCT.size + sum(struct.calcsize('<' + f) for f in UPDATE_FIELD_FORMATS)
+
+# Package types whose body length isn't fixed, with the lengths they may have
+VARIABLE_BODY_LENGTHS = {
+    b'H': (STRUCT_LENGTH_HELLO, HELLO_EXTENDED_STRUCT.size),
+    b'D': tuple(range(DELTA_BITMAP_STRUCT.size, DELTA_MAX_BODY_LENGTH + 1)),
+}
+
+# Telemetry over UDP (see linkudp): every datagram is this header followed by one complete 'U'
+# wire frame. The sequence number counts the link's datagrams and wraps around at 2**32.
+DATAGRAM_HEADER_STRUCT = struct.Struct('<BI')  # device_id, sequence
+UPDATE_FRAME_LENGTH = HEADER_LENGTH + STRUCT_LENGTH_UPDATE + FOOTER_LENGTH
+DATAGRAM_LENGTH = DATAGRAM_HEADER_STRUCT.size + UPDATE_FRAME_LENGTH
+
+
+_delta_structs = {}
+
+
+# (struct of the fields in bitmap, their indexes in the 'U' package), cached per bitmap
+def delta_struct(bitmap):
+    entry = _delta_structs.get(bitmap)
+    if entry is None:
+        indexes = tuple(i for i in range(len(UPDATE_FIELD_FORMATS)) if bitmap >> i & 1)
+        entry = struct.Struct('<' + ''.join(UPDATE_FIELD_FORMATS[i] for i in indexes)), indexes
+        _delta_structs[bitmap] = entry
+    return entry
+
+
+# Body of the 'D' package for package after previous ('U' field tuples)
+def encode_delta(previous, package):
+    bitmap = 0
+    for i, (old, new) in enumerate(zip(previous, package)):
+        if old != new:
+            bitmap |= 1 << i
+    s, indexes = delta_struct(bitmap)
+    return DELTA_BITMAP_STRUCT.pack(bitmap) + s.pack(*(package[i] for i in indexes))
+
+
+# (indexes, values) of a 'D' frame, None if its length doesn't match its bitmap
+def decode_delta(frame):
+    bitmap = DELTA_BITMAP_STRUCT.unpack_from(frame, HEADER_LENGTH)[0]
+    if bitmap >> len(UPDATE_FIELD_FORMATS):
+        return None
+    s, indexes = delta_struct(bitmap)
+    if frame[0] != DELTA_BITMAP_STRUCT.size + s.size:
+        return None
+    return indexes, s.unpack_from(frame, HEADER_LENGTH + DELTA_BITMAP_STRUCT.size)
+
+
+# The full 'U' package a decoded delta stands for
+def apply_delta(base, delta):
+    package = list(base)
+    for i, value in zip(*delta):
+        package[i] = value
+    return tuple(package)
+
+
+# Duration byte of a list entry that runs for seconds
+def list_duration(seconds):
+    ticks = int(round(seconds / LIST_TIME_UNIT))
+    if not 0 <= ticks <= 255:
+        raise ValueError(f"List entry duration {seconds} s out of range (0 to {MAX_LIST_DURATION} s)")
+    return ticks
 
 ###################################################################################################
 
 # Credit to https://github.com/hiharin/snappro_xboot/blob/master/board/dm3730logic/prod-id/crc-15.c
+# Note: the firmware only feeds the 7 low bits of every byte into the CRC, the MSB is ignored.
 
-def get_crc_15(msg):
+CRC_15_POLY = 0x4599
+
+
+def _crc_15_step_bitwise(crc, byte):
+    for i in range(7):
+        crcnext = (byte & 1) ^ (crc>>14)
+        crc = (crc << 1) & 0x7fff
+        if not (crcnext == 0):
+            crc = crc^CRC_15_POLY
+        byte = byte >> 1
+    return crc
+
+
+# Reference implementation, kept to check the table driven engine against
+def get_crc_15_bitwise(msg):
     crc = 0
 
     for i in range(len(msg)):
-        byte = msg[i]
-        for i in range(7):
-            crcnext = (byte & 1) ^ (crc>>14)
-            crc = (crc << 1) & 0x7fff
-            if not (crcnext == 0):
-                crc = crc^0x4599
-            byte = byte >> 1
+        crc = _crc_15_step_bitwise(crc, msg[i])
 
     # print(crc)
     return crc
 
+
+# After 7 shifts the low 8 bits of the register simply move up to bits 7..14 and the
+# feedback only depends on the 7 data bits xor the (bit reversed) top 7 bits of the register.
+# So one byte costs one lookup: crc = ((crc & 0xff) << 7) ^ CRC_15_TABLE[data7 ^ REV7[crc >> 8]]
+CRC_15_TABLE = tuple(_crc_15_step_bitwise(0, i) for i in range(128))
+REV7 = tuple(int(format(i, '07b')[::-1], 2) for i in range(128))
+
+
+def get_crc_15(msg):
+    crc = 0
+    table = CRC_15_TABLE
+    rev = REV7
+
+    for byte in msg:
+        crc = ((crc & 0xff) << 7) ^ table[(byte & 0x7f) ^ rev[crc >> 8]]
+
+    return crc
+
+
+# Checksums a batch of messages (e.g. header + body of several packages) in one call
+def crc_many(msgs):
+    table = CRC_15_TABLE
+    rev = REV7
+    crcs = []
+
+    for msg in msgs:
+        crc = 0
+        for byte in msg:
+            crc = ((crc & 0xff) << 7) ^ table[(byte & 0x7f) ^ rev[crc >> 8]]
+        crcs.append(crc)
+
+    return crcs
+
+
+# Verifies a batch of complete wire frames (header + body + footer). The footer is the CRC
+# sent low byte first, see RobotLink.send_package. Returns one bool per frame.
+def verify_many(frames):
+    table = CRC_15_TABLE
+    rev = REV7
+    verified = []
+
+    for frame in frames:
+        n = len(frame) - FOOTER_LENGTH
+        if n < HEADER_LENGTH:
+            verified.append(False)
+            continue
+        crc = 0
+        for i in range(n):
+            crc = ((crc & 0xff) << 7) ^ table[(frame[i] & 0x7f) ^ rev[crc >> 8]]
+        verified.append(crc == frame[n] | (frame[n + 1] << 8))
+
+    return verified
+
+###################################################################################################
+
+# LRU cache of complete wire frames (header + body + swapped footer), keyed by package type and
+# arguments. Gaits send the same few commands over and over, so most sends become a dict lookup.
+# The cache is bounded so e.g. long sinusoid parameter sweeps can't grow it without limit.
+
+class FrameCache:
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, package_type, data):
+        key = (package_type, data)
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is not None:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = RMLPacker.make_frame(package_type, data)
+        if self.maxsize > 0:
+            with self.lock:
+                self.frames[key] = entry
+                if len(self.frames) > self.maxsize:
+                    self.frames.popitem(last=False)
+        return entry
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.frames) > max(maxsize, 0):
+                self.frames.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.frames), "maxsize": self.maxsize}
+
+###################################################################################################
+
+NO_LENGTHS = frozenset()
+
+
+# Incremental framer for the byte stream coming from a Link. Reads large chunks into a reusable
+# buffer (one recv_into can return many packages) and slices frames out with memoryview.
+# A frame is only accepted if its length byte matches the package type and its CRC is valid,
+# otherwise the framer drops one byte at a time until it finds the next valid alignment.
+
+class StreamFramer:
+
+    def __init__(self, buffer_size=4096):
+        assert buffer_size >= 2 * MAX_FRAME_LENGTH, "buffer_size has to fit at least two frames"
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+        # Keyed by the package type byte so no bytes objects are created while scanning
+        self.structs = {package_type[0]: s for package_type, s in STRUCTS.items()}
+        self.body_lengths = {package_type[0]: frozenset((s.size,)) for package_type, s in STRUCTS.items()}
+        for package_type, lengths in VARIABLE_BODY_LENGTHS.items():
+            self.body_lengths[package_type[0]] = frozenset(lengths)
+        # decoders of the bodies that don't have the fixed length of self.structs
+        self.variable_decoders = {
+            ord('H'): lambda frame: HELLO_EXTENDED_STRUCT.unpack_from(frame, HEADER_LENGTH),
+            ord('D'): decode_delta,
+        }
+
+        self.in_sync = True
+        self.recv_calls = 0
+        self.frames = 0
+        self.resyncs = 0
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+
+    def _make_room(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < MAX_FRAME_LENGTH:
+            n = self.end - self.start
+            self.view[:n] = self.view[self.start:self.end]
+            self.start, self.end = 0, n
+
+    # Reads whatever is available from sock (blocking like sock.recv). Returns the number of bytes read
+    def recv_from(self, sock):
+        n = sock.recv_into(self.get_buffer())
+        if n == 0:
+            raise ConnectionResetError("Connection closed by Link")
+        self.buffer_updated(n)
+        return n
+
+    # Free space to receive into (e.g. for asyncio.BufferedProtocol), commit it with buffer_updated
+    def get_buffer(self):
+        self._make_room()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.recv_calls += 1
+        self.end += nbytes
+
+    # Adds bytes that were read somewhere else (e.g. asyncio, a capture file). The buffer grows
+    # if the caller feeds more than fits without draining the frames in between.
+    def feed(self, data):
+        n = len(data)
+        self._make_room()
+        if len(self.buffer) - self.end < n:
+            pending = self.end - self.start
+            buffer = bytearray(max(2 * len(self.buffer), pending + n + MAX_FRAME_LENGTH))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.start, self.end = 0, pending
+        self.view[self.end:self.end + n] = data
+        self.end += n
+
+    def _skip(self):
+        if self.in_sync:
+            self.resyncs += 1
+            self.in_sync = False
+        self.start += 1
+        self.skipped_bytes += 1
+
+    # Returns the next complete and verified frame as a memoryview of the buffer (only valid until
+    # the next recv_from/feed), or None if more bytes are needed
+    def next_frame(self):
+        buf = self.buffer
+        table = CRC_15_TABLE
+        rev = REV7
+        while self.end - self.start >= HEADER_LENGTH + FOOTER_LENGTH:
+            i = self.start
+            length = buf[i]
+            if length not in self.body_lengths.get(buf[i + 1], NO_LENGTHS):
+                self._skip()
+                continue
+
+            n = HEADER_LENGTH + length
+            if self.end - i < n + FOOTER_LENGTH:
+                return None
+
+            crc = 0
+            for j in range(i, i + n):
+                crc = ((crc & 0xff) << 7) ^ table[(buf[j] & 0x7f) ^ rev[crc >> 8]]
+            if crc != buf[i + n] | (buf[i + n + 1] << 8):
+                self.crc_errors += 1
+                self._skip()
+                continue
+
+            self.start = i + n + FOOTER_LENGTH
+            self.in_sync = True
+            self.frames += 1
+            return self.view[i:self.start]
+        return None
+
+    # (package, package_type) of a frame from next_frame. A 'D' package decodes to (indexes, values)
+    # (None if it is malformed), see decode_delta.
+    def decode(self, frame):
+        package_type = frame[1]
+        s = self.structs.get(package_type)
+        if s is not None and frame[0] == s.size:
+            return s.unpack_from(frame, HEADER_LENGTH), chr(package_type)
+        return self.variable_decoders[package_type](frame), chr(package_type)
+
+    # Same as next_frame but decoded, returns (package, package_type) like RobotLink.receive_package
+    def next_package(self):
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        return self.decode(frame)
+
+    def stats(self):
+        return {
+            "recv_calls": self.recv_calls,
+            "frames": self.frames,
+            # the old receive_package made three recv calls per package
+            "recv_calls_per_frame": self.recv_calls / self.frames if self.frames else None,
+            "recv_calls_saved": 3 * self.frames - self.recv_calls,
+            "resyncs": self.resyncs,
+            "crc_errors": self.crc_errors,
+            "skipped_bytes": self.skipped_bytes,
+        }
+
 ###################################################################################################
 
 
@@ -88,17 +459,23 @@ class RMLPacker:
 
     @staticmethod
     def decode_header(header):
-        return struct.unpack(STRUCT_FORMAT_HEADER, header)
+        return HEADER_STRUCT.unpack(header)
 
     @staticmethod
     def decode(package_type, bin_data):
-        return struct.unpack(STRUCT_FORMATS[package_type], bin_data)
+        if package_type == b'H' and len(bin_data) == HELLO_EXTENDED_STRUCT.size:
+            return HELLO_EXTENDED_STRUCT.unpack(bin_data)
+        return STRUCTS[package_type].unpack(bin_data)
 
     @staticmethod
     def verify_checksum(header, body, footer):
         # print(str(footer), end = " and ")
         # print(str(RMLPacker.make_crc_footer(header + body)))
-        return struct.unpack('H', footer)[0] == get_crc_15(header+body)
+        return FOOTER_STRUCT.unpack(footer)[0] == get_crc_15(header+body)
+
+    @staticmethod
+    def verify_many(frames):
+        return verify_many(frames)
 
     # These functions have to do with SENDING PACKAGES to the Link:
 
@@ -107,11 +484,39 @@ class RMLPacker:
         # if this is a calibration message there is no body
         if package_type == b'C':
             return b''
-        return struct.pack(STRUCT_FORMATS[package_type], *data_tuple)
+        return SEND_STRUCTS[package_type].pack(*data_tuple)
+
+    # Complete wire frame of an already encoded header and body (e.g. list packages), returns
+    # (frame, crc)
+    @staticmethod
+    def pack_raw(header_and_body, crc=None):
+        if crc is None:
+            crc = get_crc_15(header_and_body)
+        return bytes(header_and_body) + FOOTER_STRUCT.pack(crc), crc
+
+    # Builds a complete immutable wire frame, returns (frame, crc)
+    @staticmethod
+    def make_frame(package_type, data_tuple):
+        header_and_body = HEADERS[package_type.decode("ASCII")] + RMLPacker.encode(package_type, data_tuple)
+        crc = get_crc_15(header_and_body)
+        return header_and_body + FOOTER_STRUCT.pack(crc), crc
+
+    # Same as make_frame, but goes through the frame cache
+    @staticmethod
+    def get_frame(package_type, data_tuple):
+        return RMLPacker.frame_cache.get(package_type, data_tuple)
+
+    @staticmethod
+    def get_position_frame(srv0_pos, srv1_pos, srv0_vel, srv1_vel):
+        return RMLPacker.frame_cache.get(b'P', (srv0_pos, srv1_pos, srv0_vel, srv1_vel))
+
+    @staticmethod
+    def get_sinusoidal_frame(start_time, a0, x0, ps0, p0, a1, x1, ps1, p1):
+        return RMLPacker.frame_cache.get(b'S', (start_time, a0, x0, ps0, p0, a1, x1, ps1, p1))
 
     @staticmethod
     def make_list_header(nr_repeat, start_time):
-        return struct.pack(STRUCT_FORMAT_LIST_ACTUAL, *(nr_repeat, start_time))
+        return LIST_HEADER_STRUCT.pack(nr_repeat, start_time)
 
     @staticmethod
     def make_calibrate_package():
@@ -155,3 +560,46 @@ class RMLPacker:
     def make_list(body):
         header_and_body = bytes([len(body)]) + b'L' + body
         return header_and_body, RMLPacker.make_crc_footer(header_and_body)
+
+    # Complete wire frame of a list package, (frame, crc)
+    @staticmethod
+    def make_list_frame(body):
+        header_and_body = bytes([len(body)]) + b'L' + body
+        crc = get_crc_15(header_and_body)
+        return header_and_body + FOOTER_STRUCT.pack(crc), crc
+
+
+RMLPacker.frame_cache = FrameCache()
+
+
+if __name__ == '__main__':
+    # Equivalence check of the table driven CRC against the bitwise reference and a microbenchmark
+    import random
+    import timeit
+
+    print("Checking every (register, byte) transition...")
+    for crc in range(0x8000):
+        for byte in range(256):
+            fast = ((crc & 0xff) << 7) ^ CRC_15_TABLE[(byte & 0x7f) ^ REV7[crc >> 8]]
+            assert fast == _crc_15_step_bitwise(crc, byte), (crc, byte)
+
+    rng = random.Random(0)
+    msgs = [bytes(rng.randrange(256) for _ in range(rng.randrange(64))) for _ in range(2000)]
+    assert [get_crc_15(m) for m in msgs] == [get_crc_15_bitwise(m) for m in msgs]
+    assert crc_many(msgs) == [get_crc_15_bitwise(m) for m in msgs]
+    frames = [m + get_crc_15_bitwise(m).to_bytes(2, 'little') for m in msgs if len(m) >= HEADER_LENGTH]
+    assert all(verify_many(frames))
+    assert not any(verify_many([f[:-1] + bytes([f[-1] ^ 1]) for f in frames]))
+    print("Table driven CRC matches the bitwise reference")
+
+    header_and_body, _ = RMLPacker.make_sinusoidal_package(10, 42, 58, 0, 32000, 42, 58, 0, 32000)
+    batch = [header_and_body] * 100
+    n = 20000
+    for name, stmt in (
+            ("bitwise, 16 byte package", lambda: get_crc_15_bitwise(header_and_body)),
+            ("table,   16 byte package", lambda: get_crc_15(header_and_body)),
+    ):
+        t = timeit.timeit(stmt, number=n)
+        print(f"{name}: {t / n * 1e6:.2f} us")
+    t = timeit.timeit(lambda: crc_many(batch), number=n // 100)
+    print(f"crc_many, 100 packages:   {t / (n // 100) / 100 * 1e6:.2f} us per package")